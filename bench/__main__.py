@@ -0,0 +1,77 @@
+import yaclipy as CLI
+from print_ext import Printer, Table, PrettyException
+from .images import PROFILES, build
+from .run import TASKS, run_all, load, save
+
+
+def _list(val, valid, what):
+    names = list(valid) if not val else val.split(',')
+    for n in names:
+        if n not in valid: raise PrettyException(msg=f"Unknown {what} \b1 {n}\b , pick from: {', '.join(valid)}")
+    return names
+
+
+
+def images(*, _out, profiles__p='', force=False):
+    ''' Build the benchmark images
+
+    Parameters:
+        --profiles <names>, -p <names>
+            Comma separated profiles (default all)
+        --force
+            Rebuild even if the image already exists
+    '''
+    for name in _list(profiles__p, PROFILES, 'profile'):
+        img, meta = build(name, f'{_out}/images', force=force)
+        Printer(f"\b1 {name}\b  {img}  ", f"\bdem {meta['inodes']}")
+        for c in meta['corrupt']: Printer(f"  \berr {c}")
+
+
+
+def run(*, _out, profiles__p='small', tasks__t='', baseline__b='bench/baseline.json', save__s=False, timeout=600):
+    ''' Time the sub-commands against the benchmark images and compare with the baseline
+
+    Parameters:
+        --profiles <names>, -p <names>
+            Comma separated profiles
+        --tasks <names>, -t <names>
+            Comma separated tasks (default all)
+        --baseline <file>, -b <file>
+            Where the baseline results are kept
+        --save, -s
+            Store these results as the new baseline
+        --timeout <seconds>
+            Give up on a task after this long
+    '''
+    base = load(baseline__b)
+    tbl = Table(1,1,1,1,1,1,1,1, tmpl='pad')
+    tbl('profile\ttask\tstatus\tseconds\tMB/s\tblocks/s\tpeak RSS\tvs. baseline\t', style='1')
+    def _progress(name, task, r):
+        b = base.get(name, {}).get(task)
+        vs = f"{r['seconds']/b['seconds']:.2f}x" if b and b['status'] == 'ok' and b['seconds'] else ''
+        Printer(f"\bdem {name} {task} {r['status']} {r['seconds']:.2f}s")
+        tbl(name, '\t', task, '\t', r['status'], '\t', f"{r['seconds']:.2f}", '\t', f"{r['mb_s']:.1f}", '\t', f"{r['blocks_s']:.0f}", '\t', f"{r['rss_kb']//1024}M", '\t', vs, '\t')
+    results = run_all(_list(profiles__p, PROFILES, 'profile'), _list(tasks__t, TASKS, 'task'), _out, timeout, _progress)
+    Printer(tbl)
+    if save__s:
+        save(baseline__b, results)
+        Printer(f"Saved baseline to {baseline__b}")
+
+
+
+@CLI.sub_cmds(images, run)
+def main(*, out='local/bench'):
+    ''' Benchmarks on synthetic ext2/ext3 images
+
+    Parameters:
+        --out <dir>
+            Where images and scratch directories go
+    '''
+    yield dict(_out=out)
+
+
+
+try:
+    CLI.Command(main)(__import__('sys').argv[1:]).run()
+except PrettyException as e:
+    Printer().pretty(e)
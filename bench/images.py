@@ -0,0 +1,155 @@
+''' Reproducible ext2/ext3 test images.
+
+Each profile is turned into a source tree (seeded, fixed timestamps), packed with `mke2fs -d`, optionally
+fragmented with `debugfs`, and then damaged in the ways described in the README: zeroed directory inodes,
+zeroed directory blocks, a root that points at the wrong dblock and disagreeing backup descriptors.
+'''
+import os, json, random, shutil, struct, hashlib
+from subprocess import run, DEVNULL, PIPE
+
+
+EPOCH = 1262304000 # 2010-01-01, every file gets a time derived from this
+
+PROFILES = {
+    'small': dict(size='64M', block_size=4096, files=500, depth=4, hugedir=0, big='4M', frag=0, corrupt=False),
+    'small1k': dict(size='64M', block_size=1024, files=500, depth=4, hugedir=0, big='4M', frag=0, corrupt=False),
+    'deep': dict(size='256M', block_size=4096, files=2000, depth=64, hugedir=0, big='1M', frag=0, corrupt=False),
+    'hugedir': dict(size='256M', block_size=4096, files=200, depth=2, hugedir=30000, big='1M', frag=0, corrupt=False),
+    'frag': dict(size='256M', block_size=4096, files=200, depth=2, hugedir=0, big='32M', frag=2000, corrupt=False),
+    'corrupt': dict(size='512M', block_size=4096, files=3000, depth=8, hugedir=2000, big='16M', frag=500, corrupt=True),
+    'large': dict(size='4G', block_size=4096, files=20000, depth=16, hugedir=10000, big='256M', frag=2000, corrupt=True),
+}
+
+
+def _bytes(size):
+    units = {'k':1<<10, 'M':1<<20, 'G':1<<30, 'T':1<<40}
+    return int(size[:-1]) * units[size[-1]] if size[-1] in units else int(size)
+
+
+def spec_hash(name):
+    return hashlib.md5(json.dumps([name, PROFILES[name]], sort_keys=True).encode('utf8')).hexdigest()[:8]
+
+
+def _write(path, data, t):
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.utime(path, (t, t))
+
+
+def _text(rng, n):
+    words = [b'alpha', b'bravo', b'mongo', b'libvirt', b'Pug.img', b'centos', b'root', b'var', b'gconf', b'\n']
+    return b' '.join(rng.choice(words) for _ in range(n))
+
+
+def build_tree(root, spec, rng):
+    ''' Fill `root` with the profile's files and return the paths of the interesting ones '''
+    names = {}
+    # A deep chain of directories, with some files at every level
+    path = root
+    for d in range(spec['depth']):
+        path = os.path.join(path, f'd{d}')
+        os.mkdir(path)
+    names['deep'] = '/' + os.path.relpath(path, root)
+    dirs = [os.path.join(root, *[f'd{i}' for i in range(d+1)]) for d in range(spec['depth'])] or [root]
+    for i in range(spec['files']):
+        d = dirs[rng.randrange(len(dirs))]
+        _write(os.path.join(d, f'f{i}.txt'), _text(rng, rng.randrange(1, 2000)), EPOCH + i*60)
+    # One very large directory
+    if spec['hugedir']:
+        hd = os.path.join(root, 'huge')
+        os.mkdir(hd)
+        for i in range(spec['hugedir']):
+            _write(os.path.join(hd, f'entry_with_a_longish_name_{i:06d}'), b'', EPOCH + i)
+        names['hugedir'] = '/huge'
+    # A big file, sparse enough to be quick to create but with real data in it
+    big = os.path.join(root, 'big.bin')
+    _write(big, rng.randbytes(_bytes(spec['big'])), EPOCH)
+    names['big'] = '/big.bin'
+    # README like layout: a var directory to zero out later
+    var = os.path.join(root, 'var', 'lib', 'libvirt', 'images')
+    os.makedirs(var)
+    _write(os.path.join(var, 'Pug.img'), _text(rng, 5000), EPOCH)
+    names['var'] = '/var'
+    names['libvirt'] = '/var/lib/libvirt'
+    os.symlink('var/lib/libvirt/images/Pug.img', os.path.join(root, 'pug'))
+    for dirpath, dirnames, _ in os.walk(root):
+        for d in dirnames: os.utime(os.path.join(dirpath, d), (EPOCH, EPOCH))
+    return names
+
+
+def fragment(img, work, spec, rng):
+    ''' Interleave a file with holes left by deleted fillers so its blocks are spread all over '''
+    filler = os.path.join(work, 'filler')
+    _write(filler, rng.randbytes(spec['block_size']), EPOCH)
+    frag = os.path.join(work, 'frag.bin')
+    _write(frag, rng.randbytes(spec['frag'] * spec['block_size']), EPOCH)
+    cmds = ['mkdir /filler'] + [f'write {filler} /filler/{i}' for i in range(2*spec['frag'])]
+    cmds += [f'rm /filler/{i}' for i in range(0, 2*spec['frag'], 2)]
+    cmds += [f'write {frag} /frag.bin']
+    with open(os.path.join(work, 'frag.cmds'), 'w') as f:
+        f.write('\n'.join(cmds) + '\n')
+    run(['debugfs', '-w', '-f', os.path.join(work, 'frag.cmds'), img], stdout=DEVNULL, stderr=DEVNULL, check=True)
+    return '/frag.bin'
+
+
+def inode_of(img, path):
+    out = run(['debugfs', '-R', f'stat {path}', img], stdout=PIPE, stderr=DEVNULL, check=True).stdout.decode('utf8')
+    return int(out.split()[1])
+
+
+def corrupt(img, inodes):
+    ''' Damage the image the way the README describes.  Returns what was done. '''
+    from e2fs import Superblock
+    done = []
+    with open(img, 'r+b') as f:
+        sb = Superblock(f, 1024)
+        def _zero(offset, size, why):
+            f.seek(offset)
+            f.write(bytes(size))
+            done.append(why)
+        # The var directory's inode is zeroed (like 0x1a8001)
+        var = sb.inode(inodes['var'])
+        _zero(var.offset, var.size, f"zeroed inode {hex(inodes['var'])} (/var)")
+        # libvirt's first directory block is zeroed
+        lv = sb.inode(inodes['libvirt'])
+        _zero(lv.block[0]*sb.block_size, sb.block_size, f"zeroed dblock #{lv.block[0]} (/var/lib/libvirt)")
+        # The root points at lost+found's directory block instead of its own
+        root, lpf = sb.inode(2), sb.inode(11)
+        done.append(f"root block[0] {root.block[0]} -> {lpf.block[0]}")
+        f.seek(root.offset + root.flds['block'][0])
+        f.write(struct.pack('<I', lpf.block[0]))
+        # One backup descriptor table disagrees with the others
+        for bgrp, _ in sb.super_bgs():
+            if bgrp.bg == 0: continue
+            _zero(bgrp.descriptors_offset + bgrp.BlockDescriptor.size, bgrp.BlockDescriptor.size, f"zeroed descriptor 1 in backup bg#{bgrp.bg}")
+            break
+    return done
+
+
+def build(name, out='local/bench/images', force=False):
+    ''' Build (or reuse) the image for profile `name`.  Returns (image path, metadata dict) '''
+    spec = PROFILES[name]
+    os.makedirs(out, exist_ok=True)
+    img = os.path.join(out, f'{name}-{spec_hash(name)}.img')
+    meta_file = img + '.json'
+    if not force and os.path.exists(meta_file):
+        with open(meta_file) as f:
+            return img, json.load(f)
+    rng = random.Random(name)
+    work = img + '.work'
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(os.path.join(work, 'root'))
+    names = build_tree(os.path.join(work, 'root'), spec, rng)
+    if os.path.exists(img): os.remove(img)
+    env = dict(os.environ, E2FSPROGS_FAKE_TIME=str(EPOCH))
+    run(['mke2fs', '-q', '-F', '-t', 'ext3', '-b', str(spec['block_size']), '-I', '128',
+         '-U', '2f1b5e4c-7d3a-4b8e-9c6f-0e1d2c3b4a59', '-E', 'hash_seed=6d5b8f1e-2a4c-4e7b-8f3d-1c9a0b2e4d6f',
+         '-d', os.path.join(work, 'root'), img, spec['size']], env=env, stdout=DEVNULL, check=True)
+    if spec['frag']: names['frag'] = fragment(img, work, spec, rng)
+    inodes = {k: inode_of(img, p) for k, p in names.items()}
+    meta = dict(profile=name, spec=spec, block_size=spec['block_size'], bytes=os.path.getsize(img), inodes=inodes, corrupt=[])
+    if spec['corrupt']: meta['corrupt'] = corrupt(img, inodes)
+    shutil.rmtree(work, ignore_errors=True)
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f, indent=2)
+    return img, meta
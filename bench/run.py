@@ -0,0 +1,116 @@
+''' Time the main sub-commands against the benchmark images.
+
+Every task runs in its own interpreter (so start-up and peak RSS are real) with `--stats-json`, which gives
+the bytes read for the throughput figures.
+'''
+import os, sys, json, time, pickle, glob
+from subprocess import Popen, DEVNULL
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY = 'import sys, yaclipy as CLI; from pyutil.main import main; CLI.Command(main)(sys.argv[1:]).run()'
+
+
+def _clean(*patterns):
+    ''' Remove the results a command caches, so every run does the full work '''
+    def _f(work):
+        for pattern in patterns:
+            for fname in glob.glob(os.path.join(work, pattern)):
+                os.remove(fname)
+    return _f
+
+
+def _prune(*patterns):
+    ''' search and isearch read the directory blocks found by analyze from local/pruned.pickle '''
+    clean = _clean(*patterns)
+    def _f(work):
+        clean(work)
+        dblks = {}
+        for fname in glob.glob(os.path.join(work, 'local/analysis/analysis_bg*.pickle')):
+            with open(fname, 'rb') as f:
+                blkids, _ = pickle.load(f)
+            dblks[fname] = blkids
+        with open(os.path.join(work, 'local/pruned.pickle'), 'wb') as f:
+            pickle.dump(dblks, f)
+    return _f
+
+
+# name: (argv builder, preparation).  Tasks after analyze use its results.
+TASKS = {
+    'descriptors': (lambda m: ['descriptors'], None),
+    'ls': (lambda m: ['ls', '2', '-d', '8', '-k'], None),
+    'cat': (lambda m: ['cat', hex(m['inodes']['big'])], None),
+    'cp': (lambda m: ['cp', hex(m['inodes']['big']), 'out.bin'], _clean('local/copy_*.status', 'out.bin')),
+    'analyze': (lambda m: ['analyze', 'local/analysis/'], _clean('local/analysis/*')),
+    'search': (lambda m: ['search', r'f1\d*\.txt'], _prune('local/search/*')),
+    'isearch': (lambda m: ['isearch', str(m['inodes']['big'])], _prune('local/isearch/*')),
+    'grep': (lambda m: ['grep', 'libvirt'], _clean('local/grep/*')),
+}
+
+
+def run_task(img, meta, task, work, timeout=600):
+    ''' Run one task, returning a dict of seconds, bytes read, throughput and peak RSS '''
+    argv, prep = TASKS[task]
+    for d in ('analysis', 'search', 'isearch', 'grep'):
+        os.makedirs(os.path.join(work, 'local', d), exist_ok=True)
+    if prep: prep(work)
+    stats_file = os.path.abspath(os.path.join(work, f'{task}.stats.json'))
+    if os.path.exists(stats_file): os.remove(stats_file)
+    cmd = [sys.executable, '-c', ENTRY, '-f', os.path.abspath(img), '--stats-json', stats_file] + argv(meta)
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    t0 = time.perf_counter()
+    # stdout goes to a real file: the progress bars need to truncate it
+    with open(os.path.join(work, f'{task}.out'), 'wb') as out, open(os.path.join(work, f'{task}.log'), 'wb') as log:
+        proc = Popen(cmd, cwd=work, env=env, stdin=DEVNULL, stdout=out, stderr=log)
+    status = 'ok'
+    while True:
+        pid, code, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid: break
+        if time.perf_counter() - t0 > timeout:
+            proc.kill()
+            pid, code, usage = os.wait4(proc.pid, 0)
+            status = 'timeout'
+            break
+        time.sleep(0.01)
+    proc.returncode = code
+    secs = time.perf_counter() - t0
+    if status == 'ok' and (code or not os.path.exists(stats_file)): status = f'failed ({code})'
+    nbytes = 0
+    if os.path.exists(stats_file):
+        with open(stats_file) as f:
+            counters = json.load(f)['counters']
+        nbytes = counters.get('read.bytes', 0) + counters.get('bitmap.bytes', 0)
+    return dict(status=status, seconds=secs, bytes=nbytes,
+        mb_s=nbytes/secs/(1<<20), blocks_s=nbytes/meta['block_size']/secs, rss_kb=usage.ru_maxrss)
+
+
+def run_all(profiles, tasks, out='local/bench', timeout=600, progress=None):
+    from .images import build
+    results = {}
+    for name in profiles:
+        img, meta = build(name, os.path.join(out, 'images'))
+        work = os.path.join(out, 'work', name)
+        os.makedirs(work, exist_ok=True)
+        results[name] = {}
+        for task in tasks:
+            results[name][task] = r = run_task(img, meta, task, work, timeout)
+            if progress: progress(name, task, r)
+    return results
+
+
+def load(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save(fname, results):
+    ''' Merge `results` into the baseline file, so profiles and tasks can be re-based one at a time '''
+    base = load(fname)
+    for name, tasks in results.items():
+        base.setdefault(name, {}).update(tasks)
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    with open(fname, 'w') as f:
+        json.dump(base, f, indent=2, sort_keys=True)
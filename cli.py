@@ -24,6 +24,32 @@ def hash(fname):
     return None
 
 
+def lock_hash(fname):
+    ''' hash(fname), remembered in a stamp file until the file's mtime or size changes '''
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    key, stamp = f'{st.st_mtime_ns} {st.st_size}', join(VENV_DIR, 'lock.stamp')
+    try:
+        with open(stamp) as f:
+            k, v = f.read().rsplit(' ', 1)
+        if k == key: return v
+    except (OSError, ValueError):
+        pass
+    v = hash(fname)
+    if v:
+        os.makedirs(VENV_DIR, exist_ok=True)
+        with open(stamp, 'w') as f: f.write(f'{key} {v}')
+    return v
+
+
+def venv_site(venv):
+    ''' The venv's site-packages if it was built for this interpreter, so we can use it without re-exec'ing '''
+    site = join(venv, 'lib', f'python{sys.version_info[0]}.{sys.version_info[1]}', 'site-packages')
+    return site if exists(site) else None
+
+
 def exec():
     os.execvp('python', ['python', './cli.py'] + sys.argv[1:])
 
@@ -37,8 +63,22 @@ def abort(venv, *reason):
 
 
 os.chdir(split(abspath(__file__))[0]) # Make the cwd the same as this file
-if sys.prefix == sys.base_prefix: # Not in the virtual env
-    venv = join(VENV_DIR, hash(REQ+'.lock') or 'nolock')
+if exists(os.environ.get('E2FSGROK_SOCKET', '')): # A daemon is serving, just forward the command
+    from pyutil.client import forward
+    sys.exit(forward(os.environ['E2FSGROK_SOCKET'], sys.argv[1:]))
+site_dir = None
+if sys.prefix == sys.base_prefix:
+    venv = join(VENV_DIR, lock_hash(REQ+'.lock') or 'nolock')
+    site_dir = venv_site(venv) if exists(venv) else None
+if site_dir:
+    # The venv was built for this interpreter: put its packages first on the path instead of starting another python
+    import site as _site
+    n = len(sys.path)
+    _site.addsitedir(site_dir)
+    added = sys.path[n:]
+    del sys.path[n:]
+    sys.path[1:1] = added
+elif sys.prefix == sys.base_prefix: # Not in the virtual env
     new = not exists(venv)
     if new and call(['python3', '-m','venv', venv]):
         abort(venv, "Couldn't create python3 virtual environment at", repr(venv))
@@ -58,7 +98,7 @@ if sys.prefix == sys.base_prefix: # Not in the virtual env
     if not lock_data: abort("Pip freeze failed")
     with open(REQ+'.lock', 'w') as f: f.write(lock_data)
     # Move it to the new lockfile location
-    venv2 = join(VENV_DIR, hash(REQ+'.lock') or 'nolock')
+    venv2 = join(VENV_DIR, lock_hash(REQ+'.lock') or 'nolock')
     import shutil
     shutil.move(venv, venv2)
     os.environ['PATH'] = os.pathsep.join([join(venv2,'bin')] + os.environ['PATH'].split(os.pathsep)[1:])
@@ -1,6 +1,7 @@
-import io, struct, functools
+import io, struct, functools, time
 from print_ext import PrettyException
-from .struct import pretty_num
+from .struct import pretty_num, read, pread
+from . import stats
 
 
 class BitmapIter():
@@ -40,24 +41,26 @@ class Bitmap():
 
 
     def byte(self, offset):
+        if stats.enabled: t0 = time.perf_counter()
         try:
-            self.stream.seek(offset+self.offset)
+            data = pread(self.stream, offset+self.offset, 1)
         except OSError:
             raise PrettyException(msg=f'EOF {pretty_num(offset+self.offset)} / {pretty_num(self.stream.seek(0,io.SEEK_END))}')
-        data = self.stream.read(1)
         if len(data) != 1:
             raise PrettyException(msg=f"EOF")
+        if stats.enabled: stats.io('bitmap', self.stream, offset+self.offset, 1, time.perf_counter()-t0)
         return struct.unpack_from('B', data)[0]
 
 
     def __setitem__(self, idx, b):
         byte = self.byte(idx//8)
-        self.stream.seek(-1, io.SEEK_CUR)
+        self.stream.seek(idx//8 + self.offset)
         if b:
             byte |= 1<<idx%8
         else:
             byte &= ~(1<<idx%8)
         self.stream.write(bytes([byte]))
+        self.stream.flush() # byte() preads below any buffer
 
 
     def __iter__(self):
@@ -68,11 +71,7 @@ class Bitmap():
 
 
     def __len__(self):
-        sum = 0
-        for i in range(self.size):
-            byte = self.byte(i)
-            sum += functools.reduce(lambda a, i: a + bool(byte&(1<<i)), range(8), 0)
-        return sum
+        return bin(int.from_bytes(read(self.stream, self.offset, self.size), 'little')).count('1')
 
 
     def total(self):
@@ -93,6 +92,10 @@ class BitmapMem(Bitmap):
         return self.stream[i]
 
 
+    def __len__(self):
+        return bin(int.from_bytes(self.stream, 'little')).count('1')
+
+
     def __setitem__(self, idx, b):
         byte = self.byte(idx//8)
         if b:
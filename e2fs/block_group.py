@@ -1,6 +1,7 @@
 from math import ceil, log
 from print_ext import PrettyException
 from .bitmap import Bitmap
+from .struct import read
 from .inode import INode128
 from .block_descriptor import BlockDescriptor32, BlockDescriptor64
 
@@ -74,11 +75,23 @@ class BlockGroup():
         return BlockDescriptor64 if self.sb.desc_size > 32 else BlockDescriptor32
     
 
+    @property
+    def descriptors_offset(self):
+        return self.bg * self.sb.bg_size + self.sb.block_size
+
+
     def descriptors(self):
         if not self.is_super():
             raise PrettyException(msg=f"no superblock at bg#{self.bg}")
         for i in range(self.sb.bg_count):
-            yield self.BlockDescriptor(self.sb.stream, self.bg * self.sb.bg_size + self.sb.block_size + i*self.BlockDescriptor.size, bg=i, bg_src=self.bg)
+            yield self.BlockDescriptor(self.sb.stream, self.descriptors_offset + i*self.BlockDescriptor.size, bg=i, bg_src=self.bg)
+
+
+    def descriptor_table(self):
+        ''' The raw bytes of every descriptor in this group's table, read in one go '''
+        if not self.is_super():
+            raise PrettyException(msg=f"no superblock at bg#{self.bg}")
+        return read(self.sb.stream, self.descriptors_offset, self.sb.bg_count * self.BlockDescriptor.size)
         
 
     def __pretty__(self, print, **kwargs):
@@ -0,0 +1,128 @@
+import io, threading, time
+from collections import OrderedDict
+from . import stats
+from .struct import pread
+
+
+class BlockCache(io.RawIOBase):
+    ''' A read-through LRU page cache in front of a seekable stream.
+
+    Writes go straight through to the stream and drop the pages they touch.
+    `pread` and `prefetch` don't use the stream position and can be called from several threads.
+    '''
+    def __init__(self, stream, size=256<<20, page=64<<10):
+        self.stream = stream
+        self.page = page
+        self.max_pages = max(1, size // page)
+        self.pages = OrderedDict()
+        self.pos = 0
+        self.lock = threading.RLock()
+
+
+    def readable(self): return True
+    def seekable(self): return True
+    def writable(self): return self.stream.writable()
+
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR: offset += self.pos
+        elif whence == io.SEEK_END: offset += self.stream.seek(0, io.SEEK_END)
+        if offset < 0: raise OSError(22, 'Invalid argument')
+        self.pos = offset
+        return self.pos
+
+
+    def tell(self):
+        return self.pos
+
+
+    def _store(self, n, data):
+        self.pages[n] = data
+        self.pages.move_to_end(n)
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+
+
+    def _page(self, n):
+        with self.lock:
+            try:
+                data = self.pages[n]
+                self.pages.move_to_end(n)
+                if stats.enabled: stats.count('cache.hits')
+                return data
+            except KeyError:
+                pass
+        # Read without the lock, so several threads can have reads in flight
+        if stats.enabled:
+            stats.count('cache.misses')
+            t0 = time.perf_counter()
+        data = pread(self.stream, n*self.page, self.page)
+        if stats.enabled: stats.io('disk', self.stream, n*self.page, len(data), time.perf_counter()-t0)
+        with self.lock:
+            self._store(n, data)
+        return data
+
+
+    def prefetch(self, offset, size):
+        ''' Fill the pages covering [offset, offset+size) with one large read '''
+        first, last = offset // self.page, (offset + size - 1) // self.page
+        with self.lock:
+            while first <= last and first in self.pages: first += 1
+            while last >= first and last in self.pages: last -= 1
+        if first > last: return
+        if stats.enabled: t0 = time.perf_counter()
+        data = pread(self.stream, first*self.page, (last-first+1)*self.page)
+        if stats.enabled: stats.io('disk', self.stream, first*self.page, len(data), time.perf_counter()-t0)
+        with self.lock:
+            for n in range(first, last+1):
+                chunk = data[(n-first)*self.page:(n-first+1)*self.page]
+                if not chunk: break
+                if n not in self.pages: self._store(n, chunk)
+
+
+    def pread(self, size, offset):
+        first, last = offset // self.page, (offset + size - 1) // self.page
+        start = offset - first*self.page
+        if first == last:
+            return self._page(first)[start:start+size]
+        self.prefetch(offset, size)
+        data = b''.join(self._page(n) for n in range(first, last+1))
+        return data[start:start+size]
+
+
+    def read(self, size=-1):
+        if size < 0: size = self.stream.seek(0, io.SEEK_END) - self.pos
+        if size <= 0: return b''
+        data = self.pread(size, self.pos)
+        self.pos += len(data)
+        return data
+
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+    def direct(self, offset, size):
+        ''' Reads can go around the cache, writes go straight through it '''
+        yield size, self.stream, offset
+
+
+    def invalidate(self, offset=0, size=None):
+        with self.lock:
+            if size == None:
+                self.pages.clear()
+                return
+            for n in range(offset // self.page, (offset + size - 1) // self.page + 1):
+                self.pages.pop(n, None)
+
+
+    def write(self, data):
+        with self.lock:
+            self.invalidate(self.pos, len(data))
+            self.stream.seek(self.pos)
+            n = self.stream.write(data)
+            self.stream.flush()
+            self.pos += n
+            return n
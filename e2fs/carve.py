@@ -0,0 +1,310 @@
+''' Carve files out of the blocks that no inode claims.
+
+Files start on a block boundary, so finding them is one anchored regex match per block start over large
+windows of unclaimed blocks (read with one pread each, on several threads).  A found file is then followed the
+way ext2/3 lays it out: 12 direct blocks, an indirect block of pointers, then a double indirect block of indirect
+blocks.  When the block after the direct ones doesn't look like an indirect block the file is assumed to be
+contiguous, past that block if it is all zeros (deleting a file on ext3 zeroes its indirect blocks).  Where the
+layout is guessed like that, an all zero block ends the file.  It also ends at a claimed block, at the start of
+another file, at the format's own end (the end of the gzip member, the trailer after a JPEG's image data, the last
+`%%EOF` of a PDF, the size in a sqlite header or a qcow2 refcount table), or at `max_size`.
+'''
+import re, struct, zlib
+from math import ceil
+from . import stats
+from .export import file_data
+from .mapfile import Unrecovered
+from .struct import pread
+
+
+# name: (magic, offset of the magic, file extension, end trailer)
+FORMATS = {
+    'gzip': (b'\x1f\x8b\x08', 0, 'gz', None),
+    'zip': (b'PK\x03\x04', 0, 'zip', b'PK\x05\x06'),
+    'pdf': (b'%PDF-', 0, 'pdf', b'%%EOF'),
+    'jpeg': (b'\xff\xd8\xff', 0, 'jpg', b'\xff\xd9'),
+    'sqlite': (b'SQLite format 3\x00', 0, 'sqlite', None),
+    'qcow2': (b'QFI\xfb\x00\x00\x00', 0, 'qcow2', None),
+    'wiredtiger': (b'\x41\xd8\x01\x00\x01\x00', 0, 'wt', None), # WT_BLOCK_MAGIC 120897, major version 1
+    'tar': (b'ustar', 257, 'tar', None),
+}
+# Formats that hold other files, so another signature inside them doesn't end them
+CONTAINERS = {'tar', 'qcow2'}
+
+
+
+def matcher(names=None):
+    ''' A function (data, offset) -> format name or None, for a block starting at `offset` of `data` '''
+    names = [n for n in FORMATS if not names or n in names]
+    by_offset = {}
+    for name in names:
+        magic, at, _, _ = FORMATS[name]
+        by_offset.setdefault(at, []).append(b'(?P<%s>%s)' % (name.encode(), re.escape(magic)))
+    pats = [(at, re.compile(b'|'.join(alts))) for at, alts in sorted(by_offset.items())]
+    def _match(data, offset):
+        for at, pat in pats:
+            m = pat.match(data, offset + at)
+            if m: return m.lastgroup
+        return None
+    return _match
+
+
+
+class Carver():
+    ''' Find and follow files in the unclaimed blocks.  `claimed(blkid)` says whether a block belongs to a known inode. '''
+    def __init__(self, sb, claimed, names=None, max_size=256<<20):
+        self.sb = sb
+        self.claimed = claimed
+        self.match = matcher(names)
+        self.max_blocks = max(1, max_size // sb.block_size)
+        self.per = sb.block_size // 4
+        self.zero = bytes(sb.block_size)
+
+
+    def find(self, run):
+        ''' [(blkid, format)] of the file starts in a run (first, count) of unclaimed blocks '''
+        first, count = run
+        bs = self.sb.block_size
+        try:
+            data = pread(self.sb.stream, first*bs, count*bs)
+        except Unrecovered: # One block at a time then
+            if count == 1: return []
+            return [f for blkid in range(first, first + count) for f in self.find((blkid, 1))]
+        if stats.enabled: stats.count('carve.blocks', count)
+        found = []
+        for i in range(len(data) // bs):
+            name = self.match(data, i*bs)
+            if name: found.append((first+i, name))
+        return found
+
+
+    def block(self, blkid):
+        try:
+            return pread(self.sb.stream, blkid*self.sb.block_size, self.sb.block_size)
+        except Unrecovered:
+            return b''
+
+
+    def empty(self, blkid):
+        ''' Whether the block is all zeros, from --classes when they know it '''
+        from .classify import UNKNOWN, ZERO, UNREADABLE
+        classes = getattr(self.sb, 'classes', None)
+        if classes != None and blkid < len(classes) and classes[blkid] not in (UNKNOWN, UNREADABLE): return classes[blkid] == ZERO
+        return self.block(blkid) == self.zero
+
+
+    def pointers(self, blkid, first=None):
+        ''' The block pointers if `blkid` looks like an indirect block: increasing, in range and unclaimed, then zeros.
+        With `first` the pointers have to start there.
+        '''
+        data = self.block(blkid)
+        if len(data) != self.sb.block_size or self.claimed(blkid): return None
+        ptrs = struct.unpack(f'<{self.per}I', data)
+        n = self.per
+        while n and not ptrs[n-1]: n -= 1
+        ptrs = ptrs[:n]
+        if not ptrs or 0 in ptrs or (first != None and ptrs[0] != first): return None
+        if any(b <= a for a, b in zip(ptrs, ptrs[1:])) or ptrs[-1] >= self.sb.blocks_count_lo: return None
+        if any(self.claimed(p) for p in ptrs): return None
+        return ptrs
+
+
+    def follow(self, start, name, starts):
+        ''' The blkids of the `name` file starting at `start` in logical order, and why it stopped.
+        `starts` are the blkids where other files start.
+        '''
+        blocks = []
+        if name in CONTAINERS: starts = ()
+        def _take(blkid, guessed=False):
+            if len(blocks) >= self.max_blocks: return 'max size'
+            if blkid >= self.sb.blocks_count_lo: return 'end of filesystem'
+            if self.claimed(blkid): return 'claimed block'
+            if blocks and blkid in starts: return 'next file'
+            if guessed and blocks and self.empty(blkid): return 'empty block'
+            blocks.append(blkid)
+            return None
+        for blkid in range(start, start+12):
+            why = _take(blkid, True)
+            if why: return blocks, why
+        ind = start + 12
+        ptrs = self.pointers(ind, ind+1)
+        if ptrs == None: # No indirect block, so contiguous
+            blkid = ind
+            # Deleting a file on ext3 zeroes its indirect block, which isn't file data
+            if not self.claimed(ind) and self.block(ind) == self.zero: blkid += 1
+            while True:
+                why = _take(blkid, True)
+                if why: return blocks, why
+                blkid += 1
+        for p in ptrs:
+            why = _take(p)
+            if why: return blocks, why
+        if len(ptrs) < self.per: return blocks, 'end of indirect block'
+        dind = ptrs[-1] + 1
+        inds = self.pointers(dind, dind+1)
+        if inds == None: return blocks, 'no double indirect block'
+        for ind in inds:
+            ptrs = self.pointers(ind, ind+1)
+            if ptrs == None: return blocks, 'bad indirect block'
+            for p in ptrs:
+                why = _take(p)
+                if why: return blocks, why
+        return blocks, 'end of double indirect block'
+
+
+    def size(self, name, blocks, why):
+        ''' The size of the file in `blocks`: exact when the format says, else up to its trailer, else all of them.
+        Returns (size, why it ends there)
+        '''
+        bs = self.sb.block_size
+        total = len(blocks) * bs
+        read_at = self._reader(blocks)
+        if name == 'sqlite':
+            hdr = read_at(0, 100)
+            page = struct.unpack_from('>H', hdr, 16)[0]
+            pages = struct.unpack_from('>I', hdr, 28)[0]
+            if pages: return min(total, (65536 if page == 1 else page) * pages), 'sqlite header'
+        elif name == 'gzip':
+            end = self.gzip_end(blocks)
+            if end != None: return end, 'gzip end'
+        elif name == 'qcow2':
+            end = qcow2_end(read_at, total)
+            if end != None: return min(total, end), 'qcow2 refcounts'
+        elif name == 'tar':
+            off = 0
+            while off + 512 <= total:
+                hdr = read_at(off, 512)
+                if not hdr.strip(b'\0'): return min(total, off + 1024), 'tar end'
+                try:
+                    n = int(hdr[124:136].strip(b'\0 ') or b'0', 8)
+                except ValueError:
+                    return off, 'bad tar header'
+                off += 512 + ceil(n / 512) * 512
+        elif FORMATS[name][3]:
+            end = self.trailer(name, blocks, jpeg_scan(read_at) if name == 'jpeg' else 0)
+            if end != None: return end, 'trailer'
+        return total, why
+
+
+    def _reader(self, blocks):
+        ''' A function (offset, n) -> bytes of the file in `blocks` '''
+        bs = self.sb.block_size
+        def read_at(offset, n):
+            out = []
+            i, skip = offset // bs, offset % bs
+            while n > 0 and i < len(blocks):
+                data = (self.block(blocks[i]) or self.zero)[skip:skip+n]
+                out.append(data)
+                n, i, skip = n - len(data), i + 1, 0
+            return b''.join(out)
+        return read_at
+
+
+    def gzip_end(self, blocks):
+        ''' Where the first gzip member in `blocks` ends, or None if it doesn't end there '''
+        d = zlib.decompressobj(31)
+        pos = 0
+        try:
+            for chunk in file_data(self.sb, list(enumerate(blocks)), len(blocks)*self.sb.block_size):
+                buf = chunk
+                while buf and not d.eof:
+                    d.decompress(buf, 1<<20) # Bounded output, the data can be a bomb of zeros
+                    buf = d.unconsumed_tail
+                if d.eof: return pos + len(chunk) - len(d.unused_data) - len(buf)
+                pos += len(chunk)
+        except zlib.error:
+            return None
+        return None
+
+
+    def trailer(self, name, blocks, start=0):
+        ''' Where the file ends, just past its trailer looked for from `start` on, or None.
+        A PDF ends at its last trailer, as incremental updates each append one.
+        '''
+        trailer = FORMATS[name][3]
+        pos, data, last = 0, b'', None
+        for chunk in file_data(self.sb, list(enumerate(blocks)), len(blocks)*self.sb.block_size):
+            data += chunk
+            at = data.find(trailer, max(0, start - pos))
+            while at >= 0:
+                if name == 'zip': # The end of central directory record, then its comment
+                    if at + 22 > len(data): break
+                    return pos + at + 22 + struct.unpack_from('<H', data, at + 20)[0]
+                end = at + len(trailer)
+                if name != 'pdf': return pos + end
+                while data[end:end+1] in (b'\r', b'\n'): end += 1
+                last = pos + end
+                at = data.find(trailer, end)
+            if name == 'zip' and at >= 0: continue
+            keep = len(trailer) - 1
+            pos += len(data) - keep
+            data = data[len(data)-keep:]
+        return last
+
+
+    def write(self, blocks, size, out):
+        ''' Write the first `size` bytes of `blocks` (in logical order) to the binary stream `out`.
+        Returns the blkids of the unreadable blocks, which were written as zeros.
+        '''
+        missing = []
+        for chunk in file_data(self.sb, list(enumerate(blocks)), size, missing=missing):
+            out.write(chunk)
+        return missing
+
+
+
+def jpeg_scan(read_at):
+    ''' The offset of a JPEG's first start of scan (SOS) marker, so an FF D9 in an EXIF thumbnail, which is in an
+    APP1 segment before it, isn't taken for the end.  0 when the segments don't lead to one.
+    '''
+    pos = 2
+    for _ in range(1024):
+        hdr = read_at(pos, 4)
+        if len(hdr) < 4 or hdr[0] != 0xff: return 0
+        marker = hdr[1]
+        if marker == 0xff: # Fill byte
+            pos += 1
+        elif marker == 0xda:
+            return pos
+        elif marker == 0x01 or 0xd0 <= marker <= 0xd8: # No length
+            pos += 2
+        else:
+            pos += 2 + struct.unpack_from('>H', hdr, 2)[0]
+    return 0
+
+
+
+def qcow2_end(read_at, total):
+    ''' The size of a qcow2 file: just past the last cluster its refcount table counts, or None '''
+    hdr = read_at(0, 104)
+    if len(hdr) < 104: return None
+    version, cluster_bits = struct.unpack_from('>I', hdr, 4)[0], struct.unpack_from('>I', hdr, 20)[0]
+    table, table_clusters = struct.unpack_from('>QI', hdr, 48)
+    order = struct.unpack_from('>I', hdr, 96)[0] if version >= 3 else 4
+    fmt = {3:'B', 4:'H', 5:'I', 6:'Q'}.get(order)
+    if not 9 <= cluster_bits <= 21 or not fmt or not table_clusters: return None
+    cs = 1 << cluster_bits
+    if table + table_clusters*cs > total: return None
+    per = cs * 8 >> order
+    refblocks = struct.unpack(f'>{table_clusters*cs//8}Q', read_at(table, table_clusters*cs))
+    for i in reversed(range(len(refblocks))):
+        if not refblocks[i] or refblocks[i] + cs > total: continue
+        counts = struct.unpack(f'>{per}{fmt}', read_at(refblocks[i], cs))
+        for j in reversed(range(per)):
+            if counts[j]: return (i*per + j + 1) * cs
+    return None
+
+
+
+def unclaimed_runs(bitmap, blocks_count, max_blocks=1024, classes=None):
+    ''' (first, count) runs of the zero bits of analyze's block bitmap, cut to `max_blocks`.
+    With `classes` (see `e2fs.classify`) the zero and unreadable blocks are left out, as no file starts there.
+    '''
+    import numpy as np
+    from .classify import ZERO, UNREADABLE
+    free = ~np.unpackbits(np.frombuffer(bitmap, dtype=np.uint8), bitorder='little')[:blocks_count].astype(bool)
+    if classes != None: free &= ~np.isin(classes.map, (ZERO, UNREADABLE))
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], free, [False])).astype(np.int8)))
+    for first, end in zip(edges[::2].tolist(), edges[1::2].tolist()):
+        for a in range(first, end, max_blocks):
+            yield a, min(end, a + max_blocks) - a
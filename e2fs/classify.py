@@ -0,0 +1,155 @@
+''' A one byte class for every block: what kind of data it holds, worked out once for all the scans.
+
+`classify` reads the whole image in large windows and computes cheap features of every block in the window
+at once with numpy: all zeros, byte entropy, printable ratio, and whether it looks like an indirect block
+(increasing in-range uint32 blkids, then zeros) or the first block of a directory ('.' then '..').
+The classes go to a memory-mapped file that `BlockClasses` opens again, so other commands can skip the blocks
+that can't hold what they are looking for.  A small JSON file next to it records the filesystem's UUID and where
+its stream came from (`Superblock.source`), and `load` only uses the classes for that same filesystem.  Blocks
+written since go back to UNKNOWN.
+'''
+import os, sys, json
+from . import stats
+from .mapfile import Unrecovered
+from .scan import pmap
+from .struct import pread
+
+
+UNKNOWN, ZERO, TEXT, BINARY, RANDOM, INDIRECT, DIRECTORY, UNREADABLE = range(8)
+NAMES = ['unknown', 'zero', 'text', 'binary', 'high-entropy', 'indirect', 'directory', 'unreadable']
+# Blocks that can't be directory entries, inodes or strings
+SKIP = (ZERO, RANDOM, UNREADABLE)
+
+PRINTABLE = 0.95 # Fraction of printable bytes for TEXT
+ENTROPY = 7.2 # Bits per byte for RANDOM (compressed or encrypted)
+
+
+
+def classes(data, block_size, blocks_count):
+    ''' The class of each block in `data` (a whole number of blocks) '''
+    import numpy as np
+    blks = np.frombuffer(data, dtype=np.uint8).reshape(-1, block_size)
+    n = len(blks)
+    out = np.full(n, BINARY, dtype=np.uint8)
+    # Entropy from a byte histogram per block, all blocks in one bincount
+    counts = np.bincount((np.arange(n, dtype=np.int64)[:, None] * 256 + blks).ravel(), minlength=n*256).reshape(n, 256)
+    p = counts / block_size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.where(p > 0, p * np.log2(p), 0).sum(axis=1)
+    out[entropy >= ENTROPY] = RANDOM
+    printable = counts[:, 0x20:0x7f].sum(axis=1) + counts[:, [9, 10, 13]].sum(axis=1)
+    out[printable >= PRINTABLE * block_size] = TEXT
+    # Indirect: a run of increasing in-range pointers from the start, then zeros
+    ptrs = blks.view('<u4').astype(np.int64)
+    nz = ptrs != 0
+    count = nz.sum(axis=1)
+    pos = np.arange(ptrs.shape[1])
+    prefix = (nz == (pos[None, :] < count[:, None])).all(axis=1)
+    rising = ((np.diff(ptrs, axis=1) > 0) | (pos[None, 1:] >= count[:, None])).all(axis=1)
+    inrange = (ptrs < blocks_count).all(axis=1)
+    out[(count > 0) & prefix & rising & inrange] = INDIRECT
+    # The first block of a directory: '.' (rec_len 12) then '..'
+    first = (blks[:, 4] == 12) & (blks[:, 5] == 0) & (blks[:, 6] == 1) & (blks[:, 8] == ord('.'))
+    second = (blks[:, 18] == 2) & (blks[:, 20] == ord('.')) & (blks[:, 21] == ord('.'))
+    out[first & second] = DIRECTORY
+    out[count == 0] = ZERO
+    return out
+
+
+
+def _window(sb, first, count):
+    bs = sb.block_size
+    try:
+        return first, classes(pread(sb.stream, first*bs, count*bs), bs, sb.blocks_count_lo)
+    except Unrecovered: # One block at a time then
+        import numpy as np
+        out = np.empty(count, dtype=np.uint8)
+        for i in range(count):
+            try:
+                out[i] = classes(pread(sb.stream, (first+i)*bs, bs), bs, sb.blocks_count_lo)[0]
+            except Unrecovered:
+                out[i] = UNREADABLE
+        return first, out
+
+
+
+def made_from(sb):
+    ''' What a class map is valid for '''
+    return {'uuid':sb.uuid.hex(), 'source':sb.source, 'blocks':sb.blocks_count_lo}
+
+
+
+def classify(sb, fname, window=4<<20, progress=None):
+    ''' Classify every block into `fname`.  Returns the number of blocks of each class. '''
+    import numpy as np
+    total = sb.blocks_count_lo
+    per = max(1, window // sb.block_size)
+    out = np.lib.format.open_memmap(fname, mode='w+', dtype=np.uint8, shape=(total,))
+    wins = [(first, min(per, total - first)) for first in range(0, total, per)]
+    for i, (first, cls) in enumerate(pmap(sb.pool, lambda w: _window(sb, *w), wins, sb.queue_depth)):
+        out[first:first+len(cls)] = cls
+        if progress: progress(i, len(wins))
+    out.flush()
+    with open(fname + '.json', 'w') as f:
+        json.dump(made_from(sb), f)
+    if stats.enabled: stats.count('classify.blocks', total)
+    return np.bincount(out, minlength=len(NAMES))
+
+
+
+class BlockClasses():
+    ''' The classes saved by `classify` '''
+    def __init__(self, fname):
+        import numpy as np
+        self.fname = fname
+        self.map = np.load(fname, mmap_mode='r')
+
+
+    def __len__(self):
+        return len(self.map)
+
+
+    def __getitem__(self, blkid):
+        return int(self.map[blkid])
+
+
+    def name(self, blkid):
+        return NAMES[self[blkid]] if blkid < len(self.map) else NAMES[UNKNOWN]
+
+
+    def skip(self, blkid, skip=SKIP):
+        return blkid < len(self.map) and self.map[blkid] in skip
+
+
+    def forget(self, first, last):
+        ''' Blocks [first, last) were written: they are UNKNOWN now, here and in the file '''
+        import numpy as np
+        if first >= len(self.map): return
+        if not self.map.flags.writeable: self.map = np.load(self.fname, mmap_mode='r+')
+        self.map[first:last] = UNKNOWN
+        self.map.flush()
+
+
+    def keep(self, blkids, skip=SKIP, skipped=None):
+        ''' The blkids that aren't in one of the `skip` classes, counting the others in skipped[0] '''
+        for blkid in blkids:
+            if blkid < len(self.map) and self.map[blkid] in skip:
+                if skipped != None: skipped[0] += 1
+                continue
+            yield blkid
+
+
+
+def load(sb, fname):
+    ''' The BlockClasses in `fname`, if it exists and was made from this filesystem, through the same stream '''
+    if not os.path.exists(fname): return None
+    try:
+        with open(fname + '.json') as f:
+            made = json.load(f)
+    except (OSError, ValueError):
+        made = None
+    if made != made_from(sb):
+        sys.stderr.write(f"Not using the classes in {fname}: they were made from {made['source'] if made else 'an unknown filesystem'} ({made['uuid'] if made else '?'}), run classify again\n")
+        return None
+    classes = BlockClasses(fname)
+    return classes if len(classes) == sb.blocks_count_lo else None
@@ -1,4 +1,6 @@
+import time
 from .struct import Struct, pretty_num, read
+from . import stats
 from .inode import INode128
 
 class DirIter():
@@ -39,6 +41,7 @@ class DirectoryBlk():
         
 
     def validate(self, **kwargs):
+        if stats.enabled: t0 = time.perf_counter()
         offset = self.blkid * self.sb.block_size
         di = 0
         next_blk = (self.blkid+1)*self.sb.block_size
@@ -53,6 +56,7 @@ class DirectoryBlk():
             self._errors.append(f"rec_len doesn't end on the next block {pretty_num(offset)} != {pretty_num(next_blk)}")
         if self.sb.blkid_free(self.blkid):
             self._errors.append(f"Block {self.blkid} is free")
+        if stats.enabled: stats.add_time('directory parse', time.perf_counter()-t0)
 
 
     def __iter__(self):
@@ -70,8 +74,10 @@ class EntryIter():
 
     def __next__(self):
         if self.offset >= self.next_blk: raise StopIteration()
+        if stats.enabled: t0 = time.perf_counter()
         d = DirectoryEntry(self.sb.stream, self.offset, blkid=self.dblk.blkid) 
         self.offset += d.rec_len or 2*self.sb.block_size
+        if stats.enabled: stats.add_time('directory parse', time.perf_counter()-t0)
         return d
 
 
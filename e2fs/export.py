@@ -0,0 +1,291 @@
+''' Write a directory tree out of the image as a streaming tar archive.
+
+Symlinks and devices come first, then the regular files sorted by where their data starts on disk, so the
+file data is read front to back with large coalesced reads (see `scan.blocks`), then the directories.
+Files with holes are written as PAX 1.0 sparse members, which GNU tar and Python's tarfile both extract.
+'''
+import io, os, asyncio, tarfile
+from itertools import chain
+from math import ceil
+from . import scan, stats
+from .mapfile import Unrecovered
+from .struct import read, pread, direct
+
+
+_TYPES = {0x1000:tarfile.FIFOTYPE, 0x2000:tarfile.CHRTYPE, 0x4000:tarfile.DIRTYPE, 0x6000:tarfile.BLKTYPE, 0x8000:tarfile.REGTYPE, 0xA000:tarfile.SYMTYPE}
+
+
+
+class _Chunks(io.RawIOBase):
+    ''' A read-only file over an iterator of bytes, for `TarFile.addfile` '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf:
+            self.buf = next(self.chunks, None)
+            if self.buf == None:
+                self.buf = b''
+                return 0
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+
+
+def _regions(pairs, block_size, size):
+    ''' Merge (logical index, blkid) pairs into the data regions [(offset, length)] of a sparse file '''
+    regions = []
+    for idx, _ in pairs:
+        if regions and regions[-1][0] + regions[-1][1] == idx*block_size:
+            regions[-1][1] += block_size
+        else:
+            regions.append([idx*block_size, block_size])
+    if regions: regions[-1][1] = min(regions[-1][1], size - regions[-1][0])
+    if not regions or regions[-1][0] + regions[-1][1] < size: regions.append([size, 0])
+    return regions
+
+
+
+def _sparse_map(regions):
+    data = f'{len(regions)}\n'.encode('ascii') + b''.join(f'{off}\n{n}\n'.encode('ascii') for off, n in regions)
+    return data + b'\0' * (-len(data) % tarfile.BLOCKSIZE)
+
+
+
+def file_data(sb, pairs, size, window=32<<20, missing=None):
+    ''' Yield the bytes of the allocated blocks in `pairs`, in logical order, cut off at `size`.
+    The blocks are read `window` bytes worth at a time, in physical order.  Unreadable blocks (see `e2fs.mapfile`)
+    come out as zeros, and their blkids are appended to `missing`.
+    '''
+    per = max(1, window // sb.block_size)
+    zero = bytes(sb.block_size)
+    for i in range(0, len(pairs), per):
+        chunk = pairs[i:i+per]
+        skipped = []
+        found = {blkid:bytes(data).ljust(sb.block_size, b'\0') for blkid, data in scan.blocks(sb, [blkid for _, blkid in chunk], skipped=skipped)}
+        if missing != None: missing.extend(skipped)
+        for idx, blkid in chunk:
+            yield found.get(blkid, zero)[:max(0, size - idx*sb.block_size)]
+
+
+
+def runs(pairs, block_size):
+    ''' Merge (logical index, blkid) pairs into (file offset, image offset, length) runs contiguous in both '''
+    out = []
+    for idx, blkid in pairs:
+        if out and out[-1][0] + out[-1][2] == idx*block_size and out[-1][1] + out[-1][2] == blkid*block_size:
+            out[-1][2] += block_size
+        else:
+            out.append([idx*block_size, blkid*block_size, block_size])
+    return out
+
+
+
+def _zeros(fd, n, chunk=1<<20):
+    zero = bytes(min(n, chunk))
+    while n > 0:
+        n -= _write(fd, zero[:min(n, chunk)])
+
+
+
+def _write(fd, data):
+    ''' Write all of `data` to a file descriptor or a binary file object '''
+    if not isinstance(fd, int): return fd.write(data)
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+    return len(data)
+
+
+
+def _read(sb, offset, size, missing):
+    ''' pread through the stream stack.  When a part is unrecovered (see `e2fs.mapfile`) read it a block at a time,
+    with zeros for the unrecovered blocks, whose blkids are appended to `missing`.
+    '''
+    try:
+        return pread(sb.stream, offset, size) or bytes(size)
+    except Unrecovered:
+        pass
+    bs, parts = sb.block_size, []
+    for off in range(offset, offset + size, bs):
+        n = min(bs, offset + size - off)
+        try:
+            parts.append(pread(sb.stream, off, n).ljust(n, b'\0'))
+        except Unrecovered:
+            parts.append(bytes(n))
+            missing.append(off // bs)
+    return b''.join(parts)
+
+
+
+def send_file(sb, inode, fd, size=None, missing=None):
+    ''' Write the first `size` bytes (default all) of a regular file to `fd`, a file descriptor or a binary file
+    object without one (e.g. the daemon's stdout).
+    Runs of blocks go from the image to `fd` with os.sendfile where nothing sits between them (an overlay, a mapfile
+    refusal), which keeps the data out of Python; holes are written as zeros, and so are unrecovered blocks, whose
+    blkids are appended to `missing`.  Returns the bytes written.
+    '''
+    if missing == None: missing = []
+    total = inode.file_size if size == None or size < 0 else min(size, inode.file_size)
+    use_sendfile = hasattr(os, 'sendfile') and isinstance(fd, int)
+    pos = 0
+    for offset, phys, length in runs(inode.block_map(err_ok=True), sb.block_size):
+        if offset >= total: break
+        if offset > pos: _zeros(fd, offset - pos)
+        length = min(length, total - offset)
+        top = phys
+        for n, src, off in direct(sb.stream, phys, length):
+            while n and src != None and use_sendfile:
+                try:
+                    sent = os.sendfile(fd, src, off, n)
+                except OSError: # e.g. an fd that sendfile can't write to
+                    use_sendfile = False
+                    break
+                if not sent: break # EOF of the image
+                if stats.enabled: stats.count('sendfile.bytes', sent)
+                off, top, n = off + sent, top + sent, n - sent
+            while n: # Read through the stream stack
+                data = _read(sb, top, min(n, 1<<20), missing)
+                _write(fd, data)
+                top, n = top + len(data), n - len(data)
+        pos = offset + length
+    if pos < total: _zeros(fd, total - pos)
+    return total
+
+
+
+class TarExport():
+    ''' Collect the tree under a directory inode, then write it with `write` '''
+    def __init__(self, sb, root, err_ok=True):
+        self.sb = sb
+        self.root = root
+        self.err_ok = err_ok
+        self.entries = [] # (path, inode)
+        self.errors = []
+        self.nbytes = 0
+
+
+    async def walk(self):
+        ''' Read the tree a level at a time, like `ls` '''
+        sb = self.sb
+        loop = asyncio.get_running_loop()
+        seen = {self.root.id}
+        self.entries.append(('.', self.root))
+        level = [('.', self.root)]
+        while level:
+            blkids = await asyncio.gather(*[loop.run_in_executor(sb.pool, lambda i=inode: list(i.each_block(err_ok=True))) for _, inode in level])
+            await sb.read_blocks({blkid for blks in blkids for blkid in blks})
+            found = []
+            for (path, _), blks in zip(level, blkids):
+                for blkid in blks:
+                    for e in self._entries(blkid):
+                        if e.name in b'..' or not e.inode: continue
+                        found.append((f'{path}/{e.name_utf8}', e.inode))
+            inodes = await sb.read_inodes({id for _, id in found})
+            level = []
+            for path, id in found:
+                if id not in inodes:
+                    self.errors.append(f"{path}: invalid inode {hex(id)}")
+                    continue
+                inode = inodes[id]
+                self.entries.append((path, inode))
+                if inode.ftype == inode.S_IFDIR and id not in seen:
+                    seen.add(id)
+                    level.append((path, inode))
+        return self
+
+
+    def _entries(self, blkid):
+        from .directory import DirectoryBlk
+        d = DirectoryBlk(self.sb, blkid)
+        d.validate(all=True)
+        if d._errors: self.errors.append(f"blk #{blkid}: " + '; '.join(d._errors))
+        return d.entries
+
+
+    def _info(self, path, inode):
+        info = tarfile.TarInfo(path)
+        info.type = _TYPES.get(inode.ftype, None)
+        info.mode = inode.mode & 0o7777
+        info.uid = inode.uid | inode.uid_high << 16
+        info.gid = inode.gid | inode.gid_high << 16
+        info.mtime = inode.mtime
+        return info
+
+
+    def _symlink(self, inode):
+        size = inode.size_lo
+        if not inode.blocks_lo: # Fast symlink, stored in the block map
+            return read(inode.stream, inode.offset + inode.flds['block'][0], size)
+        blkid = next(iter(inode.each_block(err_ok=True)), 0)
+        return b''.join(file_data(self.sb, [(0, blkid)], size)) if blkid else b''
+
+
+    def _device(self, info, inode):
+        old, new = inode.block[0], inode.block[1]
+        if old:
+            info.devmajor, info.devminor = (old >> 8) & 0xff, old & 0xff
+        else:
+            info.devmajor, info.devminor = (new >> 8) & 0xfff, (new & 0xff) | ((new >> 12) & 0xfff00)
+
+
+    def write(self, out, progress=None):
+        ''' Write the archive to the binary stream `out` '''
+        hardlinks = {}
+        links = {} # inode -> the LNKTYPE members held back until its regular file is written
+        files = []
+        dirs = []
+        with tarfile.open(fileobj=out, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for path, inode in self.entries:
+                info = self._info(path, inode)
+                if info.type == None:
+                    self.errors.append(f"{path}: skipping {inode.pretty_val('mode')}")
+                    continue
+                if info.type != tarfile.DIRTYPE and inode.id in hardlinks:
+                    info.type, info.linkname = tarfile.LNKTYPE, hardlinks[inode.id]
+                    if inode.id in links: links[inode.id].append(info)
+                    else: tar.addfile(info)
+                    continue
+                if info.type == tarfile.DIRTYPE:
+                    dirs.append(info)
+                    continue
+                hardlinks[inode.id] = path
+                if info.type == tarfile.REGTYPE:
+                    first = next(iter(inode.block_map(err_ok=True)), (0, 0))[1]
+                    files.append((first, path, inode, info))
+                    links[inode.id] = []
+                    continue
+                if info.type == tarfile.SYMTYPE:
+                    info.linkname = self._symlink(inode).decode('utf8', 'surrogateescape')
+                elif info.type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+                    self._device(info, inode)
+                tar.addfile(info)
+            files.sort(key=lambda f: (f[0], f[1]))
+            for i, (_, path, inode, info) in enumerate(files):
+                size = inode.file_size
+                pairs = list(inode.block_map(err_ok=self.err_ok))
+                missing = []
+                data = file_data(self.sb, pairs, size, missing=missing)
+                if len(pairs) == ceil(size / self.sb.block_size):
+                    info.size = size
+                else:
+                    regions = _sparse_map(_regions(pairs, self.sb.block_size, size))
+                    info.pax_headers = {'GNU.sparse.major':'1', 'GNU.sparse.minor':'0', 'GNU.sparse.name':path, 'GNU.sparse.realsize':str(size)}
+                    info.name = os.path.join(os.path.dirname(path), 'GNUSparseFile.0', os.path.basename(path))
+                    info.size = len(regions) + sum(min(self.sb.block_size, size - idx*self.sb.block_size) for idx, _ in pairs)
+                    data = chain([regions], data)
+                tar.addfile(info, io.BufferedReader(_Chunks(data), 1<<20))
+                for link in links.pop(inode.id): tar.addfile(link) # Extractors need the target first
+                if missing: self.errors.append(f"{path}: {len(missing)} unrecovered blocks written as zeros, from #{missing[0]}")
+                self.nbytes += info.size
+                if progress: progress(i, len(files), path)
+            # Last, so extracting the contents doesn't touch their mtimes, deepest first
+            for info in reversed(dirs):
+                tar.addfile(info)
+        return self
@@ -0,0 +1,62 @@
+''' Names for inodes, from the file list that build_file_list writes.
+
+Each line of the list is `blkid inode dir parent name` (the numbers after blkid in hex), one per entry of every
+directory block analyze found, where dir and parent are the block's '.' and '..'.  The list can be far bigger
+than memory, so `paths` streams it twice: once for the entries of the wanted inodes and the parent of every
+directory (two numbers each), then once more for the names of just the directories above the wanted entries, and
+joins them into paths.
+'''
+
+
+
+def _entries(fname):
+    ''' (inode, dir, parent, name) for each line '''
+    with open(fname, encoding='utf8', errors='surrogateescape') as f:
+        for line in f:
+            parts = line.rstrip('\n').split(' ', 4)
+            if len(parts) < 5: continue
+            try:
+                yield int(parts[1], 16), int(parts[2], 16), int(parts[3], 16), parts[4]
+            except ValueError:
+                continue
+
+
+
+def paths(fname, inodes, max_depth=64):
+    ''' {inode: [paths]} for the `inodes` that have an entry in the list.  A path starts at the first directory
+    whose name isn't known, shown as its inode number, e.g. '#0x3d78201/etc/passwd'
+    '''
+    inodes = set(inodes)
+    found = {} # inode -> [(dir, name)]
+    dirs = {}  # dir inode -> its parent ('..')
+    for inode, d, parent, name in _entries(fname):
+        if d: dirs[d] = parent
+        if inode in inodes: found.setdefault(inode, []).append((d, name))
+    ancestors = set()
+    for entries in found.values():
+        for d, _ in entries:
+            while d and d != 2 and d not in ancestors:
+                ancestors.add(d)
+                d = dirs.get(d)
+    names = {} # dir inode -> its name, for the ancestors only
+    for inode, d, parent, name in _entries(fname):
+        if inode in ancestors and inode not in names and name not in ('.', '..'): names[inode] = name
+    out = {}
+    for inode, entries in found.items():
+        for d, name in entries:
+            parts = [name]
+            seen = set()
+            while d and d not in seen and len(parts) < max_depth:
+                seen.add(d)
+                if d == 2: # The root
+                    parts.append('')
+                    break
+                if d not in names:
+                    parts.append(f'#{hex(d)}')
+                    break
+                parts.append(names[d])
+                d = dirs.get(d)
+            else: # A loop, too deep or no parent, so it doesn't start at a known directory either
+                parts.append(f'#{hex(d or 0)}')
+            out.setdefault(inode, []).append('/'.join(reversed(parts)))
+    return out
@@ -0,0 +1,148 @@
+''' A table of the hash of every data block, for finding the blocks of known files on the image.
+
+`index` hashes windows of blocks on several threads (hashlib lets go of the GIL for block sized data) and sorts
+the (hash, blkid) rows by hash, so `HashTable.lookup` is a binary search.  Like `e2fs.spill`, the rows are sorted a
+memory's worth at a time into runs on disk, which are then merged into the table.  Zero blocks are left out, they
+would match every hole.  `match` hashes a reference file the same way and lines its blocks up
+with the ones found on disk.
+'''
+import os, heapq, hashlib
+from . import stats
+from .mapfile import Unrecovered
+from .scan import pmap
+from .struct import pread
+
+
+DTYPE = [('hash', '<u8'), ('blkid', '<u8')]
+ROW = 16 # bytes per row
+
+
+
+def block_hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+
+def _hash_run(sb, run):
+    ''' The rows of a run (first, count) of blocks '''
+    import numpy as np
+    first, count = run
+    bs = sb.block_size
+    zero = bytes(bs)
+    try:
+        data = memoryview(pread(sb.stream, first*bs, count*bs))
+        blocks = ((first + i//bs, data[i:i+bs]) for i in range(0, len(data) - len(data) % bs, bs))
+    except Unrecovered: # One block at a time then
+        blocks = []
+        for blkid in range(first, first + count):
+            try:
+                blocks.append((blkid, pread(sb.stream, blkid*bs, bs)))
+            except Unrecovered:
+                continue
+    rows = [(block_hash(block), blkid) for blkid, block in blocks if len(block) == bs and block != zero]
+    if stats.enabled: stats.count('hashes.blocks', count)
+    return np.array(rows, dtype=DTYPE)
+
+
+
+def index(sb, fname, runs, progress=None, memory=256<<20):
+    ''' Hash the blocks of `runs` [(first, count)] into the table `fname`, holding at most `memory` bytes of rows.
+    Returns the number of rows.
+    '''
+    import numpy as np
+    runs = list(runs)
+    limit = max(1024, memory // ROW)
+    rows, buf, parts = 0, [], []
+    def _flush():
+        if not buf: return
+        with stats.timer('hashes.sort'):
+            table = np.concatenate(buf)
+            table.sort(order=['hash', 'blkid'])
+        parts.append(f'{fname}.run{len(parts)}')
+        table.tofile(parts[-1])
+        buf.clear()
+    for i, table in enumerate(pmap(sb.pool, lambda run: _hash_run(sb, run), runs, sb.queue_depth)):
+        buf.append(table)
+        rows += len(table)
+        if sum(len(t) for t in buf) >= limit: _flush()
+        if progress: progress(i, len(runs), rows)
+    _flush()
+    out = np.lib.format.open_memmap(fname, mode='w+', dtype=DTYPE, shape=(rows,))
+    with stats.timer('hashes.merge'):
+        chunk = max(1024, limit // (len(parts) + 1))
+        pos, batch = 0, []
+        for row in heapq.merge(*(_rows(part, chunk) for part in parts)):
+            batch.append(row)
+            if len(batch) >= chunk:
+                out[pos:pos+len(batch)] = batch
+                pos, batch = pos + len(batch), []
+        out[pos:pos+len(batch)] = batch
+    out.flush()
+    del out
+    for part in parts: os.remove(part)
+    return rows
+
+
+
+def _rows(fname, chunk):
+    ''' The (hash, blkid) rows of a sorted run, reading `chunk` of them at a time '''
+    import numpy as np
+    with open(fname, 'rb') as f:
+        while len(rows := np.fromfile(f, dtype=DTYPE, count=chunk)):
+            yield from rows.tolist()
+
+
+
+class HashTable():
+    ''' The table written by `index`, memory-mapped '''
+    def __init__(self, fname):
+        import numpy as np
+        self.fname = fname
+        self.rows = np.load(fname, mmap_mode='r')
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def lookup(self, h):
+        ''' The blkids of the blocks with hash `h`, in blkid order '''
+        hashes = self.rows['hash']
+        a, b = hashes.searchsorted(h, 'left'), hashes.searchsorted(h, 'right')
+        return self.rows['blkid'][a:b].tolist()
+
+
+
+def candidates(table, f, block_size):
+    ''' [blkids] for each block of the binary file `f`, or None for its zero blocks, which aren't in the table.
+    The last block is padded with zeros, as it is on disk.
+    '''
+    out = []
+    zero = bytes(block_size)
+    while data := f.read(block_size):
+        data = data.ljust(block_size, b'\0')
+        out.append(None if data == zero else table.lookup(block_hash(data)))
+    return out
+
+
+
+def order(cands):
+    ''' Pick one blkid per file block, preferring the one after the previous pick, then one the next block continues.
+    Returns [(file block, blkid, count)] runs, contiguous in both.
+    '''
+    picks = []
+    for i, blks in enumerate(cands):
+        prev = picks[-1] if picks else None
+        nxt = set(cands[i+1] or ()) if i+1 < len(cands) else set()
+        if not blks: pick = None # Not found, or a zero block
+        elif prev != None and prev+1 in blks: pick = prev+1
+        else: pick = next((b for b in blks if b+1 in nxt), blks[0])
+        picks.append(pick)
+    runs = []
+    for i, blkid in enumerate(picks):
+        if blkid == None: continue
+        if runs and runs[-1][0] + runs[-1][2] == i and runs[-1][1] + runs[-1][2] == blkid:
+            runs[-1][2] += 1
+        else:
+            runs.append([i, blkid, 1])
+    return [tuple(r) for r in runs]
@@ -0,0 +1,84 @@
+''' Hex dumps a row at a time.
+
+A row's hex is one `bytes.hex` call and its ASCII gutter one `bytes.translate`, so a dump costs a few calls per
+row instead of several per byte.  Runs of all-zero rows are collapsed into one line, like hexdump without -v,
+and each row gets a single style from what it holds.  The rows are written to the stream in batches rather than
+through Printer, whose markup handling costs more than a millisecond a row.
+'''
+import sys
+
+
+WIDTH = 32 # Bytes per row
+GROUP = 2 # Bytes per space-separated word
+ASCII = bytes(b if 32 < b < 127 else 32 for b in range(256))
+_UNPRINTABLE = bytes(b for b in range(256) if not 32 <= b < 127 and b not in b'\t\n\r')
+
+ZERO, TEXT, DATA = 'zero', 'text', 'data'
+STYLES = {ZERO:'\x1b[2m', TEXT:'\x1b[33m', DATA:''} # dim, yellow
+RESET = '\x1b[0m'
+
+
+
+def _split(chunks, offset, width):
+    ''' (offset, row) for rows of `width` bytes across the chunk boundaries '''
+    rest = b''
+    for chunk in chunks:
+        data = rest + chunk if rest else chunk
+        n = len(data) - len(data) % width
+        for i in range(0, n, width):
+            yield offset + i, data[i:i+width]
+        offset += n
+        rest = data[n:]
+    if rest: yield offset, rest
+
+
+
+def kind(row):
+    if row.count(0) == len(row): return ZERO
+    return TEXT if len(row.translate(None, _UNPRINTABLE)) * 4 >= len(row) * 3 else DATA
+
+
+
+def rows(chunks, offset=0, width=WIDTH, squeeze=True):
+    ''' Yield (offset, hex, ascii, kind) for each row of the bytes in `chunks`, which start at `offset`.
+    With `squeeze` the zero rows after the first of a run are yielded once as (offset, None, count of rows, ZERO).
+    '''
+    zero = bytes(width)
+    run, prev_zero = None, False
+    for pos, row in _split(chunks, offset, width):
+        if squeeze and row == zero:
+            if prev_zero:
+                if run == None: run = [pos, 0]
+                run[1] += 1
+                continue
+            prev_zero = True
+        else:
+            prev_zero = False
+        if run:
+            yield run[0], None, run[1], ZERO
+            run = None
+        yield pos, row.hex(' ', -GROUP), row.translate(ASCII).decode('ascii'), kind(row)
+    if run: yield run[0], None, run[1], ZERO
+
+
+
+def dump(chunks, offset=0, width=WIDTH, squeeze=True, out=None, color=None, batch=1024):
+    ''' Write a hex dump of `chunks` to `out` (stdout), offsets starting at `offset`.
+    The rows are styled with ANSI codes when `color`, which defaults to whether `out` is a terminal.
+    '''
+    out = out or sys.stdout
+    if color == None: color = getattr(out, 'isatty', lambda: False)()
+    dem, reset = (STYLES[ZERO], RESET) if color else ('', '')
+    pad = width*2 + width//GROUP - 1
+    lines = []
+    for pos, hex, ascii, k in rows(chunks, offset, width, squeeze):
+        if hex == None:
+            lines.append(f'{dem}{pos:08x}  *  {ascii} zero rows{reset}\n')
+        else:
+            style = STYLES[k] if color else ''
+            lines.append(f'{dem}{pos:08x}{reset}  {style}{hex:<{pad}}{reset if style else ""}  {dem}|{reset}{ascii:<{width}}{dem}|{reset}\n')
+        if len(lines) >= batch:
+            out.write(''.join(lines))
+            lines = []
+    out.write(''.join(lines))
+    out.flush()
@@ -0,0 +1,198 @@
+''' Score every inode slot in the image and keep the plausible ones in a table on disk.
+
+`scan` reads each group's inode bitmap and inode table with one pread (they are next to each other), several
+groups in flight and in physical order, and decodes and scores a whole table at a time with numpy.  The rows go
+to `<dir>/inodes.data` as they are produced, so memory doesn't grow with the image, and `InodeTable` then sorts
+an index per queryable column and opens it all with mmap.  The four time columns are indexed too, for `timeline`.
+'''
+import os, time
+from functools import reduce
+from . import stats
+from .inode import INode128, enums, flags
+from .mapfile import Unrecovered
+from .scan import pmap
+from .struct import pread
+
+
+COLUMNS = [('id','<u4'), ('mode','<u2'), ('links','<u2'), ('size','<u8'), ('blocks','<u4'), ('flags','<u4'), ('uid','<u4'), ('gid','<u4'),
+    ('atime','<u4'), ('ctime','<u4'), ('mtime','<u4'), ('dtime','<u4'), ('checks','u1'), ('score','u1'), ('used','u1')]
+INDEXED = ('size', 'mtime', 'ctime', 'atime', 'dtime')
+TIMES = ('mtime', 'ctime', 'atime', 'dtime')
+
+# What each bit of `checks` means.  `score` is how many of them passed.
+CHECKS = {
+    0x01:'ftype One of the seven file types',
+    0x02:'flags No unknown inode flags',
+    0x04:'blocks The block pointers are inside the filesystem (or an extent header, fast symlink or device number)',
+    0x08:'size The block count fits the size',
+    0x10:'times atime, ctime and mtime are between 1980 and the last write of the filesystem',
+    0x20:'dtime Not deleted, or deleted at a sane time',
+}
+EPOCH = 315532800 # 1980-01-01
+
+
+
+def _dtype(inode_size):
+    ''' INode128's fields with the stride of the filesystem's inodes '''
+    import numpy as np
+    dt = INode128.dtype()
+    return np.dtype(dict(names=dt.names, formats=[dt.fields[n][0] for n in dt.names], offsets=[dt.fields[n][1] for n in dt.names], itemsize=inode_size))
+
+
+
+def check(sb, recs, now=None):
+    ''' The `checks` bitmask of each decoded inode '''
+    import numpy as np
+    bs = sb.block_size
+    mode, size_lo, blocks_lo = recs['mode'].astype(np.uint32), recs['size_lo'].astype(np.uint64), recs['blocks_lo'].astype(np.uint64)
+    ftype = mode & 0xf000
+    size = size_lo | np.where(ftype == 0x8000, recs['size_high'].astype(np.uint64) << np.uint64(32), np.uint64(0))
+    block = recs['block']
+    checks = np.zeros(len(recs), dtype=np.uint8)
+    checks |= np.isin(ftype, list(enums['ftype'])).astype(np.uint8)
+    known = reduce(lambda a, b: a|b, flags['flags'])
+    checks |= ((recs['flags'] & ~np.uint32(known)) == 0).astype(np.uint8) << 1
+    special = np.isin(ftype, [0x1000, 0x2000, 0x6000, 0xC000]) | ((ftype == 0xA000) & (blocks_lo == 0)) | ((block[:, 0] & 0xffff) == 0xF30A)
+    inside = (block < sb.blocks_count_lo).all(axis=1) & ((block[:, 0] != 0) | (blocks_lo == 0))
+    checks |= (special | inside).astype(np.uint8) << 2
+    data = blocks_lo * np.uint64(512) // np.uint64(bs)
+    need = (size + np.uint64(bs - 1)) // np.uint64(bs)
+    fits = (data <= need + need // np.uint64(bs // 4) + np.uint64(3)) & ((size > 0) | (data == 0))
+    checks |= (fits | special).astype(np.uint8) << 3
+    hi = max(now or int(time.time()), sb.wtime) + 86400
+    sane = lambda t: (t >= EPOCH) & (t <= hi)
+    checks |= (sane(recs['atime']) & sane(recs['ctime']) & sane(recs['mtime'])).astype(np.uint8) << 4
+    checks |= ((recs['dtime'] == 0) | sane(recs['dtime'])).astype(np.uint8) << 5
+    return checks, size
+
+
+
+def _read_table(sb, bg):
+    ''' (bg, its inode bitmap and inode table bytes, or None if unreadable) '''
+    bgrp = sb.blkgrp(bg)
+    first = bg*sb.blocks_per_group + bgrp.bitmap_offset + 1
+    try:
+        return bg, pread(sb.stream, first*sb.block_size, (1 + bgrp.inode_block_count)*sb.block_size)
+    except Unrecovered:
+        return bg, None
+
+
+
+def scan(sb, dest, min_score=4, progress=None):
+    ''' Score every inode slot and write the rows of the non-empty ones with `min_score` or more to `dest`/inodes.data.
+    Returns (slots, rows, [groups that were unreadable])
+    '''
+    import numpy as np
+    os.makedirs(dest, exist_ok=True)
+    ipg, isz, bs = sb.inodes_per_group, sb.inode_size, sb.block_size
+    dt, cols = _dtype(isz), np.dtype(COLUMNS)
+    slots, rows, bad = 0, 0, []
+    now = int(time.time())
+    with open(os.path.join(dest, 'inodes.data'), 'wb') as out:
+        for bg, data in pmap(sb.pool, lambda bg: _read_table(sb, bg), range(sb.bg_count), sb.queue_depth):
+            if data == None:
+                bad.append(bg)
+                continue
+            with stats.timer('inode_table.score'):
+                used = np.unpackbits(np.frombuffer(data[:bs], dtype=np.uint8), bitorder='little')[:ipg]
+                table = np.frombuffer(data, dtype=np.uint8, offset=bs, count=min(ipg*isz, len(data)-bs) // isz * isz)
+                recs = table.view(dt)
+                keep = table.reshape(-1, isz).any(axis=1) # Never used slots are all zeros
+                recs, idx = recs[keep], np.flatnonzero(keep)
+                checks, size = check(sb, recs, now)
+                score = np.unpackbits(checks[:, None], axis=1).sum(axis=1, dtype=np.uint8)
+                good = score >= min_score
+                out_rows = np.empty(int(good.sum()), dtype=cols)
+                out_rows['id'] = bg*ipg + idx[good] + 1
+                for col, fld in (('mode','mode'), ('links','links_count'), ('blocks','blocks_lo'), ('flags','flags'), ('atime','atime'), ('ctime','ctime'), ('mtime','mtime'), ('dtime','dtime')):
+                    out_rows[col] = recs[fld][good]
+                out_rows['uid'] = recs['uid'][good] | recs['uid_high'][good].astype(np.uint32) << 16
+                out_rows['gid'] = recs['gid'][good] | recs['gid_high'][good].astype(np.uint32) << 16
+                out_rows['size'] = size[good]
+                out_rows['checks'] = checks[good]
+                out_rows['score'] = score[good]
+                out_rows['used'] = used[idx[good]]
+            out.write(out_rows.tobytes())
+            slots += len(table) // isz
+            rows += len(out_rows)
+            if progress: progress(bg, slots, rows)
+    if stats.enabled: stats.count('inode_table.slots', slots)
+    InodeTable(dest, rebuild=True)
+    return slots, rows, bad
+
+
+
+class InodeTable():
+    ''' The rows written by `scan`, memory-mapped, with a sorted index for each of the INDEXED columns '''
+    def __init__(self, dest, rebuild=False):
+        import numpy as np
+        self.dest = dest
+        self.rows = np.memmap(os.path.join(dest, 'inodes.data'), dtype=np.dtype(COLUMNS), mode='r') if os.path.getsize(os.path.join(dest, 'inodes.data')) else np.empty(0, dtype=np.dtype(COLUMNS))
+        self.index = {}
+        for col in INDEXED:
+            fname = os.path.join(dest, f'by_{col}.npy')
+            if rebuild or not os.path.exists(fname):
+                np.save(fname, np.argsort(self.rows[col], kind='stable').astype(np.uint32 if len(self.rows) < 1<<32 else np.uint64))
+            self.index[col] = np.load(fname, mmap_mode='r')
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def range(self, col, lo=None, hi=None):
+        ''' The row numbers with lo <= col <= hi, in `col` order (binary search on the sorted index) '''
+        import numpy as np
+        order = self.index[col]
+        vals = self.rows[col]
+        a = 0 if lo == None else _search(vals, order, lo, 'left')
+        b = len(order) if hi == None else _search(vals, order, hi, 'right')
+        return np.asarray(order[a:b])
+
+
+    def query(self, size=None, mtime=None, ftype=None, min_score=0, used=None):
+        ''' The row numbers matching all of the given (lo, hi) ranges, file type and score.
+        The narrowest indexed range is looked up first and the rest are filtered on its rows.
+        '''
+        import numpy as np
+        ranges = {col:r for col, r in (('size', size), ('mtime', mtime)) if r}
+        if ranges:
+            picks = {col:self.range(col, *r) for col, r in ranges.items()}
+            first = min(picks, key=lambda c: len(picks[c]))
+            sel = picks[first]
+        else:
+            first, sel = None, np.arange(len(self.rows))
+        rows = self.rows[sel]
+        keep = rows['score'] >= min_score
+        for col, (lo, hi) in ranges.items():
+            if col == first: continue
+            if lo != None: keep &= rows[col] >= lo
+            if hi != None: keep &= rows[col] <= hi
+        if ftype != None: keep &= (rows['mode'] & 0xf000) == ftype
+        if used != None: keep &= rows['used'] == used
+        return sel[keep]
+
+
+    def timeline(self, lo=None, hi=None, cols=TIMES):
+        ''' (times, row numbers, column numbers in `cols`) of every time in [lo, hi] of the `cols` time columns,
+        sorted by time.  A time of 0 is unset, so it never matches.
+        '''
+        import numpy as np
+        picks = [self.range(col, max(1, lo or 0), hi) for col in cols]
+        rows = np.concatenate(picks) if picks else np.empty(0, dtype=np.uint32)
+        which = np.concatenate([np.full(len(p), i, dtype=np.uint8) for i, p in enumerate(picks)]) if picks else np.empty(0, dtype=np.uint8)
+        times = np.concatenate([self.rows[col][p] for col, p in zip(cols, picks)]) if picks else np.empty(0, dtype=np.uint32)
+        order = np.argsort(times, kind='stable')
+        return times[order], rows[order], which[order]
+
+
+
+def _search(vals, order, v, side):
+    ''' searchsorted over vals[order] without materializing it '''
+    lo, hi = 0, len(order)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        x = vals[order[mid]]
+        if x < v or (side == 'right' and x == v): lo = mid + 1
+        else: hi = mid
+    return lo
@@ -0,0 +1,310 @@
+''' The jbd2 journal of ext3/ext4, as a source of old versions of metadata blocks.
+
+Every transaction writes a descriptor block listing the filesystem blocks it logs, a copy of each of those
+blocks, and a commit block.  The journal is circular, so long after a transaction was checkpointed its copies stay
+there until the log wraps over them: old directory blocks and inode table blocks that were since overwritten or
+zeroed can often still be found.
+
+`scan` reads the whole journal front to back once.  Descriptor blocks claim the blocks after them (wrapping to
+the first), commit blocks mark their transaction as complete, and revoke blocks are collected.  A claim is dropped
+when a newer transaction claimed the same journal block, or when it holds a journal header itself, because then
+the copy was written over.  The result is a `Journal` with, for every filesystem block, the transactions that
+logged it and where the copy is.  `at` makes a read-only view of the filesystem as of a transaction: each logged
+block reads from its latest copy up to then, everything else from the image.
+'''
+import io, struct, pickle
+from bisect import bisect_right
+from print_ext import PrettyException
+from . import stats
+from .struct import Struct
+from .stream import Remap, InodeStream
+
+
+MAGIC = 0xC03B3998
+DESCRIPTOR, COMMIT, SUPERBLOCK_V1, SUPERBLOCK_V2, REVOKE = 1, 2, 3, 4, 5
+HEADER = struct.Struct('>III') # magic, block type, sequence
+REVOKE_HEADER = struct.Struct('>IIII') # ... and the bytes used, including the header
+COMMIT_TIME = struct.Struct('>QI') # seconds and nanoseconds, at 0x30 of a commit block
+FLAG_ESCAPE, FLAG_SAME_UUID, FLAG_DELETED, FLAG_LAST_TAG = 1, 2, 4, 8
+
+
+
+class JournalSuperblock(Struct):
+    ''' The first block of the journal.  Unlike the rest of the filesystem it is big-endian. '''
+    size = 0x100
+    enums = {
+        'blocktype': {
+            3:'SUPERBLOCK_V1 Journal superblock, version 1.',
+            4:'SUPERBLOCK_V2 Journal superblock, version 2.',
+        },
+    }
+    flags = {
+        'feature_compat': {
+            0x1:'COMPAT_CHECKSUM Commit blocks have a checksum of the transaction.',
+        },
+        'feature_incompat': {
+            0x1:'INCOMPAT_REVOKE Has revoke blocks.',
+            0x2:'INCOMPAT_64BIT Block numbers are 64 bits.',
+            0x4:'INCOMPAT_ASYNC_COMMIT Commit blocks can be written before the data blocks.',
+            0x8:'INCOMPAT_CSUM_V2 Checksums, version 2.',
+            0x10:'INCOMPAT_CSUM_V3 Checksums, version 3.',
+            0x20:'INCOMPAT_FAST_COMMIT Has a fast commit area at the end.',
+        },
+    }
+    dfn = [
+        '>I magic 0xC03B3998.',
+        '>I blocktype 3 or 4.',
+        '>I sequence Unused in the superblock.',
+        '>I blocksize Journal block size in bytes.',
+        '>I maxlen Total number of blocks in the journal.',
+        '>I first First block of log information.',
+        '>I sequence_start First commit ID expected in the log.',
+        '>I start Block number of the start of the log, 0 when the journal is clean.',
+        '>I errno Error value, as set by jbd2_journal_abort().',
+        '>I feature_compat Compatible feature set.',
+        '>I feature_incompat Incompatible feature set.',
+        '>I feature_ro_compat Read-only compatible feature set.',
+        '16s uuid 128-bit uuid for the journal.',
+        '>I nr_users Number of filesystems sharing the journal.',
+        '>I dynsuper Location of the dynamic superblock copy (unused).',
+        '>I max_transaction Limit of journal blocks per transaction (unused).',
+        '>I max_trans_data Limit of data blocks per transaction (unused).',
+        'B checksum_type Checksum algorithm of the journal, 4 is crc32c.',
+        '3s padding Unused.',
+        '>I num_fc_blks Number of fast commit blocks at the end of the journal.',
+        '>I head Block number of the head of the log.',
+        '160s padding2 Unused.',
+        '>I checksum Checksum of the superblock.',
+    ]
+
+
+    @property
+    def tag_size(self):
+        ''' The bytes of a block tag in a descriptor block, without the uuid after it '''
+        incompat = self.feature_incompat
+        if incompat & self.INCOMPAT_CSUM_V3: return 16
+        size = 12 + (2 if incompat & self.INCOMPAT_CSUM_V2 else 0)
+        return size if incompat & self.INCOMPAT_64BIT else size - 4
+
+
+    @property
+    def tail_size(self):
+        ''' The checksum at the end of descriptor blocks (and revoke blocks) '''
+        return 4 if self.feature_incompat & (self.INCOMPAT_CSUM_V2 | self.INCOMPAT_CSUM_V3) else 0
+
+
+    @property
+    def last(self):
+        ''' One past the last block of the log '''
+        fc = (self.num_fc_blks or 256) if self.feature_incompat & self.INCOMPAT_FAST_COMMIT else 0
+        return self.maxlen - fc
+
+
+    def validate(self, all=False):
+        if self.magic != MAGIC:
+            self._errors.append(f"Bad magic {self.magic:#x}")
+            if not all: return self._errors
+        return super().validate(all=all)
+
+
+
+def journal_inode(sb):
+    ''' The journal's inode.  When it is broken, an inode made from the superblock's backup of its block map. '''
+    from .inode import INode128
+    if sb.feature_incompat & sb.INCOMPAT_JOURNAL_DEV: raise PrettyException(msg="The journal is on a separate device")
+    if not sb.feature_compat & sb.COMPAT_HAS_JOURNAL: raise PrettyException(msg="The filesystem has no journal")
+    inode = sb.inode(sb.journal_inum)
+    try:
+        if inode.ftype == inode.S_IFREG and inode.file_size and any(inode.block_map()): return inode
+    except ValueError:
+        pass
+    if sb.jnl_backup_type not in (0, 1) or not any(sb.jnl_blocks): raise PrettyException(msg=f"The journal inode {hex(sb.journal_inum)} is broken and there is no backup of it")
+    raw = bytearray(INode128.size)
+    blocks = sb.jnl_blocks
+    struct.pack_into('<H', raw, INode128.flds['mode'][0], inode.S_IFREG | 0o600)
+    struct.pack_into('<I', raw, INode128.flds['size_lo'][0], blocks[16])
+    struct.pack_into('<I', raw, INode128.flds['size_high'][0], blocks[15])
+    struct.pack_into('<15I', raw, INode128.flds['block'][0], *blocks[:15])
+    return INode128(io.BytesIO(bytes(raw)), 0, id=sb.journal_inum, sb=sb, bg=inode.bg, is_free=False)
+
+
+
+class Journal():
+    ''' What `scan` found in a journal.
+
+    `versions` maps a filesystem blkid to [(transaction, journal block, escaped)] in transaction order, and
+    `revokes` a blkid to the transactions that revoked it.  `blocks` is the filesystem blkid of each journal block
+    and `txns` maps each committed transaction to (journal block of its commit, commit time or None, blocks logged).
+    '''
+    def __init__(self, block_size, blocks, first, last, start, sequence):
+        self.block_size = block_size
+        self.blocks = blocks
+        self.first, self.last, self.start, self.sequence = first, last, start, sequence
+        self.txns = {}
+        self.versions = {}
+        self.revokes = {}
+        self.uncommitted = set()
+
+
+    def save(self, fname):
+        with open(fname, 'wb') as f:
+            pickle.dump(self, f)
+
+
+    @staticmethod
+    def load(fname):
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+
+
+    def version(self, blkid, txn):
+        ''' The (transaction, journal block, escaped) holding `blkid` as of `txn`, or None for the image's.  A
+        revoke between the copy's transaction and `txn` means the block was no longer metadata, so there is none.
+        '''
+        vers = self.versions.get(blkid)
+        if not vers: return None
+        i = bisect_right(vers, (txn, 1<<64, True)) - 1
+        if i < 0: return None
+        if any(vers[i][0] <= r <= txn for r in self.revokes.get(blkid, ())): return None
+        return vers[i]
+
+
+
+def _tags(block, jsb, incompat):
+    ''' (blkid, flags) for the tags of a descriptor block '''
+    size, is64 = jsb.tag_size, incompat & jsb.INCOMPAT_64BIT
+    csum3 = incompat & jsb.INCOMPAT_CSUM_V3
+    pos, end = HEADER.size, len(block) - jsb.tail_size
+    while pos + size <= end:
+        if csum3:
+            lo, flags, hi = struct.unpack_from('>III', block, pos)
+        else:
+            lo, _, flags = struct.unpack_from('>IHH', block, pos)
+            hi = struct.unpack_from('>I', block, pos + 8)[0] if is64 else 0
+        yield lo | (hi << 32 if is64 else 0), flags
+        pos += size + (0 if flags & FLAG_SAME_UUID else 16)
+        if flags & FLAG_LAST_TAG: break
+
+
+
+def _revoked(block, is64):
+    _, _, _, count = REVOKE_HEADER.unpack_from(block)
+    fmt = '>Q' if is64 else '>I'
+    step = struct.calcsize(fmt)
+    return [struct.unpack_from(fmt, block, pos)[0] for pos in range(REVOKE_HEADER.size, min(count, len(block)) - step + 1, step)]
+
+
+
+def scan(sb, progress=None, window=256):
+    ''' Read the whole journal of `sb` once, `window` blocks at a time, into a `Journal` '''
+    inode = journal_inode(sb)
+    stream = InodeStream(sb, inode, err_ok=True)
+    jsb = JournalSuperblock(stream, 0)
+    if jsb.validate(): raise PrettyException(msg=f"Bad journal superblock: {' '.join(jsb._errors)}")
+    bs = jsb.blocksize
+    if bs != sb.block_size: raise PrettyException(msg=f"The journal's block size {bs} isn't the filesystem's {sb.block_size}")
+    blocks = [0] * jsb.maxlen
+    for idx, blkid in inode.block_map(err_ok=True):
+        if idx < len(blocks): blocks[idx] = blkid
+    first, last = jsb.first, jsb.last
+    jnl = Journal(bs, blocks, first, last, jsb.start, jsb.sequence_start)
+    incompat = jsb.feature_incompat
+    is64 = incompat & jsb.INCOMPAT_64BIT
+    claims = {} # journal block -> (transaction, blkid, escaped)
+    headers = set()
+    seen = set()
+    for w in range(first, last, window):
+        n = min(window, last - w)
+        data = memoryview(stream.pread(n*bs, w*bs))
+        for i in range(n):
+            block = data[i*bs:(i+1)*bs]
+            magic, btype, seq = HEADER.unpack_from(block)
+            if magic != MAGIC: continue
+            jblk = w + i
+            headers.add(jblk)
+            if btype == DESCRIPTOR:
+                seen.add(seq)
+                pos = jblk
+                for blkid, flags in _tags(block, jsb, incompat):
+                    pos = pos + 1 if pos + 1 < last else first
+                    if pos not in claims or claims[pos][0] < seq: claims[pos] = (seq, blkid, bool(flags & FLAG_ESCAPE))
+            elif btype == COMMIT:
+                sec, nsec = COMMIT_TIME.unpack_from(block, 0x30)
+                jnl.txns[seq] = (jblk, sec + nsec / 1e9 if 0 < sec < 1<<34 and nsec < 10**9 else None, 0)
+            elif btype == REVOKE:
+                seen.add(seq)
+                for blkid in _revoked(block, is64): jnl.revokes.setdefault(blkid, []).append(seq)
+        if progress: progress(w + n - first, last - first)
+    for jblk, (seq, blkid, escaped) in claims.items():
+        if jblk in headers or seq not in jnl.txns: continue
+        jnl.versions.setdefault(blkid, []).append((seq, jblk, escaped))
+        commit, when, count = jnl.txns[seq]
+        jnl.txns[seq] = (commit, when, count + 1)
+    for vers in jnl.versions.values(): vers.sort()
+    for revs in jnl.revokes.values(): revs.sort()
+    jnl.uncommitted = seen - jnl.txns.keys()
+    if stats.enabled: stats.count('journal.blocks', last - first)
+    return jnl
+
+
+
+class TxnStream(Remap):
+    ''' The filesystem as of transaction `txn` of `jnl`: its logged blocks read from their copies in the journal.
+    Read-only.
+    '''
+    def __init__(self, stream, jnl, txn, size):
+        bs = jnl.block_size
+        extents, self.escaped, pos = [], [], 0
+        for blkid in sorted(jnl.versions):
+            v = jnl.version(blkid, txn)
+            if v == None or blkid*bs >= size: continue
+            if pos < blkid*bs: extents.append((pos, blkid*bs - pos, pos))
+            extents.append((blkid*bs, bs, jnl.blocks[v[1]]*bs))
+            if v[2]: self.escaped.append(blkid*bs)
+            pos = (blkid + 1)*bs
+        if pos < size: extents.append((pos, size - pos, pos))
+        super().__init__(stream, extents, size)
+        self.jnl, self.txn = jnl, txn
+        self.logged = len(extents) - sum(1 for e in extents if e[0] == e[2])
+
+
+    def pread(self, size, offset):
+        data = super().pread(size, offset)
+        i = bisect_right(self.escaped, offset - 4)
+        if i >= len(self.escaped) or self.escaped[i] >= offset + len(data): return data
+        data = bytearray(data)
+        magic = struct.pack('>I', MAGIC)
+        for start in self.escaped[i:]:
+            if start >= offset + len(data): break
+            a, b = max(start, offset), min(start + 4, offset + len(data))
+            data[a - offset:b - offset] = magic[a - start:b - start]
+        return bytes(data)
+
+
+    def direct(self, offset, size):
+        ''' Like Remap's, but the escaped copies have to be read through this stream '''
+        pos = offset
+        for n, below, off in super().direct(offset, size):
+            i = bisect_right(self.escaped, pos - 4)
+            if below != None and i < len(self.escaped) and self.escaped[i] < pos + n: yield n, None, pos
+            else: yield n, below, off
+            pos += n
+
+
+    def writable(self):
+        return False
+
+
+    def write(self, data):
+        raise OSError(30, f'Transaction {self.txn} of the journal is read-only')
+
+
+
+def at(sb, jnl, txn):
+    ''' A Superblock for the filesystem of `sb` as of transaction `txn` of the Journal `jnl` '''
+    from .superblock import Superblock
+    if txn not in jnl.txns:
+        if not jnl.txns: raise PrettyException(msg="The journal has no committed transactions")
+        raise PrettyException(msg=f"No committed transaction {txn} in the journal, they are {min(jnl.txns)}-{max(jnl.txns)}")
+    stream = TxnStream(sb.stream, jnl, txn, sb.blocks_count_lo * sb.block_size)
+    return Superblock(stream, sb.offset, inode_cache=sb.inode_cache, queue_depth=sb.queue_depth)
@@ -0,0 +1,164 @@
+''' ddrescue mapfiles: which parts of a partial image were never recovered.
+
+`Mapped` sits in front of the image and refuses reads that touch an unrecovered range with `Unrecovered`,
+instead of handing back the zeros ddrescue left there (or, on a live disk, stalling on the bad sectors).
+'''
+import io
+from bisect import bisect_right
+from print_ext import PrettyException
+from . import stats
+from .struct import pread
+
+
+STATUS = {'?':'non-tried', '*':'non-trimmed', '/':'non-scraped', '-':'bad-sector', '+':'finished'}
+
+
+
+class Unrecovered(PrettyException):
+    ''' A read touched a range that ddrescue never recovered '''
+    def __init__(self, offset, size, bad):
+        super().__init__(msg=f"Unrecovered: reading {size} bytes at {offset} hits [{bad[0]}, {bad[1]}) of the mapfile")
+        self.offset = offset
+        self.size = size
+        self.bad = bad
+
+
+
+class Mapfile():
+    ''' The unrecovered ranges of a ddrescue mapfile as sorted, merged [start, end) intervals '''
+    def __init__(self, fname):
+        self.fname = fname
+        self.starts, self.ends = [], []
+        self.bad_bytes = 0
+        status_line = True
+        with open(fname) as f:
+            for line in f:
+                line = line.split('#', 1)[0].split()
+                if not line: continue
+                if status_line: # current_pos current_status [current_pass]
+                    status_line = False
+                    continue
+                pos, size, status = int(line[0], 0), int(line[1], 0), line[2]
+                if status == '+' or not size: continue
+                self.bad_bytes += size
+                if self.ends and self.ends[-1] >= pos:
+                    self.ends[-1] = max(self.ends[-1], pos + size)
+                else:
+                    self.starts.append(pos)
+                    self.ends.append(pos + size)
+
+
+    def bad(self, offset, size):
+        ''' The first unrecovered (start, end) overlapping [offset, offset+size), or None '''
+        i = bisect_right(self.ends, offset) # The first interval ending after offset
+        if i < len(self.starts) and self.starts[i] < offset + size: return self.starts[i], self.ends[i]
+        return None
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+
+class Mapped(io.RawIOBase):
+    ''' A stream that knows which of its ranges are unrecovered.
+
+    With `strict` a read that touches one raises `Unrecovered` without reading anything.  Without it the
+    unrecovered parts read as zeros (also without touching the disk): use that below a BlockCache, whose
+    pages can straddle a good and a bad range.
+    '''
+    def __init__(self, stream, mapfile, strict=True):
+        self.stream = stream
+        self.mapfile = mapfile
+        self.strict = strict
+        self.pos = 0
+
+
+    def readable(self): return True
+    def seekable(self): return True
+    def writable(self): return self.stream.writable()
+
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR: offset += self.pos
+        elif whence == io.SEEK_END: offset += self.stream.seek(0, io.SEEK_END)
+        if offset < 0: raise OSError(22, 'Invalid argument')
+        self.pos = offset
+        return self.pos
+
+
+    def tell(self):
+        return self.pos
+
+
+    def unreadable(self, offset, size):
+        return self.mapfile.bad(offset, size) != None
+
+
+    def pread(self, size, offset):
+        bad = self.mapfile.bad(offset, size)
+        if bad == None: return pread(self.stream, offset, size)
+        if stats.enabled: stats.count('mapfile.refused')
+        if self.strict: raise Unrecovered(offset, size, bad)
+        parts, pos, end = [], offset, offset + size
+        while pos < end:
+            bad = self.mapfile.bad(pos, end - pos)
+            good_end = end if bad == None else max(pos, bad[0])
+            if good_end > pos:
+                data = pread(self.stream, pos, good_end - pos)
+                parts.append(data)
+                if len(data) < good_end - pos: break # EOF
+            if bad == None: break
+            parts.append(bytes(min(end, bad[1]) - good_end))
+            pos = bad[1]
+        return b''.join(parts)
+
+
+    def direct(self, offset, size):
+        ''' The recovered pieces of [offset, offset+size) pass through to the stream below, the unrecovered ones don't '''
+        pos, end = offset, offset + size
+        while pos < end:
+            bad = self.mapfile.bad(pos, end - pos)
+            good_end = end if bad == None else max(pos, bad[0])
+            if good_end > pos: yield good_end - pos, self.stream, pos
+            if bad == None: break
+            bad_end = min(end, bad[1])
+            yield bad_end - good_end, None, good_end
+            pos = bad_end
+
+
+    def prefetch(self, offset, size):
+        if hasattr(self.stream, 'prefetch') and not self.unreadable(offset, size): self.stream.prefetch(offset, size)
+
+
+    def read(self, size=-1):
+        if size < 0: size = self.stream.seek(0, io.SEEK_END) - self.pos
+        data = self.pread(size, self.pos)
+        self.pos += len(data)
+        return data
+
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+    def write(self, data):
+        self.stream.seek(self.pos)
+        n = self.stream.write(data)
+        self.pos += n
+        return n
+
+
+    def flush(self):
+        if self.stream.writable(): self.stream.flush()
+
+
+    def invalidate(self, offset=0, size=None):
+        if hasattr(self.stream, 'invalidate'): self.stream.invalidate(offset, size)
+
+
+    # So `scan` sizes its windows to the cache below
+    page = property(lambda self: getattr(self.stream, 'page', 0))
+    max_pages = property(lambda self: getattr(self.stream, 'max_pages', 0))
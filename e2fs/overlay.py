@@ -0,0 +1,252 @@
+''' A copy-on-write overlay, so repairs can be tried without touching (or copying) the image.
+
+Writes are kept in a patch file next to the image, a page at a time:
+
+    header   b'e2fsovl1' <page size: u32>
+    record   <page number: u64> <batch: u32> <page of data>
+    commit   <COMMIT: u64> <batch: u32>
+
+The records after the last commit are the pending batch.  Reads see the pending and committed pages over the
+image.  `commit` closes the batch with one record and `rollback` truncates it away.  `export` compacts the
+committed pages into a new patch file sorted by page, which `apply` writes into an image front to back.
+'''
+import io, os, struct, threading
+from print_ext import PrettyException
+from . import stats
+from .struct import pread
+
+
+MAGIC = b'e2fsovl1'
+HEADER = struct.Struct('<8sI')
+RECORD = struct.Struct('<QI')
+COMMIT = (1<<64) - 1
+
+
+
+def load(f, fname):
+    ''' Index a patch file.  Returns (page size, committed, pending, [(batch, pages)], end of the last whole record)
+    where committed and pending map page numbers to the offset of their data.
+    '''
+    magic, page = HEADER.unpack(pread(f, 0, HEADER.size).ljust(HEADER.size, b'\0'))
+    if magic != MAGIC: raise PrettyException(msg=f"{fname} is not an overlay patch file")
+    committed, pending, batches = {}, {}, []
+    end = pos = HEADER.size
+    total = os.fstat(f.fileno()).st_size
+    while pos + RECORD.size <= total:
+        n, batch = RECORD.unpack(pread(f, pos, RECORD.size))
+        if n == COMMIT:
+            committed.update(pending)
+            batches.append((batch, len(pending)))
+            pending = {}
+            pos += RECORD.size
+        elif pos + RECORD.size + page <= total:
+            pending[n] = pos + RECORD.size
+            pos += RECORD.size + page
+        else:
+            break
+        end = pos
+    return page, committed, pending, batches, end
+
+
+
+class Overlay(io.RawIOBase):
+    ''' `stream` with the pages of the patch file `fname` laid over it.  Writes only go to the patch file. '''
+    def __init__(self, stream, fname, page=4096):
+        self.stream = stream
+        self.fname = fname
+        self.pos = 0
+        self.size = stream.seek(0, io.SEEK_END)
+        self.lock = threading.RLock()
+        self.committed = {} # page number -> offset of its data in the patch file
+        self.pending = {}
+        self.batches = [] # [(batch, pages)] committed
+        new = not os.path.exists(fname) or not os.path.getsize(fname)
+        self.f = open(fname, 'w+b' if new else 'r+b')
+        if new:
+            self.page_size = page
+            self.f.write(HEADER.pack(MAGIC, page))
+            self.f.flush()
+            self.end = self.f.tell()
+        else:
+            self.page_size, self.committed, self.pending, self.batches, self.end = load(self.f, fname)
+            if self.end < os.path.getsize(fname): # A record cut short by a crash
+                self.f.truncate(self.end)
+
+
+    @property
+    def batch(self):
+        ''' The number of the pending batch '''
+        return self.batches[-1][0] + 1 if self.batches else 1
+
+
+    def readable(self): return True
+    def seekable(self): return True
+    def writable(self): return True
+
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR: offset += self.pos
+        elif whence == io.SEEK_END: offset += self.size
+        if offset < 0: raise OSError(22, 'Invalid argument')
+        self.pos = offset
+        return self.pos
+
+
+    def tell(self):
+        return self.pos
+
+
+    def lookup(self, n):
+        ''' Where the data of page `n` is in the patch file, or None if it comes from the image '''
+        off = self.pending.get(n)
+        return self.committed.get(n) if off == None else off
+
+
+    def pread(self, size, offset):
+        if not self.pending and not self.committed: return pread(self.stream, offset, size)
+        end = min(offset + size, self.size)
+        parts, pos = [], offset
+        while pos < end:
+            n = pos // self.page_size
+            off = self.lookup(n)
+            if off == None: # Read the run of pages that aren't overlaid with one pread
+                n += 1
+                while n*self.page_size < end and self.lookup(n) == None: n += 1
+                k = min(end, n*self.page_size) - pos
+                parts.append(pread(self.stream, pos, k))
+            else:
+                k = min(end, (n+1)*self.page_size) - pos
+                if stats.enabled: stats.count('overlay.reads')
+                parts.append(pread(self.f, off + pos - n*self.page_size, k))
+            pos += k
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+
+    def direct(self, offset, size):
+        ''' The runs of pages that come from the image, and the overlaid ones (None), see `e2fs.struct.direct` '''
+        end = min(offset + size, self.size)
+        pos = offset
+        while pos < end:
+            n = pos // self.page_size
+            overlaid = self.lookup(n) != None
+            n += 1
+            while n*self.page_size < end and (self.lookup(n) != None) == overlaid: n += 1
+            k = min(end, n*self.page_size) - pos
+            yield k, None if overlaid else self.stream, pos
+            pos += k
+
+
+    def read(self, size=-1):
+        if size < 0: size = self.size - self.pos
+        data = self.pread(size, self.pos)
+        self.pos += len(data)
+        return data
+
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+    def prefetch(self, offset, size):
+        if hasattr(self.stream, 'prefetch'): self.stream.prefetch(offset, size)
+
+
+    def unreadable(self, offset, size):
+        return hasattr(self.stream, 'unreadable') and self.stream.unreadable(offset, size)
+
+
+    def invalidate(self, offset=0, size=None):
+        if hasattr(self.stream, 'invalidate'): self.stream.invalidate(offset, size)
+
+
+    # So `scan` sizes its windows to the cache below
+    page = property(lambda self: getattr(self.stream, 'page', 0))
+    max_pages = property(lambda self: getattr(self.stream, 'max_pages', 0))
+
+
+    def write(self, data):
+        ''' Copy the touched pages into the pending batch and change them there '''
+        if self.pos + len(data) > self.size: raise OSError(28, 'No space left on device')
+        with self.lock:
+            done = 0
+            while done < len(data):
+                n, start = divmod(self.pos + done, self.page_size)
+                k = min(len(data) - done, self.page_size - start)
+                if k == self.page_size:
+                    page = data[done:done+k]
+                else:
+                    page = bytearray(self.pread(self.page_size, n*self.page_size).ljust(self.page_size, b'\0'))
+                    page[start:start+k] = data[done:done+k]
+                off = self.pending.get(n)
+                if off == None: # First change to this page in the batch
+                    self.f.seek(self.end)
+                    self.f.write(RECORD.pack(n, self.batch))
+                    off = self.pending[n] = self.end + RECORD.size
+                    self.end = off + self.page_size
+                self.f.seek(off)
+                self.f.write(page)
+                done += k
+            self.f.flush() # pread goes around the file's buffer
+            self.pos += done
+            return done
+
+
+    def flush(self):
+        self.f.flush()
+
+
+    def commit(self):
+        ''' Close the pending batch.  Returns (batch, pages), or None if nothing is pending '''
+        with self.lock:
+            if not self.pending: return None
+            batch = (self.batch, len(self.pending))
+            self.f.seek(self.end)
+            self.f.write(RECORD.pack(COMMIT, batch[0]))
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.end += RECORD.size
+            self.committed.update(self.pending)
+            self.batches.append(batch)
+            self.pending = {}
+            return batch
+
+
+    def rollback(self):
+        ''' Throw away the pending batch.  Returns the page numbers it had '''
+        with self.lock:
+            pages = sorted(self.pending)
+            if pages:
+                self.end = min(self.pending.values()) - RECORD.size
+                self.f.truncate(self.end)
+                self.pending = {}
+            return pages
+
+
+    def export(self, fname):
+        ''' Write the committed pages, in page order, as a patch file with a single batch '''
+        with open(fname, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, self.page_size))
+            for n in sorted(self.committed):
+                out.write(RECORD.pack(n, 1))
+                out.write(pread(self.f, self.committed[n], self.page_size))
+            out.write(RECORD.pack(COMMIT, 1))
+        return len(self.committed)
+
+
+
+def apply(fname, stream):
+    ''' Write the committed pages of a patch file into `stream` (an image, or an Overlay) in one pass, in page order.
+    Returns the (page size, [page numbers]) written.
+    '''
+    with open(fname, 'rb') as f:
+        page, committed, pending, _, _ = load(f, fname)
+        if pending: raise PrettyException(msg=f"{fname} has {len(pending)} uncommitted pages, commit or roll them back first")
+        size = stream.seek(0, io.SEEK_END)
+        pages = sorted(committed)
+        for n in pages:
+            stream.seek(n*page)
+            stream.write(pread(f, committed[n], page)[:max(0, size - n*page)])
+        stream.flush()
+        return page, pages
@@ -0,0 +1,64 @@
+''' Machine readable output for the listing commands.
+
+`Records` writes one record per line as JSON (jsonl) or tab separated values with a header (tsv), straight to a
+large buffer on stdout's file descriptor.  There is no markup to parse or style, so a long listing costs about
+what its bytes do, and the output goes to jq, sort or a database import as is.
+'''
+import sys, json
+from print_ext import PrettyException
+
+
+FORMATS = ('text', 'jsonl', 'tsv')
+_TSV = str.maketrans({'\t':'\\t', '\n':'\\n', '\r':'\\r', '\\':'\\\\'})
+
+
+
+def check(fmt):
+    if fmt not in FORMATS: raise PrettyException(msg=f"Unknown format {fmt!r}, one of {' '.join(FORMATS)}")
+    return fmt
+
+
+
+def _tsv(v):
+    if v == None: return ''
+    if isinstance(v, (list, tuple)): return ','.join(_tsv(x) for x in v)
+    if isinstance(v, bool): return '1' if v else '0'
+    return str(v).translate(_TSV)
+
+
+
+class Records():
+    ''' A sink for records with the given `fields`, in format `fmt` (jsonl or tsv).  Use it as a context manager. '''
+    def __init__(self, fmt, fields, out=None, buffering=1<<20):
+        self.fmt = check(fmt)
+        self.fields = fields
+        self.count = 0
+        sys.stdout.flush() # Anything already printed goes first
+        if out == None and sys.stdout is not sys.__stdout__: out = sys.stdout # Redirected, e.g. to a daemon client
+        self.own = out == None
+        self.out = out or open(sys.stdout.fileno(), 'w', buffering=buffering, encoding='utf8', errors='surrogateescape', closefd=False)
+        if fmt == 'tsv': self.out.write('\t'.join(fields) + '\n')
+
+
+    def __call__(self, **rec):
+        self.count += 1
+        if self.fmt == 'jsonl':
+            self.out.write(json.dumps({k:rec.get(k) for k in self.fields}, separators=(',', ':')) + '\n')
+        else:
+            self.out.write('\t'.join(_tsv(rec.get(k)) for k in self.fields) + '\n')
+
+
+    def close(self):
+        if self.own: self.out.close()
+        else: self.out.flush()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        try:
+            self.close()
+        except BrokenPipeError: # e.g. piped into head
+            pass
@@ -0,0 +1,85 @@
+''' Visit a collection of blocks in physical order, reading them in a few large windows instead of one seek each. '''
+from itertools import islice
+from .struct import pread
+
+
+def readable(sb, blkids, skipped=None):
+    ''' Drop the blocks that the stream says are unreadable (see `e2fs.mapfile`), appending them to `skipped`.
+    A collection gives a list, an iterator gives an iterator.
+    '''
+    check = getattr(sb.stream, 'unreadable', None)
+    if not check: return blkids
+    bs = sb.block_size
+    def _good():
+        for blkid in blkids:
+            if not check(blkid*bs, bs): yield blkid
+            elif skipped != None: skipped.append(blkid)
+    return list(_good()) if hasattr(blkids, '__len__') else _good()
+
+
+def windows(blkids, max_blocks=1024, gap=16, chunk=1<<20):
+    ''' Sort `blkids` and group them into windows.
+    Blocks less than `gap` apart share a window (reading the gap is cheaper than a seek), and no window covers more than `max_blocks`.
+    A collection (set, list) is in memory already and is sorted whole.  An iterator is sorted `chunk` blkids at
+    a time, so memory stays bounded: one that comes in order (e.g. `Bitmap.each_false()`) gives one ascending pass.
+    Yields (first blkid, number of blocks covered, [blkids in the window])
+    '''
+    if hasattr(blkids, '__len__'):
+        parts = [sorted(set(blkids))]
+    else:
+        it = iter(blkids)
+        parts = iter(lambda: sorted(set(islice(it, chunk))), [])
+    run = []
+    for part in parts:
+        for blkid in part:
+            if run and blkid == run[-1]: continue # Repeated at the end of the previous chunk
+            if run and (blkid < run[-1] or blkid - run[-1] > gap or blkid - run[0] >= max_blocks):
+                yield run[0], run[-1] - run[0] + 1, run
+                run = []
+            run.append(blkid)
+    if run: yield run[0], run[-1] - run[0] + 1, run
+
+
+def _max_blocks(sb, window):
+    # Prefetched pages have to survive in the cache until the window has been parsed
+    limit = getattr(sb.stream, 'max_pages', 0) * getattr(sb.stream, 'page', 0) // 4
+    return max(1, min(window, limit or window) // sb.block_size)
+
+
+def ordered(sb, blkids, window=4<<20, gap=16, skipped=None):
+    ''' Yield `blkids` in physical order.  When the image is behind a BlockCache each window is prefetched
+    with one read first, so parsing the blocks (DirectoryBlk etc.) is served from memory.
+    Unreadable blocks are left out and appended to `skipped`.
+    '''
+    prefetch = getattr(sb.stream, 'prefetch', None)
+    for first, count, run in windows(readable(sb, blkids, skipped), _max_blocks(sb, window), gap):
+        if prefetch: prefetch(first*sb.block_size, count*sb.block_size)
+        yield from run
+
+
+def blocks(sb, blkids, window=4<<20, gap=16, skipped=None):
+    ''' Yield (blkid, data) in physical order, reading each window with one pread.
+    Unreadable blocks are left out and appended to `skipped`.
+    '''
+    check = getattr(sb.stream, 'unreadable', None)
+    for first, count, run in windows(readable(sb, blkids, skipped), max(1, window // sb.block_size), gap):
+        if check and check(first*sb.block_size, count*sb.block_size):
+            # The gaps between the blocks are unreadable: read them one at a time
+            for blkid in run:
+                yield blkid, memoryview(pread(sb.stream, blkid*sb.block_size, sb.block_size))
+            continue
+        data = memoryview(pread(sb.stream, first*sb.block_size, count*sb.block_size))
+        for blkid in run:
+            off = (blkid - first) * sb.block_size
+            yield blkid, data[off:off+sb.block_size]
+
+
+def pmap(pool, fn, items, depth=32):
+    ''' Like `pool.map(fn, items)`, but with at most `depth` calls in flight, so a long `items` doesn't pile up results '''
+    from collections import deque
+    inflight = deque()
+    for item in items:
+        inflight.append(pool.submit(fn, item))
+        if len(inflight) >= depth: yield inflight.popleft().result()
+    while inflight:
+        yield inflight.popleft().result()
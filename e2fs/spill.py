@@ -0,0 +1,102 @@
+''' Sets of ints too big for memory, kept as sorted runs on disk.
+
+`Runs` buffers what is added, up to a memory ceiling, then sorts the buffer and writes it out as a run of
+uint64.  `close` merges the runs (k-way, reading each a chunk at a time) into one sorted file without
+duplicates, which `SortedFile` streams back, e.g. for build_file_list to visit analyze's directory blocks in
+physical order.
+'''
+import os, heapq
+from array import array
+from . import stats
+
+
+ITEM = 8 # bytes per int on disk
+
+
+
+class Runs():
+    ''' Add ints in any order, with at most `memory` bytes of them buffered at a time.
+    The sorted, de-duplicated result goes to `fname`.
+    '''
+    def __init__(self, fname, memory=256<<20):
+        self.fname = fname
+        self.limit = max(1024, memory // ITEM)
+        self.buf = array('Q')
+        self.runs = []
+
+
+    def add(self, ids):
+        self.buf.extend(ids)
+        if len(self.buf) >= self.limit: self._flush()
+
+
+    def _flush(self):
+        import numpy as np
+        if not self.buf: return
+        with stats.timer('spill.sort'):
+            run = np.unique(np.frombuffer(self.buf, dtype=np.uint64))
+        fname = f'{self.fname}.run{len(self.runs)}'
+        run.tofile(fname)
+        if stats.enabled: stats.count('spill.runs')
+        self.runs.append(fname)
+        self.buf = array('Q')
+
+
+    def close(self):
+        ''' Merge the runs into `fname` and remove them.  Returns the SortedFile '''
+        if not self.runs: # It all fit, so no merge
+            import numpy as np
+            np.unique(np.frombuffer(self.buf, dtype=np.uint64)).tofile(self.fname)
+            self.buf = array('Q')
+            return SortedFile(self.fname)
+        self._flush()
+        chunk = max(1024, self.limit // (len(self.runs) + 1))
+        with open(self.fname + '.tmp', 'wb') as out, stats.timer('spill.merge'):
+            buf = array('Q')
+            for v in unique(heapq.merge(*(SortedFile(r).iter(chunk) for r in self.runs))):
+                buf.append(v)
+                if len(buf) >= chunk:
+                    buf.tofile(out)
+                    buf = array('Q')
+            buf.tofile(out)
+        os.replace(self.fname + '.tmp', self.fname)
+        for r in self.runs: os.remove(r)
+        self.runs = []
+        return SortedFile(self.fname)
+
+
+
+class SortedFile():
+    ''' A file of sorted, distinct uint64 written by `Runs` '''
+    def __init__(self, fname):
+        self.fname = fname
+
+
+    def __len__(self):
+        return os.path.getsize(self.fname) // ITEM
+
+
+    def iter(self, chunk=1<<20):
+        ''' The ints in order, reading `chunk` of them at a time '''
+        with open(self.fname, 'rb') as f:
+            while True:
+                buf = array('Q')
+                try:
+                    buf.fromfile(f, chunk)
+                except EOFError: # The last, short chunk is still read into buf
+                    yield from buf
+                    return
+                yield from buf
+
+
+    def __iter__(self):
+        return self.iter()
+
+
+
+def unique(it):
+    ''' Drop the repeats from a sorted iterator '''
+    last = None
+    for v in it:
+        if v != last: yield v
+        last = v
@@ -0,0 +1,92 @@
+''' Counters for the shared read path and timers for the main subsystems.
+
+Nothing is recorded until `enable()` is called, so the hot paths only pay for one flag test.
+'''
+import time, json
+from contextlib import contextmanager
+from print_ext import Table
+
+
+enabled = False
+counters = {}
+timers = {}
+_last_end = {} # id(stream) -> offset just past the last read
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+    counters.clear()
+    timers.clear()
+    _last_end.clear()
+
+
+def count(name, n=1):
+    counters[name] = counters.get(name, 0) + n
+
+
+def add_time(name, dt):
+    calls, total = timers.get(name, (0, 0.0))
+    timers[name] = (calls+1, total+dt)
+
+
+def io(name, stream, offset, size, dt):
+    ''' Record one read of `size` bytes at `offset` that took `dt` seconds '''
+    count(f'{name}.calls')
+    count(f'{name}.bytes', size)
+    last = _last_end.get(id(stream))
+    if last != offset:
+        count(f'{name}.seeks')
+        if last != None: count(f'{name}.seek_distance', abs(offset - last))
+    _last_end[id(stream)] = offset + size
+    add_time(name, dt)
+
+
+@contextmanager
+def timer(name):
+    if not enabled:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - t0)
+
+
+def timed_iter(name, it):
+    ''' Wrap an iterator so only the time spent producing each item is charged to `name` '''
+    it = iter(it)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            v = next(it)
+        except StopIteration:
+            add_time(name, time.perf_counter() - t0)
+            return
+        add_time(name, time.perf_counter() - t0)
+        count(f'{name}.items')
+        yield v
+
+
+def report():
+    return {
+        'counters': dict(sorted(counters.items())),
+        'timers': {k: {'calls':calls, 'seconds':total} for k, (calls, total) in sorted(timers.items())},
+    }
+
+
+def save(fname):
+    with open(fname, 'w') as f:
+        json.dump(report(), f, indent=2)
+
+
+def summary(print):
+    tbl = Table(1,1,1, tmpl='pad')
+    tbl.cell('C0', style='1', just='>')
+    tbl.cell('C1', just='>')
+    for name, (calls, total) in sorted(timers.items(), key=lambda kv: -kv[1][1]):
+        tbl(name, '\t', f'{total*1000:.1f}ms', '\t', f'\bdem {calls} calls', '\t')
+    for name, n in sorted(counters.items()):
+        tbl(name, '\t', f'{n:,}', '\t', '', '\t')
+    print(tbl)
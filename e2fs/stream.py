@@ -0,0 +1,139 @@
+''' Read-only virtual streams layered over the image (or over each other).
+
+They all implement `pread(size, offset)` as well as seek/read, so `Superblock` and `e2fs.struct.pread` can use
+them like a file, and they read through whatever is below them, e.g. the BlockCache of the outer image.
+'''
+import io
+from bisect import bisect_right
+from .struct import pread
+
+
+
+class Remap(io.RawIOBase):
+    ''' A stream made of extents of another stream.
+
+    `extents` are (logical offset, length, physical offset) sorted by logical offset; a physical offset of None,
+    or a logical range that no extent covers, reads as zeros.  Only [offset, offset+size) of the logical space is
+    visible, starting at 0.
+    '''
+    def __init__(self, stream, extents, size, offset=0):
+        self.stream = stream
+        self.extents = extents
+        self.starts = [e[0] for e in extents]
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+
+    def readable(self): return True
+    def seekable(self): return True
+
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR: offset += self.pos
+        elif whence == io.SEEK_END: offset += self.size
+        if offset < 0: raise OSError(22, 'Invalid argument')
+        self.pos = offset
+        return self.pos
+
+
+    def tell(self):
+        return self.pos
+
+
+    def pieces(self, offset, size):
+        ''' Map [offset, offset+size) to consecutive (length, physical offset or None) pieces '''
+        pos, end = offset + self.offset, offset + self.offset + size
+        i = bisect_right(self.starts, pos) - 1
+        while pos < end:
+            if i+1 < len(self.starts) and self.starts[i+1] <= pos:
+                i += 1
+                continue
+            if i >= 0 and pos < self.extents[i][0] + self.extents[i][1]:
+                start, length, phys = self.extents[i]
+                n = min(end, start + length) - pos
+                yield n, None if phys == None else phys + pos - start
+            else: # A hole up to the next extent
+                n = min(end, self.starts[i+1] if i+1 < len(self.starts) else end) - pos
+                yield n, None
+            pos += n
+
+
+    def pread(self, size, offset):
+        size = max(0, min(size, self.size - offset))
+        parts = []
+        for n, phys in self.pieces(offset, size):
+            data = bytes(n) if phys == None else pread(self.stream, phys, n)
+            parts.append(data if len(data) == n else data + bytes(n - len(data)))
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+
+    def prefetch(self, offset, size):
+        ''' Prefetch the physical ranges behind [offset, offset+size), if the stream below can '''
+        if not hasattr(self.stream, 'prefetch'): return
+        for n, phys in self.pieces(offset, max(0, min(size, self.size - offset))):
+            if phys != None: self.stream.prefetch(phys, n)
+
+
+    def direct(self, offset, size):
+        ''' The physical pieces of [offset, offset+size) in the stream below, holes as None '''
+        for n, phys in self.pieces(offset, max(0, min(size, self.size - offset))):
+            yield n, None if phys == None else self.stream, phys
+
+
+    def unreadable(self, offset, size):
+        ''' Whether the stream below refuses any part of [offset, offset+size) (see `e2fs.mapfile`) '''
+        if not hasattr(self.stream, 'unreadable'): return False
+        return any(phys != None and self.stream.unreadable(phys, n) for n, phys in self.pieces(offset, max(0, min(size, self.size - offset))))
+
+
+    def writable(self):
+        return self.stream.writable()
+
+
+    def write(self, data):
+        ''' Write through to the stream below.  Holes can't be written. '''
+        if self.pos + len(data) > self.size: raise OSError(28, 'No space left on device')
+        done = 0
+        for n, phys in self.pieces(self.pos, len(data)):
+            if phys == None: raise OSError(5, f'Offset {self.pos + done} is not mapped')
+            self.stream.seek(phys)
+            self.stream.write(data[done:done+n])
+            done += n
+        self.pos += done
+        return done
+
+
+    def flush(self):
+        if self.stream.writable(): self.stream.flush()
+
+
+    def read(self, size=-1):
+        if size < 0: size = self.size - self.pos
+        data = self.pread(size, self.pos)
+        self.pos += len(data)
+        return data
+
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+
+class InodeStream(Remap):
+    ''' The logical contents of an inode (through its block map), optionally only `size` bytes from `offset` '''
+    def __init__(self, sb, inode, offset=0, size=None, err_ok=False):
+        bs = sb.block_size
+        extents = []
+        for idx, blkid in inode.block_map(err_ok=err_ok):
+            last = extents[-1] if extents else None
+            if last and last[0] + last[1] == idx*bs and last[2] + last[1] == blkid*bs:
+                last[1] += bs
+            else:
+                extents.append([idx*bs, bs, blkid*bs])
+        total = inode.file_size
+        if size == None: size = total - offset
+        super().__init__(sb.stream, [tuple(e) for e in extents], max(0, min(size, total - offset)), offset)
+        self.inode = inode
@@ -1,18 +1,53 @@
-import io, struct, functools
+import io, os, re, struct, functools, time
 from print_ext import Table, PrettyException
+from . import stats
 
 
 def read(stream, offset, size):
+    ''' Exactly `size` bytes at `offset`.  Like `pread` it leaves the stream position alone, so the async commands
+    can parse structures on several threads at once.
+    '''
+    if stats.enabled: t0 = time.perf_counter()
     try:
-        stream.seek(offset)
+        data = pread(stream, offset, size)
     except OSError:
         raise PrettyException(msg=f'EOF {pretty_num(offset)} / {pretty_num(stream.seek(0,io.SEEK_END))}')
-    data = stream.read(size)
     if len(data) != size:
         raise PrettyException(msg=f"need {size}bytes, got {len(data)}")
+    if stats.enabled: stats.io('read', stream, offset, size, time.perf_counter()-t0)
     return data
 
 
+def pread(stream, offset, size):
+    ''' Read without using the stream position, so it is safe to call from several threads.
+    Returns fewer than `size` bytes at EOF.
+    '''
+    if hasattr(stream, 'pread'): return stream.pread(size, offset)
+    try:
+        fd = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        stream.seek(offset)
+        return stream.read(size)
+    return os.pread(fd, size, offset)
+
+
+def direct(stream, offset, size):
+    ''' Yield (length, fd, offset in fd) for consecutive pieces of [offset, offset+size) of `stream`, following the
+    layers that pass reads through unchanged (they have a `direct` method) down to a file, e.g. for os.sendfile.
+    fd is None for the pieces that have to be read through `stream`: overlaid, unrecovered, holes, or no file below.
+    '''
+    if hasattr(stream, 'direct'):
+        for n, below, off in stream.direct(offset, size):
+            if below == None: yield n, None, off
+            else: yield from direct(below, off, n)
+        return
+    try:
+        fd = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fd = None
+    yield size, fd, offset
+
+
 def pretty_num(n):
     s = []
     factor = 1024*1024*1024*1024*1024
@@ -92,18 +127,41 @@ class Struct(metaclass=MetaStruct):
         return read(self.stream, self.offset, self.size)
 
 
+    @classmethod
+    def dtype(cls):
+        ''' A numpy structured dtype matching `dfn`, for decoding many raw structs at once '''
+        import numpy as np
+        names, formats, offsets = [], [], []
+        for name, (offset, size, format) in cls.flds.items():
+            order, count, code = re.fullmatch(r'([<>=!@]?)(\d*)(\w)', format).groups()
+            count = int(count or 1)
+            if code == 's':
+                dt = np.dtype(('u1', (count,)))
+            else:
+                dt = np.dtype(('>' if order in '>!' else '<') + code)
+                if count > 1: dt = np.dtype((dt, (count,)))
+            names.append(name)
+            formats.append(dt)
+            offsets.append(offset)
+        return np.dtype(dict(names=names, formats=formats, offsets=offsets, itemsize=cls.size))
+
+
     def __getitem__(self, key):
         if key in dir(self): return getattr(self, key)
         try:
-            return self.__cache[key]
+            val = self.__cache[key]
+            if stats.enabled: stats.count('field.cache_hits')
+            return val
         except KeyError:
             pass
         if key not in self.flds:
             raise AttributeError(f"{key} is not a field")
+        if stats.enabled: t0 = time.perf_counter()
         offset, size, format = self.flds[key]
         data = read(self.stream, offset + self.offset, size)
         self.__cache[key] = struct.unpack_from(format, data)
         if len(self.__cache[key]) == 1: self.__cache[key] = self.__cache[key][0]
+        if stats.enabled: stats.add_time('struct decode', time.perf_counter()-t0)
         return self.__cache[key]
 
 
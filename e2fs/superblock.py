@@ -1,8 +1,12 @@
+import io, asyncio
+from collections import OrderedDict
 from math import ceil, log
 from print_ext import PrettyException, Printer
 from datetime import datetime
-from .struct import Struct, pretty_num, read
+from .struct import Struct, pretty_num, read, pread
 from .block_group import BlockGroup
+from . import scan
+from .mapfile import Unrecovered
 
 class Superblock(Struct):
     size = 1024
@@ -190,8 +194,15 @@ class Superblock(Struct):
         '<I checksum Superblock checksum.',
     ]
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, inode_cache=65536, queue_depth=32, **kwargs):
         self.__inode_count = -1
+        self.__inodes = OrderedDict()
+        self.__pool = None
+        self.inode_cache = inode_cache
+        self.queue_depth = queue_depth
+        self.on_write = [] # Called with (offset, size) after each write
+        self.classes = None # The BlockClasses of e2fs.classify, if they were made
+        self.source = None # Where the stream comes from (the image, --volume, ...), for the files made from it
         super().__init__(*args, **kwargs)
 
 
@@ -234,16 +245,50 @@ class Superblock(Struct):
         return self._timestamp(k) if self[k] else 'Never'
         
 
-    def super_bgs(self, brute=False):
+    def super_offset(self, bg):
+        return bg*self.bg_size + (0 if bg else 1024)
+
+
+    def probe(self, brute=False, threads=8):
+        ''' Read the superblock at every candidate location, one pread each spread over `threads`.
+        Returns (bgs, recs): the block groups that have the right magic, and their decoded fields as a structured array.
+        '''
+        import numpy as np
+        from concurrent.futures import ThreadPoolExecutor
         if not self.feature_ro_compat & self.RO_COMPAT_SPARSE_SUPER: brute = True
-        for bg in range(0, self.bg_count):
-            bgrp = self.blkgrp(bg)
-            if not (brute or bgrp.is_super()): continue
-            sb = Superblock(self.stream, bg*self.bg_size + (0 if bg else 1024))
-            sb.validate()
-            if sb._errors and sb._errors[0] == "Bad magic": continue
+        bgs = np.array([bg for bg in range(self.bg_count) if brute or self.blkgrp(bg).is_super()], dtype=np.int64)
+        def _read(bg):
+            return pread(self.stream, self.super_offset(bg), self.size).ljust(self.size, b'\0')
+        try:
+            if not hasattr(self.stream, 'pread'): self.stream.fileno()
+        except Exception:
+            threads = 0 # pread falls back to seek+read, which can't be shared
+        if threads > 1:
+            with ThreadPoolExecutor(threads) as pool:
+                data = b''.join(pool.map(_read, bgs.tolist()))
+        else:
+            data = b''.join(map(_read, bgs.tolist()))
+        recs = np.frombuffer(data, dtype=self.dtype())
+        good = recs['magic'] == 0xEF53
+        return bgs[good], recs[good]
+
+
+    def diff_fields(self, recs):
+        ''' Compare decoded superblocks (from `probe`) to this one.  Returns {field: bool array of the copies that differ} '''
+        import numpy as np
+        me = np.frombuffer(self.raw(), dtype=self.dtype())
+        diffs = {}
+        for fld in self.flds:
+            ne = (recs[fld].reshape(len(recs), -1) != me[fld].reshape(1, -1)).any(axis=1)
+            if ne.any(): diffs[fld] = ne
+        return diffs
+
+
+    def super_bgs(self, brute=False):
+        for bg in self.probe(brute=brute)[0].tolist():
+            sb = Superblock(self.stream, self.super_offset(bg))
             sb.validate(all=True)
-            yield bgrp, sb
+            yield self.blkgrp(bg), sb
 
 
     def summary(self, print):
@@ -286,16 +331,50 @@ class Superblock(Struct):
         return 2**(10+self.log_cluster_size)
 
 
-    def all_block_descriptors(self):
-        ''' Collect every descriptor from every super-block-group and organize them by same hash '''
-        all_bg = {}
+    def descriptor_matrix(self):
+        ''' Read each super-block-group's descriptor table in one go and compare the copies row by row.
+        Returns (srcs, table, agree, first, consensus):
+         * srcs[i] : block group of the i'th copy
+         * table[i,j] : raw bytes of descriptor j in copy i
+         * agree[i,j] : number of copies whose descriptor j is identical to copy i's
+         * first[i,j] : first copy whose descriptor j is identical to copy i's
+         * consensus[j] : copy holding the most common version of descriptor j
+        '''
+        import numpy as np
+        srcs, tables = [], []
         for bgrp, _ in self.super_bgs():
-            for bg_desc in bgrp.descriptors():
-                bg_desc.copies = 1
-                h = hash(bg_desc.raw())
-                if h in all_bg: all_bg[h].copies += 1
-                else: all_bg[h] = bg_desc
-        return all_bg.values()
+            srcs.append(bgrp.bg)
+            tables.append(np.frombuffer(bgrp.descriptor_table(), dtype=np.uint8))
+        size = self.blkgrp(0).BlockDescriptor.size
+        table = np.stack(tables).reshape(len(srcs), self.bg_count, size)
+        rows = table.view(np.uint64)
+        agree = np.empty((len(srcs), self.bg_count), dtype=np.int32)
+        first = np.empty((len(srcs), self.bg_count), dtype=np.int32)
+        for i in range(len(srcs)):
+            same = (rows == rows[i]).all(axis=2)
+            agree[i] = same.sum(axis=0)
+            first[i] = same.argmax(axis=0)
+        consensus = first[agree.argmax(axis=0), np.arange(self.bg_count)]
+        return srcs, table, agree, first, consensus
+
+
+    def all_block_descriptors(self):
+        ''' Yield every distinct version of every descriptor, consensus first.
+        Each descriptor has `copies` (how many super-block-groups agree with it) and `matrix`, one
+        character per super-block-group: '.' agrees with the consensus, otherwise a letter per variant.
+        '''
+        import numpy as np
+        srcs, table, agree, first, consensus = self.descriptor_matrix()
+        BlockDescriptor = self.blkgrp(0).BlockDescriptor
+        letters = np.frombuffer(b'.abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ', dtype=np.uint8)
+        for bg in range(self.bg_count):
+            col = first[:, bg]
+            variants = [consensus[bg]] + [i for i in np.unique(col) if i != consensus[bg]]
+            ids = np.searchsorted(variants[1:], col) + 1 if len(variants) > 1 else np.ones(len(col), dtype=np.intp)
+            ids[col == consensus[bg]] = 0
+            matrix = letters[np.minimum(ids, len(letters)-1)].tobytes().decode('ascii')
+            for i in variants:
+                yield BlockDescriptor(io.BytesIO(table[i, bg].tobytes()), 0, bg=bg, bg_src=srcs[i], copies=int(agree[i, bg]), matrix=matrix, consensus=i==consensus[bg])
 
 
     @property
@@ -317,9 +396,84 @@ class Superblock(Struct):
 
     def inode(self, id, **kwargs):
         if id < 1 or id >= self.inode_count: raise ValueError(f"inode out of range (1, {self.inode_count})  {id}")
-        return self.blkgrp((id - 1) // self.inodes_per_group, **kwargs).inode_idx(id)
+        if kwargs or not self.inode_cache:
+            return self.blkgrp((id - 1) // self.inodes_per_group, **kwargs).inode_idx(id)
+        try:
+            inode = self.__inodes[id]
+            self.__inodes.move_to_end(id)
+            inode._errors = []
+            return inode
+        except KeyError:
+            pass
+        inode = self.__inodes[id] = self.blkgrp((id - 1) // self.inodes_per_group).inode_idx(id)
+        if len(self.__inodes) > self.inode_cache: self.__inodes.popitem(last=False)
+        return inode
+
+
+    def cache_clear(self):
+        self.__inodes.clear()
+        if hasattr(self.stream, 'invalidate'): self.stream.invalidate()
+
+
+    def write(self, offset, data):
+        ''' Write raw bytes into the image and drop anything cached from it '''
+        self.stream.seek(offset)
+        self.stream.write(data)
+        self.stream.flush()
+        self.cache_clear()
+        for fn in self.on_write: fn(offset, len(data))
         
 
+    @property
+    def pool(self):
+        ''' The `queue_depth` threads that do the preads for the async API '''
+        if self.__pool == None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.__pool = ThreadPoolExecutor(self.queue_depth, thread_name_prefix='e2fs-io')
+        return self.__pool
+
+
+    async def read_blocks(self, blkids, window=1<<20, gap=0):
+        ''' Read `blkids` with up to `queue_depth` preads in flight.
+        Neighbouring blocks are coalesced into reads of at most `window` bytes.
+        Returns the data of each block, in the order of `blkids`, and b'' for the unreadable ones (see `e2fs.mapfile`).
+        '''
+        loop = asyncio.get_running_loop()
+        blkids = list(blkids)
+        wins = scan.windows(scan.readable(self, blkids), max(1, window // self.block_size), gap)
+        found = {}
+        for part in await asyncio.gather(*[loop.run_in_executor(self.pool, self._read_window, *w) for w in wins]):
+            found.update(part)
+        return [found.get(blkid, b'') for blkid in blkids]
+
+
+    def _read_window(self, first, count, run):
+        bs = self.block_size
+        try:
+            data = pread(self.stream, first*bs, count*bs)
+        except Unrecovered: # Only the gaps between the blocks can be unreadable
+            return {blkid:pread(self.stream, blkid*bs, bs) for blkid in run}
+        return {blkid:data[(blkid-first)*bs:(blkid-first+1)*bs] for blkid in run}
+
+
+    async def read_inodes(self, ids):
+        ''' Look up many inodes, reading their inode-table and bitmap blocks concurrently first.
+        Returns {id: inode} for the ids that are in range and readable.
+        '''
+        ipg = self.inodes_per_group
+        ids = [id for id in ids if 0 < id < self.inode_count]
+        def _blkids():
+            blkids = {}
+            for id in ids:
+                bgrp = self.blkgrp((id - 1) // ipg)
+                blkids[id] = (bgrp.inode_table_blkid() + (id - 1) % ipg * self.inode_size // self.block_size, bgrp.bg*self.blocks_per_group + bgrp.bitmap_offset + 1)
+            return blkids
+        blkids = await asyncio.get_running_loop().run_in_executor(self.pool, _blkids)
+        wanted = list({blkid for pair in blkids.values() for blkid in pair})
+        got = dict(zip(wanted, await self.read_blocks(wanted)))
+        return {id:self.inode(id) for id in ids if got[blkids[id][0]] and got[blkids[id][1]]}
+
+
     def blkgrp(self, bg, **kwargs):
         if bg < 0 or bg >= self.bg_count: raise ValueError(f"bg out of range (0, {self.bg_count})  {bg}")
         return BlockGroup(self, bg, **kwargs)
@@ -0,0 +1,352 @@
+''' Find the filesystem inside a disk image: MBR/GPT partitions and LVM2 logical volumes.
+
+Every volume is a `Remap` of the stream below, so a partition of the image, or a logical volume inside that
+partition, reads straight from the image (and its BlockCache) without copying anything.
+Only the physical volume in the given stream is known: segments of a logical volume that live on another
+physical volume read as zeros.
+'''
+import re, struct, zlib
+from bisect import bisect_right
+from print_ext import PrettyException
+from .struct import Struct, pread
+from .stream import Remap
+
+
+SECTOR = 512
+
+MBR_TYPES = {0x05:'Extended', 0x07:'NTFS/exFAT', 0x0b:'FAT32', 0x0c:'FAT32 (LBA)', 0x0f:'Extended (LBA)', 0x82:'Linux swap', 0x83:'Linux', 0x85:'Linux extended', 0x8e:'Linux LVM', 0xee:'GPT protective'}
+MBR_EXTENDED = {0x05, 0x0f, 0x85}
+
+GPT_TYPES = {
+    '0FC63DAF-8483-4772-8E79-3D69D8477DE4':'Linux',
+    'E6D6D379-F507-44C2-A23C-238F2A3DF928':'Linux LVM',
+    '0657FD6D-A4AB-43C4-84E5-0933C84B4F4F':'Linux swap',
+    'C12A7328-F81F-11D2-BA4B-00A0C93EC93B':'EFI System',
+    '21686148-6449-6E6F-744E-656564454649':'BIOS boot',
+    'EBD0A0A2-B9E5-4433-87C0-68B6B72699C7':'Microsoft basic data',
+}
+
+
+
+class MBREntry(Struct):
+    size = 16
+    enums = {}
+    flags = {}
+    dfn = [
+        '<B status 0x80 if the partition is bootable.',
+        '3s chs_first CHS address of the first sector (unused).',
+        '<B type Partition type.',
+        '3s chs_last CHS address of the last sector (unused).',
+        '<I lba_first First sector, relative to the start of the disk (or of the extended partition for logical partitions).',
+        '<I sectors Number of sectors.',
+    ]
+
+
+
+class GPTHeader(Struct):
+    size = 92
+    enums = {}
+    flags = {}
+    dfn = [
+        '8s signature "EFI PART".',
+        '<I revision Header format revision.',
+        '<I header_size Size of this header.',
+        '<I header_crc32 CRC32 of the header, with this field zeroed.',
+        '<I reserved Zero.',
+        '<Q current_lba The LBA of this header.',
+        '<Q backup_lba The LBA of the other header.',
+        '<Q first_usable_lba First LBA partitions can use.',
+        '<Q last_usable_lba Last LBA partitions can use.',
+        '16s disk_guid Disk GUID.',
+        '<Q entries_lba Start of the partition entry array.',
+        '<I entries_count Number of partition entries.',
+        '<I entry_size Size of one partition entry.',
+        '<I entries_crc32 CRC32 of the partition entry array.',
+    ]
+
+
+
+class GPTEntry(Struct):
+    size = 128
+    enums = {}
+    flags = {}
+    dfn = [
+        '16s type_guid Partition type GUID, all zero for an unused entry.',
+        '16s guid Unique partition GUID.',
+        '<Q lba_first First LBA.',
+        '<Q lba_last Last LBA (inclusive).',
+        '<Q attributes Attribute flags.',
+        '72s name UTF-16LE partition name.',
+    ]
+
+
+
+class LVMLabel(Struct):
+    size = 32
+    enums = {}
+    flags = {}
+    dfn = [
+        '8s id "LABELONE".',
+        '<Q sector Sector this label is in.',
+        '<I crc CRC of the rest of the label sector.',
+        '<I pv_offset Offset of the pv header from the start of the label.',
+        '8s type "LVM2 001".',
+    ]
+
+
+
+class MDAHeader(Struct):
+    size = 40
+    enums = {}
+    flags = {}
+    dfn = [
+        '<I checksum CRC of the rest of the header.',
+        '16s magic " LVM2 x[5A%r0N*>".',
+        '<I version Metadata area format version.',
+        '<Q start Absolute offset of this metadata area.',
+        '<Q area_size Size of this metadata area.',
+    ]
+
+
+
+def _guid(b):
+    a, b2, c = struct.unpack_from('<IHH', b)
+    return f'{a:08X}-{b2:04X}-{c:04X}-{b[8:10].hex().upper()}-{b[10:16].hex().upper()}'
+
+
+
+class Volume():
+    ''' A partition or logical volume: `stream` reads its contents '''
+    def __init__(self, name, kind, stream, desc=''):
+        self.name = name
+        self.kind = kind
+        self.stream = stream
+        self.desc = desc
+
+
+    @property
+    def size(self):
+        return self.stream.size
+
+
+    def __repr__(self):
+        return f"{self.kind} {self.name} {self.size} {self.desc}"
+
+
+
+def partitions(stream):
+    ''' The partitions in an MBR (including logical partitions) or GPT partition table '''
+    mbr = pread(stream, 0, SECTOR)
+    if len(mbr) < SECTOR or mbr[510:512] != b'\x55\xaa': return []
+    entries = [MBREntry(stream, 446 + 16*i) for i in range(4)]
+    if any(e.type == 0xee for e in entries):
+        return _gpt(stream)
+    found = []
+    for i, e in enumerate(entries):
+        if not e.type or not e.sectors: continue
+        if e.type in MBR_EXTENDED:
+            found.extend(_logical(stream, e.lba_first))
+            continue
+        found.append(_part(stream, str(i+1), e.lba_first*SECTOR, e.sectors*SECTOR, MBR_TYPES.get(e.type, hex(e.type))))
+    return found
+
+
+
+def _part(stream, name, offset, size, desc):
+    return Volume(name, 'partition', Remap(stream, [(0, size, offset)], size), desc)
+
+
+
+def _logical(stream, ext_first):
+    ''' Follow the chain of EBRs of an extended partition.  Logical partitions are numbered from 5. '''
+    found, ebr, seen = [], ext_first, set()
+    while ebr not in seen:
+        seen.add(ebr)
+        if pread(stream, ebr*SECTOR + 510, 2) != b'\x55\xaa': break
+        part, nxt = MBREntry(stream, ebr*SECTOR + 446), MBREntry(stream, ebr*SECTOR + 462)
+        if part.type and part.sectors:
+            found.append(_part(stream, str(5 + len(found)), (ebr + part.lba_first)*SECTOR, part.sectors*SECTOR, MBR_TYPES.get(part.type, hex(part.type))))
+        if not nxt.type: break
+        ebr = ext_first + nxt.lba_first
+    return found
+
+
+
+def _gpt(stream):
+    for sector in (SECTOR, 4096):
+        hdr = GPTHeader(stream, sector)
+        if hdr.signature == b'EFI PART': break
+    else:
+        raise PrettyException(msg="Protective MBR, but no GPT header")
+    table = pread(stream, hdr.entries_lba*sector, hdr.entries_count*hdr.entry_size)
+    if zlib.crc32(table) != hdr.entries_crc32:
+        raise PrettyException(msg="GPT partition entries don't match their CRC (try the backup at the end of the disk)")
+    found = []
+    for i in range(hdr.entries_count):
+        e = GPTEntry(stream, hdr.entries_lba*sector + i*hdr.entry_size)
+        if not any(e.type_guid): continue
+        kind = _guid(e.type_guid)
+        name = e.name.decode('utf-16-le').rstrip('\0')
+        desc = GPT_TYPES.get(kind, kind) + (f' {name!r}' if name else '')
+        found.append(_part(stream, str(i+1), e.lba_first*sector, (e.lba_last - e.lba_first + 1)*sector, desc))
+    return found
+
+
+
+def parse_lvm_config(text):
+    ''' Parse LVM2 metadata text into nested dicts.  Arrays become lists. '''
+    tokens = re.findall(r'"(?:[^"\\]|\\.)*"|[{}\[\]=,]|[^\s{}\[\]=,"#]+|#[^\n]*', text)
+    tokens = [t for t in tokens if not t.startswith('#')]
+    pos = 0
+    def value():
+        nonlocal pos
+        t = tokens[pos]
+        pos += 1
+        if t == '[':
+            vals = []
+            while tokens[pos] != ']':
+                if tokens[pos] == ',':
+                    pos += 1
+                    continue
+                vals.append(value())
+            pos += 1
+            return vals
+        if t.startswith('"'): return re.sub(r'\\(.)', r'\1', t[1:-1])
+        try:
+            return int(t)
+        except ValueError:
+            return t
+    def section():
+        nonlocal pos
+        d = {}
+        while pos < len(tokens) and tokens[pos] != '}':
+            name, op = tokens[pos], tokens[pos+1]
+            pos += 2
+            if op == '=':
+                d[name] = value()
+            elif op == '{':
+                d[name] = section()
+                pos += 1
+            else:
+                raise PrettyException(msg=f"Bad LVM metadata near {name!r} {op!r}")
+        return d
+    return section()
+
+
+
+def lvm_metadata(stream):
+    ''' Find the PV label in the first 4 sectors and read the current metadata text.
+    Returns (pv uuid, {vg name: vg config}), or None if this isn't a PV.
+    '''
+    for sector in range(4):
+        label = LVMLabel(stream, sector*SECTOR)
+        if len(pread(stream, sector*SECTOR, SECTOR)) == SECTOR and label.id == b'LABELONE' and label.type == b'LVM2 001': break
+    else:
+        return None
+    pvh = sector*SECTOR + label.pv_offset
+    uuid = pread(stream, pvh, 32).decode('ascii')
+    # The disk locations: data areas then metadata areas, each list ends with a zero entry
+    locns, off = [[], []], pvh + 40
+    for areas in locns:
+        while True:
+            offset, size = struct.unpack('<QQ', pread(stream, off, 16))
+            off += 16
+            if not offset: break
+            areas.append((offset, size))
+    for offset, size in locns[1]:
+        mda = MDAHeader(stream, offset)
+        if mda.magic != b' LVM2 x[5A%r0N*>': continue
+        loc, length = struct.unpack('<QQ', pread(stream, offset + MDAHeader.size, 16))
+        if not length: continue
+        first = min(length, mda.area_size - loc)
+        text = pread(stream, offset + loc, first)
+        if first < length: text += pread(stream, offset + SECTOR, length - first) # Wrapped around the circular buffer
+        vgs = {k:v for k,v in parse_lvm_config(text.rstrip(b'\0').decode('utf8', 'replace')).items() if isinstance(v, dict) and 'physical_volumes' in v}
+        return uuid, vgs
+    return uuid, {}
+
+
+
+class LogicalVolume(Remap):
+    ''' The contents of an LVM2 logical volume made of linear or striped segments on one physical volume '''
+    def __init__(self, stream, vg, lv, pv_uuid):
+        self.extent = vg['extent_size'] * SECTOR
+        pvs = {}
+        for name, pv in vg['physical_volumes'].items():
+            if pv['id'].replace('-', '') == pv_uuid: pvs[name] = pv['pe_start'] * SECTOR
+        self.segments = [] # (start, size, stripe size, [pv offset or None])
+        self.missing = set()
+        segs = sorted((v for k,v in lv.items() if k.startswith('segment') and isinstance(v, dict)), key=lambda s: s['start_extent'])
+        for seg in segs:
+            if seg.get('type', 'striped') != 'striped':
+                raise PrettyException(msg=f"LVM segment type {seg['type']!r} isn't supported (only linear and striped)")
+            stripes = seg['stripes']
+            offsets = []
+            for pv, extent in zip(stripes[::2], stripes[1::2]):
+                if pv not in pvs: self.missing.add(pv)
+                offsets.append(pvs[pv] + extent*self.extent if pv in pvs else None)
+            self.segments.append((seg['start_extent']*self.extent, seg['extent_count']*self.extent, seg.get('stripe_size', 0)*SECTOR, offsets))
+        size = sum(s[1] for s in self.segments)
+        super().__init__(stream, [], size)
+        self.seg_starts = [s[0] for s in self.segments]
+
+
+    def pieces(self, offset, size):
+        pos, end = offset, offset + size
+        while pos < end:
+            i = bisect_right(self.seg_starts, pos) - 1
+            if i < 0 or pos >= self.segments[i][0] + self.segments[i][1]:
+                nxt = self.seg_starts[i+1] if i+1 < len(self.seg_starts) else end
+                n = min(end, nxt) - pos
+                yield n, None
+                pos += n
+                continue
+            start, length, stripe, offsets = self.segments[i]
+            rel = pos - start
+            if len(offsets) == 1:
+                n = min(end, start + length) - pos
+                yield n, None if offsets[0] == None else offsets[0] + rel
+            else:
+                chunk, within = divmod(rel, stripe)
+                row, idx = divmod(chunk, len(offsets))
+                n = min(end - pos, stripe - within, start + length - pos)
+                yield n, None if offsets[idx] == None else offsets[idx] + row*stripe + within
+            pos += n
+
+
+
+def logical_volumes(stream):
+    ''' The logical volumes of the PV in `stream`, named vg/lv '''
+    meta = lvm_metadata(stream)
+    if not meta: return []
+    uuid, vgs = meta
+    found = []
+    for vgname, vg in vgs.items():
+        for lvname, lv in vg.get('logical_volumes', {}).items():
+            v = LogicalVolume(stream, vg, lv, uuid)
+            desc = f"{len(v.segments)} segments" + (f", missing PVs {', '.join(sorted(v.missing))}" if v.missing else '')
+            found.append(Volume(f'{vgname}/{lvname}', 'lv', v, desc))
+    return found
+
+
+
+def volumes(stream):
+    ''' Every partition and logical volume in `stream`, with the logical volumes inside partitions named part/vg/lv '''
+    found = []
+    for part in partitions(stream):
+        found.append(part)
+        for lv in logical_volumes(part.stream):
+            lv.name = f'{part.name}/{lv.name}'
+            found.append(lv)
+    found.extend(logical_volumes(stream))
+    return found
+
+
+
+def open_volume(stream, spec):
+    ''' The stream for a volume spec: `2` (a partition), `vg/lv` or `lv`, or `2/vg/lv` '''
+    vols = volumes(stream)
+    for v in vols:
+        if v.name == spec or (v.kind == 'lv' and v.name.endswith('/' + spec)):
+            return v.stream
+    raise PrettyException(msg=f"No volume {spec!r}.  Found: {', '.join(v.name for v in vols) or 'nothing'}")
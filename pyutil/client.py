@@ -0,0 +1,61 @@
+''' Thin client for the `daemon` sub-command.
+
+This only uses the standard library so `cli.py` can forward a command without the venv, yaclipy or print_ext.
+
+Every frame is a one byte kind, a little endian uint32 length and the payload:
+ * r : request (client -> daemon) json {argv, cwd, tty, width}
+ * l : a line of stdin (client -> daemon), sent in response to an `i`
+ * o, e : stdout / stderr bytes (daemon -> client)
+ * i : the command wants a line of stdin (daemon -> client)
+ * x : exit status as ascii (daemon -> client), always last
+'''
+import os, sys, json, socket, struct
+
+
+def send_frame(sock, kind, payload=b''):
+    sock.sendall(kind + struct.pack('<I', len(payload)) + payload)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk: raise EOFError()
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    head = _recv_exact(sock, 5)
+    return head[:1], _recv_exact(sock, struct.unpack_from('<I', head, 1)[0])
+
+
+def forward(path, argv):
+    ''' Run `argv` (main's sub-command line) in the daemon listening on `path` and return its exit status '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        width = os.get_terminal_size().columns
+    except OSError:
+        width = 0
+    req = dict(argv=list(argv), cwd=os.getcwd(), tty=sys.stdout.isatty(), width=width)
+    send_frame(sock, b'r', json.dumps(req).encode('utf8'))
+    out = {b'o': sys.stdout.buffer, b'e': sys.stderr.buffer}
+    try:
+        while True:
+            kind, payload = recv_frame(sock)
+            if kind in out:
+                out[kind].write(payload)
+                out[kind].flush()
+            elif kind == b'i':
+                send_frame(sock, b'l', sys.stdin.buffer.readline())
+            elif kind == b'x':
+                return int(payload)
+    except EOFError:
+        return 1
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    sys.exit(forward(os.environ.get('E2FSGROK_SOCKET', 'local/e2fsgrok.sock'), sys.argv[1:]))
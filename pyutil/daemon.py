@@ -0,0 +1,123 @@
+''' Serve `main` sub-commands over a unix domain socket.
+
+The daemon keeps the open image, its Superblock and the block/inode caches between commands, so a script
+calling `blkls` or `cat` thousands of times only pays for the work itself.  See `pyutil/client.py` for the protocol.
+'''
+import io, os, sys, json, socket, asyncio, traceback
+from contextlib import redirect_stdout, redirect_stderr
+from inspect import Parameter
+import yaclipy as CLI
+from print_ext import Printer, PrettyException
+from print_ext.printer import printer_for_stream, printer_var
+from e2fs import records, stats as e2fs_stats
+from .client import send_frame, recv_frame
+
+
+class _Frames(io.RawIOBase):
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        send_frame(self.sock, self.kind, bytes(b))
+        return len(b)
+
+
+
+class _Out(io.TextIOWrapper):
+    ''' stdout/stderr that is sent to the client, buffered into large frames '''
+    def __init__(self, sock, kind, tty):
+        super().__init__(io.BufferedWriter(_Frames(sock, kind), 1<<16), encoding='utf8', errors='replace', write_through=True)
+        self.tty = tty
+
+    def isatty(self):
+        return self.tty
+
+    def seekable(self):
+        return False
+
+
+
+class _In(io.TextIOBase):
+    ''' stdin lines are requested from the client one at a time (for `areyousure`) '''
+    def __init__(self, sock, flush):
+        self.sock = sock
+        self.flush_out = flush
+
+    def readable(self):
+        return True
+
+    def readline(self, size=-1):
+        for f in self.flush_out: f.flush()
+        send_frame(self.sock, b'i')
+        kind, line = recv_frame(self.sock)
+        return line.decode('utf8')
+
+
+
+async def _handle(main, sb, conn):
+    kind, payload = recv_frame(conn)
+    req = json.loads(payload)
+    if req['argv'] == ['quit']:
+        send_frame(conn, b'x', b'0')
+        return False
+    out, err = _Out(conn, b'o', req['tty']), _Out(conn, b'e', False)
+    kwargs = dict(width_max=req['width']-1) if req['width'] else {}
+    token = printer_var.set(printer_for_stream(stream=out, **kwargs))
+    cwd, stdin = os.getcwd(), sys.stdin
+    status = 0
+    try:
+        os.chdir(req['cwd'])
+        sys.stdin = _In(conn, (out, err))
+        with redirect_stdout(out), redirect_stderr(err):
+            try:
+                cmd = CLI.Command(main)(req['argv'])
+                if cmd.next_cmd == None: raise PrettyException(msg="No sub-command given")
+                opts = {k:v for k,v in cmd.run_spec.kwargs.items() if v is not Parameter.empty}
+                if opts.get('stats') or opts.get('stats_json'): e2fs_stats.enable()
+                await cmd.next_cmd.run(dict(_sb=sb, _format=records.check(opts.get('format', 'text'))))
+                if opts.get('stats'): e2fs_stats.summary(Printer())
+                if opts.get('stats_json'): e2fs_stats.save(opts['stats_json'])
+            except PrettyException as e:
+                Printer().pretty(e)
+                status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            out.flush()
+            err.flush()
+    finally:
+        e2fs_stats.enable(False)
+        sys.stdin = stdin
+        os.chdir(cwd)
+        printer_var.reset(token)
+    send_frame(conn, b'x', str(status).encode('ascii'))
+    return True
+
+
+
+async def serve(main, sb, path):
+    ''' Accept one client at a time until one sends `quit` '''
+    if os.path.exists(path): os.remove(path)
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.bind(path)
+    os.chmod(path, 0o600)
+    srv.listen(16)
+    srv.setblocking(False)
+    loop = asyncio.get_running_loop()
+    Printer(f"Serving \b1 {os.environ.get('IMG_FILE')}\b  on \b1 {path}\b .  Use \b1 E2FSGROK_SOCKET={path} ./cli.py <cmd>")
+    try:
+        while True:
+            conn, _ = await loop.sock_accept(srv)
+            conn.setblocking(True) # A command's output is sent from plain (blocking) code
+            with conn:
+                try:
+                    if not await _handle(main, sb, conn): break
+                except (EOFError, BrokenPipeError, ConnectionResetError):
+                    continue # The client went away
+    finally:
+        srv.close()
+        os.remove(path)
@@ -1,12 +1,12 @@
 import yaclipy as CLI
-import pickle, struct, re, hashlib, sys, os, shlex, traceback
-from math import ceil
-from print_ext import Printer, PrettyException, Line, Bdr, Text
-from e2fs import Superblock, Bitmap
+import io, pickle, struct, re, sys, os
+from inspect import Parameter
+from print_ext import Printer, PrettyException, Line, Text
+from e2fs import Superblock
 from e2fs.struct import pretty_num, read, Struct
 from e2fs.bitmap import BitmapMem
-from e2fs.directory import DirectoryBlk
-from yaclipy_tools.commands import grep as project_grep, grep_groups
+from e2fs import scan, records, stats as e2fs_stats
+from e2fs.mapfile import Unrecovered
 from yaclipy.arg_spec import coerce_int
 
 def cur_inode(set=None):
@@ -21,6 +21,7 @@ def cur_inode(set=None):
 
 
 def parent_inode(inode, sb):
+    from e2fs.directory import DirectoryBlk
     for blkid in sb.inode(inode).each_block(err_ok=True):
         for e in DirectoryBlk(sb, blkid):
             if e.name == b'..':
@@ -29,6 +30,7 @@ def parent_inode(inode, sb):
 
 
 def name_for_inode(parent, inode, sb):
+    from e2fs.directory import DirectoryBlk
     for blkid in sb.inode(parent).each_block(err_ok=True):
         for e in DirectoryBlk(sb, blkid):
             if e.name == b'.': continue
@@ -50,6 +52,7 @@ def cur_path(sb):
 
 
 def name_or_inode(name, inode=None,*, _sb=None):
+    from e2fs.directory import DirectoryBlk
     if not isinstance(inode, Struct): inode = _sb.inode(inode or cur_inode())
     for blkid in inode.each_block(err_ok=True):
         d = DirectoryBlk(inode.sb, blkid)
@@ -64,54 +67,92 @@ def name_or_inode(name, inode=None,*, _sb=None):
 
 
 
-def superblocks(*, _sb, limit__l=1):
-    ''' Show superblock info
+def volumes(*, _sb):
+    ''' List the partitions (MBR or GPT) and LVM2 logical volumes in the image, for --volume
+    '''
+    from e2fs.volume import volumes
+    found = volumes(_sb.stream)
+    for v in found:
+        Printer(f"\b1 {v.name}\b   {v.kind}  \b3 {pretty_num(v.size)}\b   {v.desc}")
+    if not found: Printer("No partition table or LVM2 physical volume found", style='dem')
+
+
+
+def superblocks(*, _sb, limit__l=1, brute__b=False, threads__t=8):
+    ''' Show superblock info, and how the backup copies differ from it
 
     Parameters:
         --limit <int>, -l <int>
             Only show this many superblocks (of the backup copies)
+        --brute, -b
+            Probe every block group, not just the sparse_super ones
+        --threads <int>, -t <int>
+            How many reads to have in flight while probing
     '''
-    i = 0
-    for bgrp, osb in _sb.super_bgs():
-        Printer().hr(f"{bgrp.bg} : {pretty_num(osb.offset)}")
-        if bgrp.bg == _sb.block_group_nr:
+    bgs, recs = _sb.probe(brute=brute__b, threads=threads__t)
+    diffs = _sb.diff_fields(recs)
+    Printer().hr(f"{len(bgs)} superblocks found")
+    for fld, ne in diffs.items():
+        Printer(f"\b1 {fld}\b  differs in {ne.sum()}/{len(bgs)}  ", '\bdem ' + ' '.join(str(bg) for bg in bgs[ne][:16]), '\bdem  ...' if ne.sum() > 16 else '')
+    for i, bg in enumerate(bgs[:limit__l]):
+        Printer().hr(f"{bg} : {pretty_num(_sb.super_offset(bg))}")
+        if bg == _sb.block_group_nr:
             _sb.summary(Printer())
             Printer().pretty(_sb)
         else:
-            sbb.diff(Printer(), _sb)
-        i += 1
-        if i == limit__l: break
+            osb = Superblock(io.BytesIO(recs[i].tobytes()))
+            osb.validate(all=True)
+            osb.diff(Printer(), _sb)
 
 
 
-def descriptors(*, _sb, limit__l=0):
-    ''' Show descriptors for a given block.
-    Output is #A,B (C) D+E+F  G/H
+def _descriptors(_sb, limit=0):
+    ''' (descriptor, block group, free blocks, free inodes) for every copy of every descriptor, the free counts from the bitmaps '''
+    counts = {}
+    for d in _sb.all_block_descriptors():
+        if limit and d.bg >= limit: break
+        bgrp = _sb.blkgrp(d.bg)
+        if d.bg not in counts:
+            counts = {d.bg: (_sb.blocks_per_group - len(bgrp.data_bitmap()), _sb.inodes_per_group - len(bgrp.inode_bitmap()))}
+        yield (d, bgrp, *counts[d.bg])
+
+
+
+def descriptors(*, _sb, limit__l=0, _format='text'):
+    ''' Compare the descriptor tables of every super-block-group.
+    Output is #A,B (C) D/E  F+G+H  I
      * A : block group id
      * B : super-block-group that this descriptor was found in
      * C : Number of identical descriptors in other super-block-groups
-     * D : Blk bitmap blkid
-     * E : Inode bitmap blkid
-     * F : Inode table blkid
-     * G : Number of free blocks
-     * H : Number of free inodes
+     * D : Number of free blocks
+     * E : Number of free inodes
+     * F : Blk bitmap blkid
+     * G : Inode bitmap blkid
+     * H : Inode table blkid
+     * I : One char per super-block-group: '.' agrees with the consensus, a letter marks a divergent copy
 
     Parameters:
         --limit <int>, -l <int>
             Only show descriptors for the first `-l` descriptors
     '''
-    for d in _sb.all_block_descriptors():
-        if limit__l and d.bg >= limit__l: continue
-        bgrp = _sb.blkgrp(d.bg)
+    if _format != 'text':
+        with records.Records(_format, ['bg', 'src', 'copies', 'super', 'free_blocks', 'desc_free_blocks', 'free_inodes', 'desc_free_inodes',
+                'block_bitmap', 'desc_block_bitmap', 'desc_inode_bitmap', 'desc_inode_table', 'consensus', 'matrix']) as out:
+            for d, bgrp, free_blks, free_inodes in _descriptors(_sb, limit__l):
+                out(bg=d.bg, src=d.bg_src, copies=d.copies, super=bool(bgrp.is_super()), free_blocks=free_blks, desc_free_blocks=d.free_blocks_count_lo,
+                    free_inodes=free_inodes, desc_free_inodes=d.free_inodes_count_lo, block_bitmap=bgrp.bitmap_offset + d.bg * _sb.blocks_per_group,
+                    desc_block_bitmap=d.block_bitmap_lo, desc_inode_bitmap=d.inode_bitmap_lo, desc_inode_table=d.inode_table_lo,
+                    consensus=bool(d.consensus), matrix=d.matrix)
+        return
+    for d, bgrp, free_blks, free_inodes in _descriptors(_sb, limit__l):
         line = Line('\b2 $' if bgrp.is_super() else '#', f'{d.bg},{d.bg_src}  (', f'\b2 {d.copies}',')  ')
-        n = _sb.blocks_per_group - len(bgrp.data_bitmap())
-        line(f"{n} \berr {d.free_blocks_count_lo}" if n != d.free_blocks_count_lo else n, '\bdem /')
-        n = _sb.inodes_per_group - len(bgrp.inode_bitmap())
-        line(f"{n} \berr {d.free_inodes_count_lo}" if n != d.free_inodes_count_lo else n,'  ')
+        line(f"{free_blks} \berr {d.free_blocks_count_lo}" if free_blks != d.free_blocks_count_lo else free_blks, '\bdem /')
+        line(f"{free_inodes} \berr {d.free_inodes_count_lo}" if free_inodes != d.free_inodes_count_lo else free_inodes,'  ')
         off = bgrp.bitmap_offset + d.bg * _sb.blocks_per_group
         line(f"{hex(off)} \berr {hex(d.block_bitmap_lo)}" if off != d.block_bitmap_lo else hex(off),'\bdem +')
         line(f"{1} \berr {d.inode_bitmap_lo-off}" if off+1 != d.inode_bitmap_lo else 1,'\bdem +')
         line(f"{2} \berr {d.inode_table_lo-off}" if off+2 != d.inode_table_lo else 2,'  ')
+        line(f"\bdem {d.matrix}" if d.consensus else '')
         Printer(line)
 
 
@@ -133,9 +174,24 @@ def blkgrp(bg=0, *, _sb, free__f=False):
 
 
 
-def inode_(inode, *, _sb, blocks__b=False):
+def _at_txn(_sb, txn, fname='local/journal.pickle'):
+    ''' `_sb` as of journal transaction `txn`, through the index saved by the journal sub-command (or a new scan) '''
+    if txn == None: return _sb
+    from e2fs.journal import Journal, scan, at
+    return at(_sb, Journal.load(fname) if os.path.exists(fname) else scan(_sb), txn)
+
+
+
+def inode_(inode, *, _sb, blocks__b=False, txn:int=None):
     ''' Show details of an Inode
+
+    Parameters:
+        <inode>
+            The inode (or name in the current directory)
+        --txn <int>
+            Show it as of this transaction of the journal: from the copy of its inode table block logged then
     '''
+    _sb = _at_txn(_sb, txn)
     inode = _sb.inode(name_or_inode(inode, _sb=_sb))
     inode.validate(all=True)
     Printer().hr(f"{hex(inode.id)} #{inode.bg} {'free' if inode.is_free else ''}  nblks: {inode.block_count}")
@@ -161,47 +217,61 @@ def root_inodes(*, _sb):
 
 
 
-def blk_data(blkid=0, *, _sb):
-    ''' Show raw data of a block
+def blk_data(blkid=0, *, _sb, count__n:int=1, verbose__v=False, txn:int=None):
+    ''' Show raw data of a block, or of a range of blocks
 
     Parameters:
         <blkid>
             The block ID to show
+        --count <int>, -n <int>
+            Show this many blocks from blkid on
+        --verbose, -v
+            Show every row, instead of collapsing runs of zero rows into one line
+        --txn <int>
+            Show the blocks as of this transaction of the journal: the ones it or an earlier transaction logged
+            come from their copies in the journal
     '''
+    from e2fs.hexdump import dump
+    _sb = _at_txn(_sb, txn)
+    bs = _sb.block_size
     bgrp = _sb.blkgrp(blkid // _sb.blocks_per_group)
-    Printer().hr(f"#{blkid}  bg:{bgrp.bg}", " @ ", pretty_num(blkid*_sb.block_size),  '  free' if bgrp.blkidx_free(blkid % _sb.blocks_per_group) else '  in use')
-    data = read(_sb.stream, blkid*_sb.block_size, _sb.block_size)
-    i = 0
-    while i < _sb.block_size:
-        l = Line()
-        ascii = ''
-        while i < _sb.block_size:
-            word = ''
-            while i < _sb.block_size:
-                b = data[i]
-                word += f"{b:02x}"
-                ascii += chr(b) if b > 32 and b < 127 else ' '
-                i += 1
-                if i%2 == 0: break
-            l(' \bdem$' if word == '0'*len(word) else ' ', word)
-            if i%32 == 0: break
-        Printer(l, '  ', '\bdem |', ascii, '\bdem |')
-    
+    cls = f'  {_sb.classes.name(blkid)}' if _sb.classes else ''
+    if txn != None:
+        v = _sb.stream.jnl.version(blkid, txn)
+        cls = f'  \b3 txn {v[0]}\b  copy at #{_sb.stream.jnl.blocks[v[1]]}' if v else '  not in the journal'
+    if count__n > 1:
+        Printer().hr(f"#{blkid}-{blkid+count__n-1}  bg:{bgrp.bg}", " @ ", pretty_num(blkid*bs), f'  {count__n} blocks')
+    else:
+        Printer().hr(f"#{blkid}  bg:{bgrp.bg}", " @ ", pretty_num(blkid*bs),  '  free' if bgrp.blkidx_free(blkid % _sb.blocks_per_group) else '  in use', cls)
+    per = max(1, (1<<20) // bs)
+    chunks = (read(_sb.stream, b*bs, min(per, blkid + count__n - b)*bs) for b in range(blkid, blkid + count__n, per))
+    dump(chunks, blkid*bs, squeeze=not verbose__v)
 
 
-def ls(root_inode=0, *, _sb, depth__d=1, keep_going__k=False, parent__p:int=None):
+
+async def ls(root_inode=0, *, _sb, depth__d=1, keep_going__k=False, parent__p:int=None, format=None, _format='text'):
     ''' Show a directory listing from an inode
 
+    The tree is read a level at a time: the directory blocks of a whole level, and then all of the inodes
+    they point to, are fetched together in a few large reads.
+
     Parameters:
         <inode>
             The inode directory to traverse
         --depth <int>, -d <int> | default=0
             How many layers deep to show
         --keep_going, -k
-            Continue even if errors are encountered, otherwise stop on the first error
+            Continue even if errors are encountered, otherwise stop on the first error.
+            With --mapfile, directory blocks and inodes that were never recovered are reported as errors too.
         --parent <inode>, -p <inode>
             The known parent of the root_inode (for checking purposes)
+        --format <text|jsonl|tsv>
+            Overrides the global --format.  jsonl and tsv write one record per entry as soon as its level has
+            been read, instead of the tree at the end
     '''
+    import asyncio
+    from e2fs.directory import DirectoryBlk
+    format = records.check(format or _format)
     class CollectedErrors(PrettyException):
         def __pretty__(self, print, **kwargs):
             for args,kwargs in self.errors:
@@ -213,57 +283,155 @@ def ls(root_inode=0, *, _sb, depth__d=1, keep_going__k=False, parent__p:int=None
     def _error(*args, **kwargs):
         errs.errors.append((args, kwargs))
         if not keep_going__k: raise errs
-        
 
-    def branch(parent_id, inode, depth=0, full_path=''):
-        for blkid in inode.each_block(err_ok=True):
-            d = DirectoryBlk(_sb, blkid)
-            d.validate(all=True)
-            Printer(f'#{blkid}', style='dem')
-            if d._errors: _error(f"blk #{blkid} Errors\t{full_path}\n",*[f"* {e}\n" for e in d._errors])
-            for e in d.entries:
-                path = full_path + f'\bdem /\b {e.name_utf8}\bdem  {hex(e.inode)} \b '
-                if e.name == b'' and e.inode == 0: continue
-                if e.name == b'.':
-                    if e.inode != inode.id: _error(f". Error\t{path}\n* self inode mismatch {hex(e.inode)} != {hex(inode.id)}")
-                    continue
-                if e.name == b'..':
-                    if parent_id != None and e.inode != parent_id:
-                        _error(f".. Error\t{path}\n* parent inode mismatch {hex(e.inode)} != {hex(parent_id)}")
-                    continue
+    class Dir():
+        def __init__(self, parent_id, inode, depth=0, path='', names=''):
+            self.parent_id = parent_id
+            self.inode = inode
+            self.depth = depth
+            self.path = path
+            self.names = names
+            self.rows = [] # blkid's and (record, sub Dir)
+
+    loop = asyncio.get_running_loop()
+    seen = set()
+
+    def dir_blocks(d):
+        blkids = []
+        try:
+            for blkid in d.inode.each_block(err_ok=True): blkids.append(blkid)
+        except Unrecovered as e:
+            _error(f"inode {hex(d.inode.id)} Unrecovered\t{d.path}\n* {e.msg}\n")
+        return blkids
+
+    async def level(dirs):
+        blkids = await asyncio.gather(*[loop.run_in_executor(_sb.pool, dir_blocks, d) for d in dirs])
+        await _sb.read_blocks({blkid for blks in blkids for blkid in blks})
+        found = []
+        for d, blks in zip(dirs, blkids):
+            for blkid in blks:
+                found.append((d, blkid, None))
                 try:
-                    if e.name in b'..': raise ValueError()
-                    child = _sb.inode(e.inode)
-                except ValueError:
-                    child = None
-                if child == None:
-                    Printer('  '*depth, f'\br {e.name_utf8}', f'  \b1 {hex(e.inode)}',)
+                    dblk = DirectoryBlk(_sb, blkid)
+                    dblk.validate(all=True)
+                except Unrecovered:
+                    _error(f"blk #{blkid} Unrecovered\t{d.path}\n")
                     continue
-                child.validate(all=True)
-                isdir = child.ftype == child.S_IFDIR
-                tail = f'\berr {len(child._errors)} Errors' if child._errors else Line(child.pretty_val('mode'), '  \b3$', pretty_num(child.size_lo))
-                Printer('  '*depth, f"\b{'2' if isdir else '!'} {e.name_utf8}", f'  \b1 {hex(e.inode)}', '  ', tail)
-                if child._errors: _error(f"inode {hex(child.id)} Errors\t{path}\n", *[f"* {e}\n" for e in child._errors])
-                if isdir: continue
-                if depth+1 == depth__d: continue
-                branch(inode.id, child, depth+1, path)
-        return inode
+                if dblk._errors: _error(f"blk #{blkid} Errors\t{d.path}\n",*[f"* {e}\n" for e in dblk._errors])
+                for e in dblk.entries:
+                    if e.name == b'' and e.inode == 0: continue
+                    path = d.path + f'\bdem /\b {e.name_utf8}\bdem  {hex(e.inode)} \b '
+                    if e.name == b'.':
+                        if e.inode != d.inode.id: _error(f". Error\t{path}\n* self inode mismatch {hex(e.inode)} != {hex(d.inode.id)}")
+                        continue
+                    if e.name == b'..':
+                        if d.parent_id != None and e.inode != d.parent_id:
+                            _error(f".. Error\t{path}\n* parent inode mismatch {hex(e.inode)} != {hex(d.parent_id)}")
+                        continue
+                    found.append((d, blkid, e))
+        inodes = await _sb.read_inodes({e.inode for _, _, e in found if e and e.name not in b'..'})
+        subs = []
+        for d, blkid, e in found:
+            if e == None:
+                if not out: d.rows.append(blkid)
+                continue
+            rec = dict(path=f'{d.names}/{e.name_utf8}', name=e.name_utf8, inode=e.inode, parent=d.inode.id, blkid=blkid, depth=d.depth, mode=None, size=None, errors=None)
+            sub = None
+            if e.inode not in inodes and 0 < e.inode < _sb.inode_count:
+                _error(f"inode {hex(e.inode)} Unrecovered\t{d.path}\bdem /\b {e.name_utf8}\n")
+            elif e.inode in inodes and e.name not in b'..':
+                child = _sb.inode(e.inode)
+                try:
+                    child.validate(all=True)
+                except Unrecovered as ex:
+                    child._errors.append(ex.msg)
+                rec.update(mode=child.pretty_val('mode'), size=child.size_lo, errors=list(child._errors))
+                if child._errors:
+                    _error(f"inode {hex(child.id)} Errors\t{d.path}\bdem /\b {e.name_utf8}\bdem  {hex(e.inode)} \b \n", *[f"* {e}\n" for e in child._errors])
+                if child.ftype == child.S_IFDIR and d.depth+1 != depth__d and child.id not in seen:
+                    seen.add(child.id)
+                    sub = Dir(d.inode.id, child, d.depth+1, d.path + f'\bdem /\b {e.name_utf8}\bdem  {hex(e.inode)} \b ', rec['path'])
+                    subs.append(sub)
+            if out:
+                out(**rec)
+            else:
+                d.rows.append((rec, sub))
+        return subs
+
+    def show(d):
+        for row in d.rows:
+            if not isinstance(row, tuple):
+                Printer(f'#{row}', style='dem')
+                continue
+            rec, sub = row
+            if rec['mode'] == None:
+                Printer('  '*rec['depth'], f"\br {rec['name']}", f"  \b1 {hex(rec['inode'])}",)
+                continue
+            isdir = rec['mode'][0] == 'd'
+            tail = f"\berr {len(rec['errors'])} Errors" if rec['errors'] else Line(rec['mode'], '  \b3$', pretty_num(rec['size']))
+            Printer('  '*rec['depth'], f"\b{'2' if isdir else '!'} {rec['name']}", f"  \b1 {hex(rec['inode'])}", '  ', tail)
+            if sub: show(sub)
+
+    out = records.Records(format, ['path', 'name', 'inode', 'parent', 'blkid', 'depth', 'mode', 'size', 'errors']) if format != 'text' else None
     inode = _sb.inode(root_inode or cur_inode())
     inode.validate(all=True)
-    if inode._errors: _error(f"inode {hex(inode.id)} Errors\t", *[f"* {e}\n" for e in inode._errors])
-    branch(parent__p, inode)
-    return errs
-    
+    root = Dir(parent__p, inode)
+    seen.add(inode.id)
+    try:
+        if inode._errors: _error(f"inode {hex(inode.id)} Errors\t", *[f"* {e}\n" for e in inode._errors])
+        dirs = [root]
+        while dirs:
+            dirs = await level(dirs)
+    finally:
+        if out:
+            out.close()
+        else:
+            show(root)
+    if not out: return errs
+
+
+
+def log_dirty(_sb, offset, size, analysis='local/analysis/'):
+    ''' Note the block groups that a write touched in the dirty log, so the next `analyze` redoes them '''
+    if not os.path.isdir(analysis): return
+    first, last = offset // _sb.block_size // _sb.blocks_per_group, (offset + size - 1) // _sb.block_size // _sb.blocks_per_group
+    with open(analysis+'dirty.log', 'a') as f:
+        f.write(''.join(f'{bg}\n' for bg in range(first, last+1)))
+
 
 
-def analyze(fname='local/analysis/', *, _sb):
+def _group_fingerprint(_sb, bgrp, dblks):
+    ''' A hash of what analyze's result for a group depends on: its bitmaps, its inode table and the directory blocks found in it '''
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    first = bgrp.bg*_sb.blocks_per_group + bgrp.bitmap_offset
+    for _, data in scan.blocks(_sb, [*range(first, first + 2 + bgrp.inode_block_count), *dblks]):
+        h.update(data)
+    return h.hexdigest()
+
+
+
+def analyze(fname='local/analysis/', *, _sb, verify=False, memory:int=256):
     ''' Search every block for blocks that look like directory entries
 
+    Blocks that --mapfile says were never recovered are skipped, and listed at the end.
+    After the first run only the groups in the dirty log (filled in by the change_* commands) are redone,
+    along with the groups whose directories point into them.
+    The directory blocks and inodes of all the groups are merged on disk into analysis_blkids.u64 and
+    analysis_inodes.u64 (sorted uint64), so the totals don't need them all in memory.
+
     Parameters:
         <filename>  | default='local/scan_dir.pickle'
             Where to save the data
+        --verify
+            Also redo the analyzed groups whose fingerprint changed, e.g. after the image was changed by another tool
+        --memory <MB>
+            How much of the merged blkids and inodes to hold in memory before spilling a sorted run to disk
     '''
-    version = 11
+    from e2fs.directory import DirectoryBlk
+    import mmap
+    from e2fs import spill
+    version = 12
     try:
         with open(fname+'analysis_info.pickle', 'rb') as f:
             v, bg = pickle.load(f)
@@ -277,12 +445,21 @@ def analyze(fname='local/analysis/', *, _sb):
     if not os.path.exists(fname+'analysis_blocks.data'):
         with open(fname+'analysis_blocks.data', 'wb') as f:
             f.write(bytearray(_sb.blocks_count_lo//8))
+    try:
+        with open(fname+'analysis_unreadable.pickle', 'rb') as f:
+            unreadable = pickle.load(f)
+    except FileNotFoundError:
+        unreadable = {} # bg -> [blkid]
     # This is called for every block group
     total_valid = 0
+    check = getattr(_sb.stream, 'unreadable', None)
     def _handle(bgrp, valid):
         nonlocal total_valid
         blkids = set()
         inodes = set()
+        marked = []
+        deps = set() # The groups of the inode tables it read
+        skipped = unreadable[bgrp.bg] = []
         head_count = bgrp.bitmap_offset + bgrp.inode_block_count + 2
         base = bgrp.bg*_sb.blocks_per_group
         for i in range(_sb.blocks_per_group):
@@ -290,6 +467,10 @@ def analyze(fname='local/analysis/', *, _sb):
             if blkid == _sb.blocks_count_lo: break
             if i < head_count: valid[blkid] = 1
             if valid[blkid]: continue
+            if check and check(blkid*_sb.block_size, _sb.block_size):
+                skipped.append(blkid)
+                continue
+            if _sb.classes and _sb.classes.skip(blkid): continue # Zero or high-entropy, so not a directory
             # is it a directory?
             d = DirectoryBlk(_sb, blkid)
             d.validate()
@@ -300,16 +481,15 @@ def analyze(fname='local/analysis/', *, _sb):
             for e in d.entries:
                 try: inode = _sb.inode(e.inode)
                 except: continue
+                deps.add((inode.id - 1) // _sb.inodes_per_group)
                 if inode.id in inodes: continue # it was already good
-                inode.validate()
-                iblks = iter(inode)
-                iblks.allow0 = False
                 try:
-                    iblks = set(iblks)
+                    inode.validate()
+                    iblks = set(inode.each_block())
                     if not iblks: raise ValueError
                     if inode.size_lo <= (len(iblks)-1)*_sb.block_size: raise ValueError
                     if inode.size_lo > len(iblks)*_sb.block_size: raise ValueError
-                except ValueError:
+                except (ValueError, Unrecovered):
                     continue
                 # A good inode and good iblks
                 inodes.add(inode.id)
@@ -317,98 +497,495 @@ def analyze(fname='local/analysis/', *, _sb):
                     for iblk in iblks:
                         total_valid += 1
                         valid[iblk] = 1
+                        marked.append(iblk)
             update(f'#{bgrp.bg}.{blkid}  {len(blkids)} {len(inodes)} {total_valid}', tag={'progress':(bgrp.bg, _sb.bg_count)})
-        return blkids, inodes
+        return (blkids, inodes), (_group_fingerprint(_sb, bgrp, blkids), marked, deps)
+
+    def _save(bg, resp, state):
+        with open(fname+f'analysis_bg{bg}.pickle', 'wb') as f:
+            pickle.dump(resp, f)
+        with open(fname+f'analysis_state{bg}.pickle', 'wb') as f:
+            pickle.dump(state, f)
+        with open(fname+'analysis_unreadable.pickle', 'wb') as f:
+            pickle.dump(unreadable, f)
+
+    # The groups to redo: the dirty ones, the ones whose fingerprint changed, and the ones that read their inode tables
+    redo = set()
+    if os.path.exists(fname+'dirty.log'):
+        with open(fname+'dirty.log') as f:
+            redo = {int(l) for l in f if l.strip() and int(l) < bg}
+    states = {}
+    for g in range(bg if redo or verify else 0):
+        with open(fname+f'analysis_state{g}.pickle', 'rb') as f:
+            states[g] = pickle.load(f)
+    if verify:
+        for g in range(bg):
+            if g in redo: continue
+            with open(fname+f'analysis_bg{g}.pickle', 'rb') as f:
+                dblks = pickle.load(f)[0]
+            if _group_fingerprint(_sb, _sb.blkgrp(g), dblks) != states[g][0]: redo.add(g)
+    redo |= {g for g, (_, _, deps) in states.items() if deps & redo}
+    if redo: # Rebuild the valid blocks from the groups that stay, then redo the others on top
+        buf = bytearray(_sb.blocks_count_lo//8)
+        keep = BitmapMem(buf)
+        for g in range(bg):
+            bgrp = _sb.blkgrp(g)
+            for blkid in range(g*_sb.blocks_per_group, min(_sb.blocks_count_lo, g*_sb.blocks_per_group + bgrp.bitmap_offset + bgrp.inode_block_count + 2)):
+                keep[blkid] = 1
+            if g not in redo:
+                for blkid in states[g][1]: keep[blkid] = 1
+        with open(fname+'analysis_blocks.data', 'wb') as f:
+            f.write(buf)
+
     btotal = 0
     itotal = 0
-    with open(fname+'analysis_blocks.data', 'rb+') as valid_stream:
-        valid = Bitmap(valid_stream, 0, _sb.blocks_count_lo//8)
+    # A bit test per block of the image: in memory, not a syscall each
+    with open(fname+'analysis_blocks.data', 'rb+') as valid_stream, mmap.mmap(valid_stream.fileno(), 0) as valid_map:
+        valid = BitmapMem(valid_map)
+        if redo:
+            with Printer().progress(f"redo {len(redo)}/{bg} groups", height_max=10) as update:
+                for i, g in enumerate(sorted(redo)):
+                    resp, state = _handle(_sb.blkgrp(g), valid)
+                    update.name = f'redo #{g}  blkids:{len(resp[0])}  inodes:{len(resp[1])}'
+                    update('bg', tag={'progress':(i, len(redo))})
+                    _save(g, resp, state)
+        if os.path.exists(fname+'dirty.log'): os.remove(fname+'dirty.log')
         with Printer().progress(f"from {bg}/{_sb.bg_count}", height_max=10) as update:
             while bg < _sb.bg_count:
-                resp = _handle(_sb.blkgrp(bg), valid)
+                resp, state = _handle(_sb.blkgrp(bg), valid)
                 btotal += len(resp[0])
                 itotal += len(resp[1])
                 update.name = f'#{bg}  blkids:{len(resp[0])}/{btotal}  inodes:{len(resp[1])}/{itotal}  valid:{total_valid}'
                 update('bg', tag={'progress':(bg, _sb.bg_count)})
+                _save(bg, resp, state)
                 bg += 1
                 with open(fname+'analysis_info.pickle', 'wb') as f:
                     pickle.dump((version, bg), f)
-                with open(fname+f'analysis_bg{bg-1}.pickle', 'wb') as f:
-                    pickle.dump(resp, f)
     with open(fname+'analysis_blocks.data', 'rb') as valid_stream:
-        blkids = set()
-        inodes = set()
-        valid = Bitmap(valid_stream, 0, _sb.blocks_count_lo//8)
+        blkids = spill.Runs(fname+'analysis_blkids.u64', (memory<<20)//2)
+        inodes = spill.Runs(fname+'analysis_inodes.u64', (memory<<20)//2)
+        valid = BitmapMem(valid_stream.read(_sb.blocks_count_lo//8))
         for bg in range(_sb.bg_count):
             with open(fname+f'analysis_bg{bg}.pickle', 'rb') as f:
                 b,i = pickle.load(f)
-                blkids.update(b)
-                inodes.update(i)
+                blkids.add(b)
+                inodes.add(i)
+        blkids, inodes = blkids.close(), inodes.close()
         Printer(f"blkids:{len(blkids)}  valid:{len(valid)}/{_sb.blocks_count_lo}  inodes:{len(inodes)}/{_sb.inode_count}")
+    _report_unreadable([blkid for skipped in unreadable.values() for blkid in skipped])
+
+
+
+def _report_unreadable(blkids, limit=10):
+    ''' Summarize the blocks a scan skipped because the mapfile says they were never recovered '''
+    if not blkids: return
+    runs = [(first, first+count-1) for first, count, _ in scan.windows(sorted(blkids), len(blkids), gap=1)]
+    Printer(f"\berr {len(blkids)}\b  unrecovered blocks skipped in {len(runs)} ranges: ", ', '.join(f'{a}' if a == b else f'{a}-{b}' for a, b in runs[:limit]), ' ...' if len(runs) > limit else '')
+
+
+
+def classify(fname='local/classes.npy', *, _sb, window:int=4):
+    ''' Classify every block as zero, text, binary, high-entropy, indirect or directory, for --classes
+
+    Parameters:
+        <fname>
+            Where to save the classes, one byte per block
+        --window <MB>
+            How much to read and classify at once
+    '''
+    from e2fs.classify import classify, NAMES
+    with Printer().progress("classifying", height_max=10) as update:
+        def _progress(i, total):
+            if i%16 == 0: update(f"{i}/{total}", tag={'progress':(i, total)})
+        counts = classify(_sb, fname, window<<20, _progress)
+    for name, n in zip(NAMES, counts.tolist()):
+        if n: Printer(f"{name:>13}  \b3 {n:>12}\b   {n*100/_sb.blocks_count_lo:5.1f}%")
+    Printer(f"Saved in \b1 {fname}")
+
+
+
+def scan_inodes(dest='local/inodes/', *, _sb, min_score:int=4):
+    ''' Score every inode slot in the inode tables and save the plausible ones, for find_inodes
+
+    The tables are read front to back, --queue-depth groups at a time, and scored with numpy, one table per step.
+
+    Parameters:
+        <dest>
+            Where to save the table
+        --min-score <int>
+            Leave out the slots that pass fewer of the 6 checks (file type, flags, block pointers, size, times, dtime)
+    '''
+    from e2fs.inode_table import scan
+    with Printer().progress("0", height_max=10) as update:
+        def _progress(bg, slots, rows):
+            if bg%64 == 0:
+                update.name = f"#{bg}/{_sb.bg_count}"
+                update(f"{slots} slots  {rows} rows", tag={'progress':(bg, _sb.bg_count)})
+        slots, rows, bad = scan(_sb, dest, min_score, _progress)
+    if bad: Printer(f"\berr {len(bad)}\b  unrecovered groups skipped:", ' '.join(map(str, bad[:20])), ' ...' if len(bad) > 20 else '')
+    Printer(f"{rows} of {slots} inode slots scored {min_score} or more, saved in \b1 {dest}")
+
+
+
+def _range(spec, conv):
+    ''' 'lo:hi', 'lo:' or ':hi' -> (lo, hi) with None for an open end '''
+    if spec == None: return None
+    lo, _, hi = str(spec).partition(':')
+    return (conv(lo) if lo else None, conv(hi) if hi else None)
+
+
+
+def _when(v):
+    ''' A time as seconds since the epoch or YYYY-MM-DD[THH:MM[:SS]] '''
+    from datetime import datetime
+    try:
+        return coerce_int(v)
+    except ValueError:
+        return int(datetime.fromisoformat(v).timestamp())
+
+
+
+def find_inodes(*, _sb, table='local/inodes/', ftype=None, size=None, mtime=None, min_score:int=6, free__f=False, limit__l:int=50):
+    ''' Query the table saved by scan_inodes
+
+    Parameters:
+        --table <path>
+            Where scan_inodes saved it
+        --ftype <f|d|l|p|c|b|s>
+            Only this file type
+        --size <lo:hi>
+            Only sizes in this range (either end can be left out)
+        --mtime <lo:hi>
+            Only modification times in this range, as YYYY-MM-DD[THH:MM] or seconds since the epoch
+        --min-score <int>
+            Only inodes that passed at least this many checks
+        --free, -f
+            Only inodes the inode bitmap says are free: deleted or lost files
+        --limit <int>, -l <int>
+            Show at most this many
+    '''
+    from datetime import datetime
+    from e2fs.inode import enums
+    from e2fs.inode_table import InodeTable
+    t = InodeTable(table)
+    if ftype != None:
+        types = {v.split()[0]:k for k, v in enums['ftype'].items()}
+        if ftype not in types: raise PrettyException(msg=f"Unknown file type {ftype!r}, one of {' '.join(types)}")
+        ftype = types[ftype]
+    sel = t.query(size=_range(size, coerce_int), mtime=_range(mtime, _when), ftype=ftype, min_score=min_score, used=0 if free__f else None)
+    for row in t.rows[sel[:limit__l]]:
+        inode = _sb.inode(int(row['id']))
+        Printer(f"\b1 {hex(row['id'])}\b   {inode.pretty_val('mode')}  \b3 {pretty_num(int(row['size']))}\b   {datetime.fromtimestamp(int(row['mtime']))}  score:{row['score']}", '' if row['used'] else '  \berr free')
+    Printer(f"{len(sel)} of {len(t)} inodes match", style='dem')
+
+
+
+def timeline(start=None, end=None, *, _sb, table='local/inodes/', times='mtime,ctime,atime,dtime', names='local/file_list.txt', ftype=None, min_score:int=6, limit__l:int=200, _format='text'):
+    ''' What happened between two times: every inode time in the window, oldest first, with the file's names
+
+    Uses the time indexes of the table saved by scan_inodes, so a window is a binary search per time column.
+
+    Parameters:
+        <start>
+            YYYY-MM-DD[THH:MM[:SS]] or seconds since the epoch.  Leave out (or '') for no lower bound
+        <end>
+            The same, for the upper bound (inclusive)
+        --table <path>
+            Where scan_inodes saved it
+        --times <mtime,ctime,atime,dtime>
+            Which of the times to include
+        --names <path>
+            The list saved by build_file_list, for the names of the inodes (skipped when it doesn't exist)
+        --ftype <f|d|l|p|c|b|s>
+            Only this file type
+        --min-score <int>
+            Only inodes that passed at least this many checks
+        --limit <int>, -l <int>
+            Show at most this many
+    '''
+    from datetime import datetime
+    from e2fs.inode import enums
+    from e2fs.inode_table import InodeTable, TIMES
+    from e2fs.file_list import paths
+    cols = tuple(times.split(','))
+    for col in cols:
+        if col not in TIMES: raise PrettyException(msg=f"Unknown time {col!r}, one of {' '.join(TIMES)}")
+    types = {k:v.split()[0] for k, v in enums['ftype'].items()}
+    if ftype != None and ftype not in types.values(): raise PrettyException(msg=f"Unknown file type {ftype!r}, one of {' '.join(types.values())}")
+    t = InodeTable(table)
+    when, sel, which = t.timeline(_when(start) if start else None, _when(end) if end else None, cols)
+    rows = t.rows[sel]
+    keep = rows['score'] >= min_score
+    if ftype != None: keep &= (rows['mode'] & 0xf000) == {v:k for k, v in types.items()}[ftype]
+    total = int(keep.sum())
+    when, rows, which = when[keep][:limit__l], rows[keep][:limit__l], which[keep][:limit__l]
+    found = paths(names, {int(id) for id in rows['id']}) if os.path.exists(names) else {}
+    if _format != 'text':
+        with records.Records(_format, ['time', 'event', 'inode', 'ftype', 'size', 'used', 'paths']) as out:
+            for w, row, col in zip(when.tolist(), rows, which.tolist()):
+                out(time=w, event=cols[col], inode=int(row['id']), ftype=types.get(int(row['mode']) & 0xf000), size=int(row['size']), used=bool(row['used']), paths=found.get(int(row['id']), []))
+        return
+    for w, row, col in zip(when.tolist(), rows, which.tolist()):
+        id = int(row['id'])
+        Printer(f"{datetime.fromtimestamp(w)}  \b3 {cols[col][0]}\b  \b1 {hex(id)}\b  {types.get(int(row['mode']) & 0xf000, '?')} {pretty_num(int(row['size']))}  ", ' '.join(found.get(id, [])), '' if row['used'] else '  \berr free')
+    Printer(f"{min(total, limit__l)} of {total} events in {len(t)} inodes", style='dem')
+
+
+
+def carve(dest='local/carve/', *, _sb, analysis='local/analysis/', types=None, max_size:int=256, window:int=4):
+    ''' Recover files by their signature from the blocks that analyze didn't find an owner for
+
+    Parameters:
+        <dest>
+            Where to write the files (named by their first blkid) and carved.tsv
+        --types <name,...>
+            Only these formats: gzip zip pdf jpeg sqlite qcow2 wiredtiger tar
+        --max-size <MB>
+            Stop following a file after this much
+        --window <MB>
+            How much of the unclaimed blocks to read at once
+    '''
+    import numpy as np
+    from math import ceil
+    from e2fs.carve import Carver, FORMATS, unclaimed_runs
+    names = types.split(',') if types else None
+    for n in names or []:
+        if n not in FORMATS: raise PrettyException(msg=f"Unknown format {n!r}, one of {' '.join(FORMATS)}")
+    with open(analysis+'analysis_blocks.data', 'rb') as f:
+        bitmap = f.read(_sb.blocks_count_lo//8)
+    bits = np.unpackbits(np.frombuffer(bitmap, dtype=np.uint8), bitorder='little').astype(bool)
+    carver = Carver(_sb, lambda blkid: bool(bits[blkid]), names, max_size<<20)
+    runs = list(unclaimed_runs(bitmap, _sb.blocks_count_lo, max(1, (window<<20) // _sb.block_size), _sb.classes))
+    found = []
+    with Printer().progress("finding", height_max=10) as update:
+        for i, hits in enumerate(scan.pmap(_sb.pool, carver.find, runs, _sb.queue_depth)):
+            found.extend(hits)
+            if i%16 == 0: update(f"{len(found)} found", tag={'progress':(i, len(runs))})
+    starts = {blkid for blkid, _ in found}
+    taken = set()
+    files = []
+    for blkid, name in found:
+        if blkid in taken: continue # Inside a file carved already
+        blocks, why = carver.follow(blkid, name, starts)
+        size, why = carver.size(name, blocks, why)
+        blocks = blocks[:ceil(size / _sb.block_size)]
+        taken.update(blocks)
+        files.append((blkid, name, blocks, size, why))
+    os.makedirs(dest, exist_ok=True)
+    def _write(f):
+        blkid, name, blocks, size, why = f
+        with open(os.path.join(dest, f'{blkid}.{FORMATS[name][2]}'), 'wb') as out:
+            missing = carver.write(blocks, size, out)
+        if missing: why += f', {len(missing)} unrecovered blocks zeroed'
+        return blkid, name, blocks, size, why
+    counts = {}
+    with open(os.path.join(dest, 'carved.tsv'), 'w') as manifest, Printer().progress("writing", height_max=10) as update:
+        manifest.write('blkid\tformat\tsize\tblocks\tend\n')
+        for i, (blkid, name, blocks, size, why) in enumerate(scan.pmap(_sb.pool, _write, files, _sb.queue_depth)):
+            manifest.write(f'{blkid}\t{name}\t{size}\t{len(blocks)}\t{why}\n')
+            counts[name] = counts.get(name, 0) + 1
+            update(f"\b2 {blkid}.{FORMATS[name][2]}\b   {pretty_num(size)}  {why}", tag={'progress':(i, len(files))})
+    Printer(f"{len(files)} files carved into \b1 {dest}\b :", '  '.join(f'{n}:{c}' for n, c in sorted(counts.items())))
+
+
+
+def index_hashes(fname='local/hashes.npy', *, _sb, unclaimed=False, analysis='local/analysis/', window:int=4, memory:int=256):
+    ''' Hash every non-zero block into a table sorted by hash, for match
+
+    Parameters:
+        <fname>
+            Where to save the table
+        --unclaimed
+            Only the blocks that analyze didn't find an owner for
+        --window <MB>
+            How much to read and hash at once
+        --memory <MB>
+            How much of the table to sort in memory at a time before spilling a sorted run to disk
+    '''
+    from e2fs.carve import unclaimed_runs
+    from e2fs.hashes import index
+    bitmap = bytes(_sb.blocks_count_lo//8)
+    if unclaimed:
+        with open(analysis+'analysis_blocks.data', 'rb') as f:
+            bitmap = f.read(_sb.blocks_count_lo//8)
+    runs = unclaimed_runs(bitmap, _sb.blocks_count_lo, max(1, (window<<20) // _sb.block_size), _sb.classes)
+    with Printer().progress("hashing", height_max=10) as update:
+        def _progress(i, total, rows):
+            if i%16 == 0: update(f"{rows} blocks", tag={'progress':(i, total)})
+        rows = index(_sb, fname, runs, _progress, memory<<20)
+    Printer(f"{rows} blocks hashed into \b1 {fname}")
+
+
+
+def match(file, *, _sb, table='local/hashes.npy', _format='text'):
+    ''' Find the blocks of a known file (e.g. from a backup) on the image, through the table of index-hashes
+
+    Shows the runs of the file's blocks that were found, and where, in the most likely order.
+
+    Parameters:
+        <file>
+            The reference file
+        --table <path>
+            The table saved by index-hashes
+    '''
+    from e2fs.hashes import HashTable, candidates, order
+    bs = _sb.block_size
+    if not os.path.isfile(file): raise PrettyException(msg=f"{file} is not a file")
+    with open(file, 'rb') as f:
+        cands = candidates(HashTable(table), f, bs)
+    runs = order(cands)
+    if _format != 'text':
+        with records.Records(_format, ['offset', 'blkid', 'blocks', 'candidates']) as out:
+            for idx, blkid, count in runs:
+                out(offset=idx*bs, blkid=blkid, blocks=count, candidates=len(cands[idx]))
+        return
+    found = sum(count for _, _, count in runs)
+    zeros = sum(1 for c in cands if c == None)
+    for idx, blkid, count in runs:
+        more = f"  \bdem +{len(cands[idx])-1} other copies" if len(cands[idx]) > 1 else ''
+        Printer(f"{pretty_num(idx*bs)}\bdem  file blocks \b {idx}-{idx+count-1}  ->  blkids \b1 {blkid}-{blkid+count-1}", more)
+    Printer(f"\b{'2' if found + zeros == len(cands) else 'err'} {found}/{len(cands) - zeros}\b  blocks found in {len(runs)} runs", f"\bdem   ({zeros} zero blocks not looked up)" if zeros else '')
+
+
+
+def journal(blkid:int=None, *, _sb, fname='local/journal.pickle', limit__l:int=20, _format='text'):
+    ''' Index the old copies of metadata blocks in the journal, or list the copies of one block
+
+    The whole journal is read once, and the index of which transactions logged each block, and where the copies
+    are, saved for the --txn option of blkls, blk_data and inode_.
+
+    Parameters:
+        <blkid>
+            List the copies of this block in the saved index, instead of making it
+        --fname <path>
+            Where to save the index
+        --limit <int>, -l <int>
+            Show this many of the latest transactions
+    '''
+    from datetime import datetime
+    from e2fs.journal import Journal, scan
+    def _time(t): return datetime.fromtimestamp(t) if t != None else '?'
+    if blkid != None:
+        jnl = Journal.load(fname) if os.path.exists(fname) else scan(_sb)
+        revoked = jnl.revokes.get(blkid, [])
+        if _format != 'text':
+            with records.Records(_format, ['blkid', 'txn', 'time', 'copy', 'escaped', 'revoked']) as out:
+                for txn, jblk, escaped in jnl.versions.get(blkid, []):
+                    out(blkid=blkid, txn=txn, time=jnl.txns[txn][1], copy=jnl.blocks[jblk], escaped=escaped, revoked=[r for r in revoked if r >= txn])
+            return
+        for txn, jblk, escaped in jnl.versions.get(blkid, []):
+            Printer(f"\b3 txn {txn}\b   {_time(jnl.txns[txn][1])}   copy at \b1 #{jnl.blocks[jblk]}\b \bdem  (journal block {jblk})", '  escaped' if escaped else '')
+        for txn in revoked:
+            Printer(f"\b3 txn {txn}\b   {_time(jnl.txns[txn][1] if txn in jnl.txns else None)}   \berr revoked")
+        Printer(f"#{blkid}: {len(jnl.versions.get(blkid, []))} copies in the journal", style='dem')
+        return
+    with _progress(_format, "journal") as update:
+        jnl = scan(_sb, lambda done, total: update(f"{done} blocks", tag={'progress':(done, total)}))
+    jnl.save(fname)
+    txns = sorted(jnl.txns)
+    if _format != 'text':
+        with records.Records(_format, ['txn', 'time', 'commit', 'blocks']) as out:
+            for txn in txns:
+                commit, when, count = jnl.txns[txn]
+                out(txn=txn, time=when, commit=commit, blocks=count)
+        return
+    for txn in txns[-limit__l:]:
+        commit, when, count = jnl.txns[txn]
+        Printer(f"\b3 txn {txn}\b   {_time(when)}   {count} blocks   \bdem commit at journal block {commit}")
+    Printer(f"Journal blocks {jnl.first}-{jnl.last-1}, " + (f"log starts at {jnl.start} with txn {jnl.sequence}" if jnl.start else "clean"))
+    Printer(f"\b2 {len(txns)}\b  committed transactions" + (f" ({txns[0]}-{txns[-1]})" if txns else ''), f", {len(jnl.uncommitted)} incomplete" if jnl.uncommitted else '')
+    Printer(f"{sum(len(v) for v in jnl.versions.values())} copies of {len(jnl.versions)} blocks, {len(jnl.revokes)} blocks revoked, saved to \b1 {fname}")
+
+
+
+def _grep_strings(data, pat):
+    ''' Like `strings | grep pattern` on one block '''
+    return [s for s in re.findall(rb'[\x20-\x7e\t]{4,}', bytes(data)) if pat.search(s)]
 
 
 
 def grep(pattern, *, _sb, analysis='local/analysis/'):
-    from subprocess import run, DEVNULL
+    ''' Find the unclaimed blocks (not used by any inode analyze found) containing a string that matches `pattern`
+    Blocks that --mapfile says were never recovered are skipped.
+    '''
+    import hashlib
     os.makedirs('local/grep', exist_ok=True)
     hval = hashlib.md5(pattern.encode('utf8')).hexdigest()
+    pat = re.compile(pattern.encode('utf8'))
     try:
         with open(f'local/grep/{hval}.pickle', 'rb') as f:
             found = pickle.load(f)
     except:
-        found = set()
-        infile = os.environ.get("IMG_FILE")
         found = set()
         with open(analysis+'analysis_blocks.data', 'rb') as valid_stream:
-            blkids = set()
-            inodes = set()
-            valid = Bitmap(valid_stream, 0, _sb.blocks_count_lo//8)
-            total = valid.total() - len(valid)
-            with Printer().progress("0", height_max=10) as update:  
-                for i, blkid in enumerate(valid.each_false()):
-                    if i%64 == 0:
-                        update.name = f"{i*100/total:.1f}%"
-                        update(f"{i} {len(found)}", tag={'progress':(i, total)})
-                    #print(blkid)
-                    cmd = f'dd if={infile} skip={blkid} bs={_sb.block_size} count=1 | strings | grep {pattern!r}'
-                    if run(cmd, shell=True, stderr=DEVNULL).returncode: continue
-                    update(f"\b2 {blkid}")
+            valid = BitmapMem(valid_stream.read(_sb.blocks_count_lo//8))
+        total = valid.total() - len(valid)
+        skipped = []
+        with Printer().progress("0", height_max=10) as update:  
+            blkids = _sb.classes.keep(valid.each_false()) if _sb.classes else valid.each_false()
+            for i, (blkid, data) in enumerate(scan.blocks(_sb, blkids, skipped=skipped)):
+                if i%4096 == 0:
+                    update.name = f"{i*100/total:.1f}%"
+                    update(f"{i} {len(found)}", tag={'progress':(i, total)})
+                if not _grep_strings(data, pat): continue
+                found.add(blkid)
+                update(f"\b2 {blkid}")
+        _report_unreadable(skipped)
         with open(f'local/grep/{hval}.pickle', 'wb') as f:
             pickle.dump(found, f)
         
-    for blkid in found:
-        Printer.hr(f"{blkid}")
-        cmd = f'dd if={infile} skip={blkid} bs={_sb.block_size} count=1 | strings | grep {pattern!r}'
-        run(cmd, shell=True, stderr=DEVNULL)
+    for blkid, data in scan.blocks(_sb, found):
+        Printer().hr(f"{blkid}")
+        for s in _grep_strings(data, pat):
+            Printer(s.decode('ascii'))
+
+
+
+def _progress(format, name):
+    ''' A Printer progress bar, or one that shows nothing when stdout has jsonl or tsv records '''
+    if format == 'text': return Printer().progress(name, height_max=10)
+    from contextlib import nullcontext
+    class _Quiet():
+        def __call__(self, *args, **kwargs): pass
+    return nullcontext(_Quiet())
+
 
 
+def build_file_list(*, _sb, fname='local/file_list.txt', analysis='local/analysis/', _format='text'):
+    ''' List every entry of the directory blocks found by analyze into `fname`
 
-def build_file_list(*, _sb, fname='local/file_list.txt', analysis='local/analysis/'):
+    Each line is `blkid inode dir parent name`, where dir and parent are the '.' and '..' entries of the block.
+    With --format jsonl or tsv the records go to stdout instead.
+    '''
+    from e2fs.directory import DirectoryBlk
+    from e2fs.spill import SortedFile
     folders = set()
     nfiles = 0
-    if os.path.exists(fname):
+    if _format == 'text' and os.path.exists(fname):
         print('done')
         return
-    with open(fname, 'w') as f:
-        with Printer().progress("0", height_max=10) as update: 
-            for bg in range(_sb.bg_count):
-                with open(analysis+f'analysis_bg{bg}.pickle', 'rb') as fblk:
-                    blkids,_ = pickle.load(fblk)
-                    for blkid in blkids:
-                        d = DirectoryBlk(_sb, blkid)
-                        dot = [0, 0, 0]
-                        for e in d:
-                            if not e.name: continue
-                            if e.name in b'..':
-                                dot[len(e.name)] = e.inode
-                                folders.add(e.inode)
-                                continue
-                            nfiles += 1
-                            f.write(f'{blkid} {hex(e.inode)} {hex(dot[1])} {hex(dot[2])} {e.name_utf8}\n')
-                        # Done with this block
-                    # Close the block file
-                update.name = f"{bg*100/_sb.bg_count:.1f}%"
-                update(f"{bg} {nfiles} {len(folders)}", tag={'progress':(bg, _sb.bg_count)})
+    out = records.Records(_format, ['blkid', 'inode', 'dir', 'parent', 'name']) if _format != 'text' else None
+    with open(fname, 'w') if not out else out as f:
+        # The directory blocks of all the groups, merged and sorted by analyze, streamed in physical order
+        found = SortedFile(analysis+'analysis_blkids.u64')
+        with _progress(_format, "0") as update:
+            for i, blkid in enumerate(scan.ordered(_sb, found.iter())):
+                d = DirectoryBlk(_sb, blkid)
+                dot = [0, 0, 0]
+                for e in d:
+                    if not e.name: continue
+                    if e.name in b'..':
+                        dot[len(e.name)] = e.inode
+                        folders.add(e.inode)
+                        continue
+                    nfiles += 1
+                    if out:
+                        out(blkid=blkid, inode=e.inode, dir=dot[1], parent=dot[2], name=e.name_utf8)
+                    else:
+                        f.write(f'{blkid} {hex(e.inode)} {hex(dot[1])} {hex(dot[2])} {e.name_utf8}\n')
+                if i % 1024 == 0:
+                    update.name = f"{blkid*100/_sb.blocks_count_lo:.1f}%"
+                    update(f"{i} {nfiles} {len(folders)}", tag={'progress':(i, len(found))})
             # Done with progress
         # Close the fname
     with open(f'local/known_folders.pickle', 'wb') as f:
@@ -416,27 +993,27 @@ def build_file_list(*, _sb, fname='local/file_list.txt', analysis='local/analysi
 
 
 
-def dotfiles(*,_input, sb=1024, fdblks='local/pruned.pickle', fpc='local/parent_child.pickle'):
-    sb = Superblock(_input, sb)
+def dotfiles(*, _sb, fdblks='local/pruned.pickle', fpc='local/parent_child.pickle'):
+    from e2fs.directory import DirectoryBlk
     with open(fdblks, 'rb') as f:
         dblks = pickle.load(f)
+        blkids = set()
+        for blks in dblks.values(): blkids.update(blks)
     try:
         with open(fpc, 'rb') as f:
             mappings = pickle.load(f)
     except:
         mappings = set()
-        bi = 0
-        for e, blks in dblks.items():
-            for blkid in blks:
-                if (bi:=bi+1)%10000 == 0:
-                    print(f"{bi} {len(mappings)}")
-                dblk = DirectoryBlk(sb, blkid)
-                e = iter(dblk)
-                d0 = next(e)
-                if d0.name != b'.': continue
-                d1 = next(e)
-                assert(d1.name == b'..')
-                mappings.add( (blkid, d0.inode, d1.inode) )
+        for bi, blkid in enumerate(scan.ordered(_sb, blkids)):
+            if bi%10000 == 0:
+                print(f"{bi} {len(mappings)}")
+            dblk = DirectoryBlk(_sb, blkid)
+            e = iter(dblk)
+            d0 = next(e)
+            if d0.name != b'.': continue
+            d1 = next(e)
+            assert(d1.name == b'..')
+            mappings.add( (blkid, d0.inode, d1.inode) )
         with open(fpc, 'wb') as f:
             pickle.dump(mappings, f)
     for m in mappings:
@@ -444,6 +1021,7 @@ def dotfiles(*,_input, sb=1024, fdblks='local/pruned.pickle', fpc='local/parent_
 
 
 def rootfiles(*, _input, sb=1024, fpc='local/parent_child.pickle'):
+    from e2fs.directory import DirectoryBlk
     sb = Superblock(_input, sb)
     with open(fpc, 'rb') as f:
         fpc = pickle.load(f)
@@ -465,9 +1043,40 @@ def rootfiles(*, _input, sb=1024, fpc='local/parent_child.pickle'):
     
 
 
-def blkls(blkid:int, *, _sb):
+BLKLS_FIELDS = ['blkid', 'name', 'inode', 'mode', 'size', 'free', 'errors']
+
+
+
+def _blkls(_sb, blkid, out):
+    ''' Write a record for each entry of a directory block to `out` (see e2fs.records) '''
+    from e2fs.directory import DirectoryBlk
+    d = DirectoryBlk(_sb, blkid)
+    d.validate(all=True)
+    for e in d.entries:
+        try:
+            inode = _sb.inode(e.inode)
+        except:
+            out(blkid=blkid, name=e.name_utf8, inode=e.inode, errors=['Invalid inode ID'])
+            continue
+        inode.validate(all=True)
+        out(blkid=blkid, name=e.name_utf8, inode=e.inode, mode=inode.pretty_val('mode'), size=inode.size_lo, free=bool(inode.is_free), errors=inode._errors)
+
+
+
+def blkls(blkid:int, *, _sb, _format='text', txn:int=None):
     ''' Show the contents of a directory block
+
+    Parameters:
+        <blkid>
+            The directory block
+        --txn <int>
+            Show the block, and the inodes it points to, as of this transaction of the journal
     '''
+    from e2fs.directory import DirectoryBlk
+    _sb = _at_txn(_sb, txn)
+    if _format != 'text':
+        with records.Records(_format, BLKLS_FIELDS) as out: _blkls(_sb, blkid, out)
+        return
     Printer().hr(blkid)
     d = DirectoryBlk(_sb, blkid)
     d.validate(all=True)
@@ -493,13 +1102,15 @@ def blkls(blkid:int, *, _sb):
 
 
 
-def search(pattern, *, _sb, fdblks='local/pruned.pickle', fmatches=None, verbose__v=False):
+def search(pattern, *, _sb, fdblks='local/pruned.pickle', fmatches=None, verbose__v=False, _format='text'):
     ''' Search all the identified directory-blocks for a file that matches `pattern`
 
     Parameters:
         <pattern>
             A regex pattern to match filenames against
     '''
+    import hashlib
+    from e2fs.directory import DirectoryBlk
     hval = hashlib.md5(pattern.encode('utf8')).hexdigest()
     if fmatches == None: fmatches = f"local/search/{hval}.pickle"
     pat = re.compile(pattern)
@@ -512,8 +1123,8 @@ def search(pattern, *, _sb, fdblks='local/pruned.pickle', fmatches=None, verbose
             matches = pickle.load(f)
     except:
         matches = set()
-        with Printer().progress(f"searching for {pattern!r} -> {fmatches}", height_max=10) as p:
-            for bi, blkid in enumerate(blkids):
+        with _progress(_format, f"searching for {pattern!r} -> {fmatches}") as p:
+            for bi, blkid in enumerate(scan.ordered(_sb, blkids)):
                 if bi%4096 == 0:
                     p(f"{bi}/{len(blkids)} {bi*100/len(blkids):.1f}%  found: {len(matches)} ", tag={'progress':(bi,len(blkids))})
                 d = DirectoryBlk(_sb, blkid)
@@ -524,7 +1135,18 @@ def search(pattern, *, _sb, fdblks='local/pruned.pickle', fmatches=None, verbose
                     break
         with open(fmatches, 'wb') as f:
             pickle.dump(matches, f)
-    for blkid in matches:
+    if _format != 'text':
+        with records.Records(_format, BLKLS_FIELDS if verbose__v else ['blkid', 'name', 'inode']) as out:
+            for blkid in scan.ordered(_sb, matches):
+                if verbose__v:
+                    _blkls(_sb, blkid, out)
+                    continue
+                for e in DirectoryBlk(_sb, blkid):
+                    if pat.fullmatch(e.name_utf8, re.I):
+                        out(blkid=blkid, name=e.name_utf8, inode=e.inode)
+                        break
+        return
+    for blkid in scan.ordered(_sb, matches):
         if verbose__v:
             blkls(blkid, _sb=_sb)
             continue
@@ -538,9 +1160,10 @@ def search(pattern, *, _sb, fdblks='local/pruned.pickle', fmatches=None, verbose
 
 
 
-def isearch(inode:int, *, _sb, fdblks='local/pruned.pickle', fmatches=None):
+def isearch(inode:int, *, _sb, fdblks='local/pruned.pickle', fmatches=None, _format='text'):
     ''' Find all directory entries that point to this inode
     '''
+    from e2fs.directory import DirectoryBlk
     if fmatches == None: fmatches = f"local/isearch/{hex(inode)}.pickle"
     with open(fdblks, 'rb') as f:
         dblks = pickle.load(f)
@@ -551,8 +1174,8 @@ def isearch(inode:int, *, _sb, fdblks='local/pruned.pickle', fmatches=None):
             matches = pickle.load(f)
     except:
         matches = set()
-        with Printer().progress(f"searching for entries pointing to {inode!r}", height_max=10) as update:
-            for bi, blkid in enumerate(blkids):
+        with _progress(_format, f"searching for entries pointing to {inode!r}") as update:
+            for bi, blkid in enumerate(scan.ordered(_sb, blkids)):
                 if bi%4096 == 0:
                     update(f"{bi}/{len(blkids)} {bi*100/len(blkids):.1f}%  found: {len(matches)} ", tag={'progress':(bi,len(blkids))})
                 d = DirectoryBlk(_sb, blkid)
@@ -562,7 +1185,11 @@ def isearch(inode:int, *, _sb, fdblks='local/pruned.pickle', fmatches=None):
                     break
         with open(fmatches, 'wb') as f:
             pickle.dump(matches, f)
-    for blkid in matches:
+    if _format != 'text':
+        with records.Records(_format, BLKLS_FIELDS) as out:
+            for blkid in scan.ordered(_sb, matches): _blkls(_sb, blkid, out)
+        return
+    for blkid in scan.ordered(_sb, matches):
         blkls(blkid, _sb=_sb)
     print(len(matches))
 
@@ -594,8 +1221,7 @@ def change_block(inode, index:int, blkid:int, *, _sb):
     areyousure()
     offset = inode.offset + inode.flds['block'][0] + 4*index
     data = struct.pack('<I', blkid)
-    _sb.stream.seek(offset)
-    _sb.stream.write(data)
+    _sb.write(offset, data)
     Printer("Wrote:", data, " to ", pretty_num(offset))
 
 
@@ -615,8 +1241,7 @@ def change_blkcount(nblks:int, *, _sb):
     areyousure()
     offset = inode.offset + inode.flds['blocks_lo'][0]
     data = struct.pack('<I', new_lo)
-    _sb.stream.seek(offset)
-    _sb.stream.write(data)
+    _sb.write(offset, data)
     Printer("Wrote:", data, " to ", pretty_num(offset))
 
 
@@ -632,6 +1257,7 @@ def change_dir_entry(blkid:int, name, inode:int, *, _sb):
         <inode>
             The new inode that filename should point to
     '''
+    from e2fs.directory import DirectoryBlk
     blkls(blkid, _sb=_sb)
     d = DirectoryBlk(_sb, blkid)
     for e in d:
@@ -643,12 +1269,68 @@ def change_dir_entry(blkid:int, name, inode:int, *, _sb):
     areyousure()
     offset = e.offset + e.flds['inode'][0]
     data = struct.pack('<I', inode)
-    _sb.stream.seek(offset)
-    _sb.stream.write(data)
+    _sb.write(offset, data)
     Printer("Wrote:", data, " to ", pretty_num(offset))
 
 
 
+def patch(action='status', fname=None, *, _sb):
+    ''' Manage the --overlay of pending and committed writes
+
+    Parameters:
+        <action>
+            status: list the batches.  commit: close the pending batch.  rollback: throw the pending batch away.
+            export <fname>: write the committed pages to a compact patch file.
+            apply <fname>: write a patch file into the --overlay, or into the image itself with -w
+        <fname>
+            The patch file to export or apply
+    '''
+    from e2fs.overlay import Overlay, apply
+    from e2fs.cache import BlockCache
+    s = _sb.stream
+    while not isinstance(s, (Overlay, BlockCache)) and hasattr(s, 'stream'): s = s.stream
+    def _changed(page, pages):
+        from e2fs.stream import Remap
+        t = _sb.stream
+        while t is not s:
+            if isinstance(t, Remap): # The pages are in the image, not in the --volume or --nested filesystem
+                if pages: Printer("Run \b1 analyze --verify\b  to find the groups this changed", style='dem')
+                return
+            t = t.stream
+        for n in pages:
+            for fn in _sb.on_write: fn(n*page, page)
+    if action == 'apply':
+        if not fname: raise PrettyException(msg="Which patch file?")
+        if not s.writable(): raise PrettyException(msg="Open the image with \b1 -w\b  or apply the patch to an \b1 --overlay")
+        if not isinstance(s, Overlay): areyousure()
+        page, pages = apply(fname, s)
+        _sb.cache_clear()
+        _changed(page, pages)
+        Printer(f"Wrote {len(pages)} pages from \b1 {fname}\b  into {s.fname if isinstance(s, Overlay) else 'the image'}")
+        return
+    if not isinstance(s, Overlay): raise PrettyException(msg="Pass the patch file with \b1 --overlay")
+    if action == 'status':
+        for batch, pages in s.batches:
+            Printer(f"batch \b1 {batch}\b   {pages} pages")
+        Printer(f"pending \b1 {s.batch}\b   {len(s.pending)} pages", style='dem' if not s.pending else None)
+        Printer(f"{len(set(s.committed) | set(s.pending))} pages of {pretty_num(s.page_size)} changed, {pretty_num(s.end)} in \b1 {s.fname}")
+    elif action == 'commit':
+        done = s.commit()
+        Printer(f"Committed batch \b1 {done[0]}\b  of {done[1]} pages" if done else "Nothing pending")
+    elif action == 'rollback':
+        pages = s.rollback()
+        _sb.cache_clear()
+        _changed(s.page_size, pages)
+        Printer(f"Threw away {len(pages)} pending pages")
+    elif action == 'export':
+        if not fname: raise PrettyException(msg="Where to export to?")
+        if s.pending: Printer(f"{len(s.pending)} pending pages are not exported", style='err')
+        Printer(f"Exported {s.export(fname)} pages to \b1 {fname}")
+    else:
+        raise PrettyException(msg=f"Unknown action {action!r}")
+
+
+
 def cp(inode, dest, *, _sb, force__f=False):
     ''' Copy a file to some external destination
     '''
@@ -693,33 +1375,84 @@ def cp(inode, dest, *, _sb, force__f=False):
 
 
 
+async def export(inode, dest='-', *, _sb, strict=False):
+    ''' Write the tree under a directory as a tar archive (names, modes, owners, mtimes, symlinks and holes)
+
+    Any directory inode can be the root, including an orphaned one found with isearch or dotfiles.
+
+    Parameters:
+        <inode>
+            The directory (name or inode) to export
+        <dest>
+            The tar file to write, or - for stdout
+        --strict
+            Stop on an invalid blkid in a file instead of exporting it as a hole
+    '''
+    from e2fs.export import TarExport
+    root = _sb.inode(name_or_inode(inode, _sb=_sb))
+    if root.ftype != root.S_IFDIR: raise PrettyException(msg=f"Not a directory {root.pretty_val('mode')}")
+    tar = await TarExport(_sb, root, err_ok=not strict).walk()
+    if dest == '-':
+        tar.write(sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        for err in tar.errors: sys.stderr.write(err + '\n')
+        return
+    with open(dest, 'wb') as f, Printer().progress(f"Exporting {hex(root.id)} -> {dest}", height_max=10) as update:
+        def _progress(i, total, path):
+            if i%64 == 0: update(f"{i}/{total} {path}", tag={'progress':(i, total)})
+        tar.write(f, _progress)
+    if tar.errors: Printer().card(f"Errors\t", *[f"* {e}\n" for e in tar.errors], style='err')
+    Printer(f"{len(tar.entries)} entries, {pretty_num(tar.nbytes)} of file data written to \b1 {dest}")
+
+
+
 def cat_special(inode):
     offset, size, _ = inode.flds['block']
     block = read(inode.sb.stream, offset + inode.offset, size)
     Printer(block)
 
 
-def cat(inode, *, _sb, binary__b=False, encoding='utf8', size__s=-1):
+def cat(inode, *, _sb, binary__b=False, raw__r=False, encoding='utf8', size__s=-1, verbose__v=False):
     ''' Show the contents inode's data blocks
+
+    Parameters:
+        --binary, -b
+            Show a hex dump
+        --raw, -r
+            Write the file's bytes, and nothing else, to stdout: holes as zeros, cut at the file size.
+            Runs of blocks are sent straight from the image with sendfile, for piping large files into other tools.
+            Unrecovered blocks (--mapfile) are written as zeros too, with a warning on stderr; errors go to stderr.
+        --verbose, -v
+            With -b, show every row instead of collapsing runs of zero rows
     '''
     inode = _sb.inode(name_or_inode(inode, _sb=_sb))
+    if raw__r:
+        from e2fs.export import send_file
+        if inode.ftype != inode.S_IFREG: raise PrettyException(msg=f"{hex(inode.id)} is not a regular file {inode.pretty_val('mode')}")
+        sys.stdout.flush()
+        try:
+            out = sys.stdout.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation): # e.g. the daemon's stdout, sent to the client
+            out = sys.stdout.buffer
+        missing = []
+        try:
+            send_file(_sb, inode, out, size__s, missing)
+            if out is sys.stdout.buffer: out.flush()
+        except BrokenPipeError:
+            pass
+        except PrettyException as e: # stdout is the data
+            sys.stderr.write(f"{e.msg}\n")
+            sys.exit(1)
+        if missing: sys.stderr.write(f"{hex(inode.id)}: {len(missing)} unrecovered blocks written as zeros, from #{missing[0]}\n")
+        return
     Printer().hr(repr(inode), border_style='dem')
     if inode.ftype not in {inode.S_IFDIR, inode.S_IFREG}:
         return cat_special(inode)
-    for data in inode.each_line(32 if binary__b else 4096, not binary__b, size=size__s):
-        if not binary__b:
-            sys.stdout.buffer.write(data)
-            continue
-        line = Line()
-        ascii = ''
-        for i,b in enumerate(data):
-            is_ascii = (b >32 and b < 127)
-            if i and i%4==0: line(' ')
-            if i and i%2==0: line(' ')
-            line(f"{b:02x}", style='dem' if b==0 else 'y' if is_ascii else '')
-            
-            ascii += chr(b) if is_ascii else ' '
-        Printer(line, f"\bdem {Bdr.codes['- - ']}", ascii, f"\bdem {Bdr.codes['- - ']}")
+    if binary__b:
+        from e2fs.hexdump import dump
+        return dump(inode.each_line(64<<10, False, size=size__s), squeeze=not verbose__v)
+    for data in inode.each_line(4096, True, size=size__s):
+        sys.stdout.buffer.write(data)
 
 
 
@@ -731,17 +1464,29 @@ def cd(name, *, _sb):
 
 
 async def shell(*, _sb):
+    ''' Run sub-commands interactively.  Ctrl-C stops the running command and returns to the prompt.
+    '''
+    import asyncio, signal, shlex, traceback
     from print_ext.printer import printer_for_stream
     direct = printer_for_stream(end='')
+    loop = asyncio.get_running_loop()
     while True:
         direct(f'\bg!, {hex(cur_inode())} \bb {cur_path(_sb)} $')
         direct.stream.write(' ')
         direct.stream.flush()
-        cmd = sys.stdin.readline()
+        cmd = await loop.run_in_executor(None, sys.stdin.readline)
         if not cmd: break
         try:
             cmd = CLI.Command(main)(shlex.split(cmd))
-            await cmd.next_cmd.run(dict(_sb=_sb))
+            format = cmd.run_spec.kwargs.get('format', 'text')
+            task = asyncio.ensure_future(cmd.next_cmd.run(dict(_sb=_sb, _format=records.check('text' if format is Parameter.empty else format))))
+            loop.add_signal_handler(signal.SIGINT, task.cancel)
+            try:
+                await task
+            finally:
+                loop.remove_signal_handler(signal.SIGINT)
+        except asyncio.CancelledError:
+            Printer('Interrupted', style='err')
         except PrettyException as e:
             Printer().pretty(e)
         except Exception as e:
@@ -750,6 +1495,20 @@ async def shell(*, _sb):
 
 
 
+async def daemon(*, _sb, socket='local/e2fsgrok.sock'):
+    ''' Keep the image and caches open and serve sub-commands over a unix socket
+
+    Point `cli.py` at it with E2FSGROK_SOCKET=<socket>, and send it `quit` to stop.
+
+    Parameters:
+        --socket <path>
+            Where to listen
+    '''
+    from .daemon import serve
+    await serve(main, _sb, socket)
+
+
+
 def test(*,_sb):
     from .prompt import Prompt
     p = Prompt(value='here', choices={'plants', 'pottery', 'pot', 'horse', 'hungry', 'happy', ''}, history=['history3', 'history2', 'history1'])
@@ -761,17 +1520,93 @@ def test(*,_sb):
 
 
 
-@CLI.sub_cmds(grep, shell, test, change_dir_entry, change_block, superblocks, descriptors, blkgrp, root_inodes, inode_, blk_data, ls, analyze, blkls, dotfiles, rootfiles, search, change_blkcount, isearch, cp,cd, cat, build_file_list)
-def main(*, sb=1024, write__w=False, fname__f=None):
-    grep_groups({
-        'e2fs': [('py', 'e2fs', '*/__pycache__/*')],
-        'pyutil': [('py', 'pyutil', '*/__pycache__/*')],
-    })
+def nested_stream(_sb, spec, write=False):
+    ''' The InodeStream for a --nested <inode:offset[:size]> spec '''
+    from e2fs.stream import InodeStream
+    if write: raise PrettyException(msg="--nested filesystems are read-only")
+    try:
+        parts = [coerce_int(v) for v in spec.split(':')]
+        inode, offset, size = parts[0], (parts[1:2] or [0])[0], (parts[2:3] or [None])[0]
+    except (ValueError, IndexError):
+        raise PrettyException(msg=f"Bad --nested {spec!r}, expected \b1 inode:offset[:size]")
+    inode = _sb.inode(inode)
+    if inode.ftype != inode.S_IFREG: raise PrettyException(msg=f"--nested {hex(inode.id)} is not a regular file {inode.pretty_val('mode')}")
+    return InodeStream(_sb, inode, offset, size, err_ok=True)
+
+
+
+@CLI.sub_cmds(grep, shell, daemon, test, volumes, patch, change_dir_entry, change_block, superblocks, descriptors, blkgrp, root_inodes, inode_, blk_data, ls, analyze, blkls, dotfiles, rootfiles, search, change_blkcount, isearch, cp, export, cd, cat, build_file_list, scan_inodes, find_inodes, carve, classify, index_hashes, match, timeline, journal)
+def main(*, sb=1024, write__w=False, fname__f=None, overlay=None, mapfile=None, volume=None, nested=None, classes='local/classes.npy', format='text', cache=256, queue_depth=32, stats=False, stats_json=None):
+    ''' Investigate ext2/ext3 filesystem images
+
+    Parameters:
+        --sb <int>
+            Byte offset of the superblock to use
+        --write, -w
+            Open the image for writing
+        --fname <path>, -f <path>
+            The filesystem image (defaults to $IMG_FILE)
+        --overlay <path>
+            Keep all writes (change_*) in this patch file instead of the image, which stays untouched and is read
+            underneath.  Writes collect in a pending batch until `patch commit` or `patch rollback`.
+        --mapfile <path>
+            The ddrescue mapfile of a partial image.  Reads that touch a range that wasn't recovered fail right away
+            instead of returning ddrescue's zeros, and analyze, grep, search and ls -k skip and report those blocks.
+        --volume <spec>
+            Use a partition or LVM2 logical volume of the image: `2`, `vg/lv` (or just `lv`), or `2/vg/lv` for a
+            logical volume inside partition 2.  See the `volumes` sub-command.
+        --nested <inode:offset[:size]>
+            Investigate the filesystem stored inside a file of the image, e.g. a VM disk image, starting `offset` bytes
+            into inode's data.  Nothing is copied: reads go through the file's block map and the image's cache.
+            --sb then applies to the inner filesystem.
+        --classes <path>
+            The block classes saved by classify.  When it exists, and was made from this filesystem opened the same
+            way, analyze and grep skip the zero and high-entropy blocks, carve skips the zero ones, and blk_data shows
+            the class.  Blocks written since are unknown again.
+        --format <text|jsonl|tsv>
+            How ls, blkls, search, isearch, descriptors and build_file_list write their results: text for people, or
+            one record per line (JSON, or tab separated with a header) straight to stdout, for jq and databases
+        --cache <MB>
+            Size of the block cache in front of the image
+        --queue-depth <int>
+            How many reads the async commands (ls, shell, export) and scan-inodes keep in flight
+        --stats
+            Print read counters and subsystem timers after the command
+        --stats-json <path>
+            Also write the counters and timers to this file as JSON
+    '''
     if not fname__f: fname__f = os.environ.get('IMG_FILE', '')
     os.environ['IMG_FILE'] = fname__f
+    if stats or stats_json: e2fs_stats.enable()
+    records.check(format)
+    from e2fs.cache import BlockCache
+    if mapfile:
+        from e2fs.mapfile import Mapfile, Mapped
+        mapfile = Mapfile(mapfile)
     try:
         with open(fname__f, 'r+b' if write__w else 'rb') as f:
-            yield dict(_sb=Superblock(f, sb))
+            if mapfile: # Cache pages can straddle a bad range, so only refuse reads above the cache
+                stream = Mapped(BlockCache(Mapped(f, mapfile, strict=False), cache<<20), mapfile)
+            else:
+                stream = BlockCache(f, cache<<20)
+            if overlay:
+                from e2fs.overlay import Overlay
+                stream = Overlay(stream, overlay)
+            if volume:
+                from e2fs.volume import open_volume
+                stream = open_volume(stream, volume)
+            _sb = Superblock(stream, sb if not nested else 1024, queue_depth=queue_depth)
+            if nested: _sb = Superblock(nested_stream(_sb, nested, write__w), sb, queue_depth=queue_depth)
+            _sb.source = ' '.join([os.path.realpath(fname__f)] + [f'--{k} {v}' for k, v in [('overlay', overlay and os.path.realpath(overlay)), ('volume', volume), ('nested', nested)] if v])
+            _sb.on_write.append(lambda offset, size: log_dirty(_sb, offset, size))
+            _sb.on_write.append(lambda offset, size: _sb.classes and _sb.classes.forget(offset // _sb.block_size, (offset + size - 1) // _sb.block_size + 1))
+            if os.path.exists(classes):
+                from e2fs.classify import load as load_classes
+                _sb.classes = load_classes(_sb, classes)
+            yield dict(_sb=_sb, _format=format)
+            if stats:
+                Printer().hr('stats', border_style='dem')
+                e2fs_stats.summary(Printer())
+            if stats_json: e2fs_stats.save(stats_json)
     except FileNotFoundError:
         raise PrettyException(msg=f"Set \b1 IMG_FILE\b  or pass the filesystem as \b1 -f\b ")
-    
\ No newline at end of file
@@ -0,0 +1,24 @@
+import os, shutil, subprocess
+import pytest
+from e2fs import Superblock
+
+
+@pytest.fixture
+def mkfs(tmp_path):
+    ''' mkfs(fill, size='16M', block_size=4096) packs the tree that `fill(root)` writes with `mke2fs -d` and
+    returns (image path, open Superblock)
+    '''
+    if not shutil.which('mke2fs'): pytest.skip('needs mke2fs')
+    files = []
+    def make(fill, size='16M', block_size=4096, fstype='ext3'):
+        root = tmp_path / 'root'
+        root.mkdir()
+        fill(root)
+        img = str(tmp_path / 'test.img')
+        subprocess.run(['mke2fs', '-q', '-F', '-t', fstype, '-b', str(block_size), '-I', '128', '-d', str(root), img, size],
+            env=dict(os.environ, E2FSPROGS_FAKE_TIME='1600000000'), stdout=subprocess.DEVNULL, check=True)
+        f = open(img, 'rb')
+        files.append(f)
+        return img, Superblock(f, 1024)
+    yield make
+    for f in files: f.close()
@@ -0,0 +1,67 @@
+import io, gzip, random, struct
+from types import SimpleNamespace
+from e2fs.carve import Carver
+
+BS = 1024
+
+
+def _disk(files, blocks=256):
+    ''' A fake filesystem with `files` ({first blkid: data}) in unclaimed blocks, and nothing else but zeros '''
+    data = bytearray(blocks * BS)
+    for blkid, f in files.items(): data[blkid*BS:blkid*BS+len(f)] = f
+    return SimpleNamespace(block_size=BS, blocks_count_lo=blocks, stream=io.BytesIO(bytes(data)), classes=None)
+
+
+def _carve(sb, start):
+    carver = Carver(sb, lambda blkid: False)
+    (blkid, name), = [f for f in carver.find((start, 1))]
+    blocks, why = carver.follow(blkid, name, set())
+    return carver.size(name, blocks, why)
+
+
+def _junk(n, seed=1):
+    return random.Random(seed).randbytes(n)
+
+
+def test_gzip_ends_with_its_member():
+    gz = gzip.compress(_junk(10000) + bytes(20000))
+    sb = _disk({10: gz + _junk(20*BS - len(gz), 2)})
+    assert _carve(sb, 10) == (len(gz), 'gzip end')
+
+
+def test_guessed_layout_stops_at_an_empty_block():
+    db = b'SQLite format 3\x00' + bytes(84) + _junk(3*BS - 100)
+    sb = _disk({60: db})
+    assert _carve(sb, 60) == (3*BS, 'empty block')
+    # Past the 12 direct blocks as well, after a zeroed indirect block
+    db = b'SQLite format 3\x00' + bytes(84) + _junk(12*BS - 100) + bytes(BS) + _junk(5*BS)
+    sb = _disk({60: db})
+    assert _carve(sb, 60) == (17*BS, 'empty block')
+
+
+def test_jpeg_ends_after_the_image_data_not_the_thumbnail():
+    thumb = b'\xff\xd8\xff\xdb\x00\x03\x00' + b'thumbnail' + b'\xff\xd9'
+    app1 = b'Exif\x00\x00' + thumb + _junk(1500)
+    jpg = b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1
+    jpg += b'\xff\xdb\x00\x04\x00\x01' + b'\xff\xda\x00\x03\x00' + _junk(3000).replace(b'\xff', b'\xff\x00') + b'\xff\xd9'
+    sb = _disk({80: jpg})
+    assert _carve(sb, 80) == (len(jpg), 'trailer')
+
+
+def test_pdf_ends_at_its_last_eof():
+    pdf = b'%PDF-1.4\n' + _junk(1500) + b'\n%%EOF\n' + b'1 0 obj update\n' + _junk(2000) + b'\n%%EOF\r\n'
+    sb = _disk({120: pdf + _junk(1500).replace(b'%', b'.')}) # Junk after it, not ending in %%EOF
+    assert _carve(sb, 120) == (len(pdf), 'trailer')
+
+
+def test_qcow2_ends_after_its_last_counted_cluster():
+    hdr = bytearray(BS) # Clusters of BS bytes: header, refcount table, refcount block, 2 data clusters
+    hdr[:8] = b'QFI\xfb\x00\x00\x00\x03'
+    struct.pack_into('>I', hdr, 20, 10)
+    struct.pack_into('>QI', hdr, 48, BS, 1)
+    struct.pack_into('>I', hdr, 96, 4)
+    table = struct.pack('>Q', 2*BS).ljust(BS, b'\0')
+    refs = struct.pack('>5H', 1, 1, 1, 1, 1).ljust(BS, b'\0')
+    qcow = bytes(hdr) + table + refs + _junk(2*BS)
+    sb = _disk({160: qcow + _junk(30*BS, 3)})
+    assert _carve(sb, 160) == (5*BS, 'qcow2 refcounts')
@@ -0,0 +1,33 @@
+import os, struct
+import numpy as np
+from e2fs import classify as C
+
+BS = 4096
+
+
+def test_classes():
+    indirect = struct.pack('<4I', 100, 101, 205, 300).ljust(BS, b'\0')
+    backwards = struct.pack('<3I', 100, 99, 98).ljust(BS, b'\0')
+    dirent = struct.pack('<IHBB', 2, 12, 1, 2) + b'.\0\0\0' + struct.pack('<IHBB', 2, BS-12, 2, 2) + b'..'
+    blocks = [
+        bytes(BS),
+        (b'hello world\n' * 400)[:BS],
+        os.urandom(BS),
+        indirect,
+        backwards,
+        dirent.ljust(BS, b'\0'),
+        struct.pack('<4I', 100, 101, 205, 1000).ljust(BS, b'\0'), # Out of range
+    ]
+    assert list(C.classes(b''.join(blocks), BS, 500)) == [C.ZERO, C.TEXT, C.RANDOM, C.INDIRECT, C.BINARY, C.DIRECTORY, C.BINARY]
+
+
+def test_block_classes(tmp_path):
+    fname = str(tmp_path / 'classes.npy')
+    np.save(fname, np.array([C.ZERO, C.TEXT, C.RANDOM, C.DIRECTORY], dtype=np.uint8))
+    classes = C.BlockClasses(fname)
+    assert classes.name(1) == 'text' and classes.name(10) == 'unknown'
+    skipped = [0]
+    assert list(classes.keep(range(6), skipped=skipped)) == [1, 3, 4, 5]
+    assert skipped == [2]
+    classes.forget(0, 2)
+    assert list(C.BlockClasses(fname).map) == [C.UNKNOWN, C.UNKNOWN, C.RANDOM, C.DIRECTORY]
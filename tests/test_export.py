@@ -0,0 +1,35 @@
+import io, os, asyncio, tarfile
+from e2fs.export import TarExport, send_file
+
+
+def _tree(root):
+    (root / 'a').mkdir()
+    (root / 'b').mkdir()
+    (root / 'a' / 'aa').write_bytes(os.urandom(5000))
+    os.link(root / 'a' / 'aa', root / 'b' / 'zz')
+    os.symlink('a/aa', root / 'ln')
+
+
+def test_hard_link_extracts(mkfs, tmp_path):
+    img, sb = mkfs(_tree)
+    tar = asyncio.run(TarExport(sb, sb.inode(2)).walk())
+    out = io.BytesIO()
+    tar.write(out)
+    out.seek(0)
+    members = [(m.name, m.type) for m in tarfile.open(fileobj=out)]
+    assert members.index(('./b/zz', tarfile.LNKTYPE)) > members.index(('./a/aa', tarfile.REGTYPE))
+    out.seek(0)
+    dest = tmp_path / 'out'
+    with tarfile.open(fileobj=out) as t: t.extractall(dest, filter='tar')
+    data = (tmp_path / 'root' / 'a' / 'aa').read_bytes()
+    assert (dest / 'a' / 'aa').read_bytes() == data
+    assert (dest / 'b' / 'zz').read_bytes() == data
+    assert os.readlink(dest / 'ln') == 'a/aa'
+
+
+def test_send_file_to_a_file_object(mkfs, tmp_path):
+    img, sb = mkfs(_tree)
+    inode = dict(asyncio.run(TarExport(sb, sb.inode(2)).walk()).entries)['./a/aa']
+    out = io.BytesIO() # No fileno, like the daemon's stdout
+    assert send_file(sb, inode, out) == 5000
+    assert out.getvalue() == (tmp_path / 'root' / 'a' / 'aa').read_bytes()
@@ -0,0 +1,22 @@
+from e2fs.file_list import paths
+
+
+def test_paths(tmp_path):
+    fname = tmp_path / 'file_list.txt'
+    fname.write_text('\n'.join([
+        # blkid inode dir parent name
+        '100 c 2 2 home',
+        '101 d c 2 user',
+        '102 e d c notes.txt',
+        '103 f d c link.txt',
+        '103 e d c hard.txt', # A second name
+        '200 31 30 20 orphan', # 0x30 has no entry, so its name is unknown
+        '201 40 40 40 loop', # A directory that is its own parent
+        'not a line',
+        'zz 1 2 3 bad number',
+    ]) + '\n')
+    found = paths(str(fname), [0xe, 0x31, 0x40, 0x99])
+    assert sorted(found[0xe]) == ['/home/user/hard.txt', '/home/user/notes.txt']
+    assert found[0x31] == ['#0x30/orphan']
+    assert found[0x40] == ['#0x40/loop/loop']
+    assert 0x99 not in found
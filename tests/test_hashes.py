@@ -0,0 +1,41 @@
+import os
+import numpy as np
+from e2fs.hashes import index, order, HashTable, block_hash
+
+
+def _tree(root):
+    block = os.urandom(4096)
+    for i in range(40): (root / f'f{i}').write_bytes(os.urandom(4096*59) + block) # One block in every file
+
+
+def test_index_merges_sorted_runs(mkfs, tmp_path):
+    img, sb = mkfs(_tree)
+    runs = [(0, sb.blocks_count_lo)]
+    whole = str(tmp_path / 'whole.npy')
+    spilled = str(tmp_path / 'spilled.npy')
+    assert index(sb, whole, runs) == index(sb, spilled, runs, memory=0) # 1024 rows per run
+    a, b = np.load(whole), np.load(spilled)
+    assert len(b) > 2400 and (a == b).all()
+    assert (np.diff(b['hash'].astype(np.float64)) >= 0).all()
+    assert not [f for f in os.listdir(tmp_path) if '.run' in f]
+    with open(tmp_path / 'root' / 'f0', 'rb') as f: shared = f.read()[4096*59:]
+    blkids = HashTable(spilled).lookup(block_hash(shared))
+    assert len(blkids) == 40 and blkids == sorted(blkids)
+
+
+def test_order_follows_runs():
+    cands = [
+        [50, 7],  # Both could start it: 7 is picked, as 8 continues it
+        [8, 90],
+        None,     # A zero block
+        [10, 60], # 10 continues the run from 7 past the zero block
+        [],       # Not found
+        [61],
+        [62, 11],
+    ]
+    assert order(cands) == [(0, 7, 2), (3, 10, 1), (5, 61, 2)]
+
+
+def test_order_prefers_the_next_block():
+    assert order([[5], [9, 6], [7, 3]]) == [(0, 5, 3)]
+    assert order([]) == []
@@ -0,0 +1,29 @@
+import io
+from e2fs.hexdump import rows, dump, ZERO, TEXT, DATA
+
+
+def test_zero_rows_are_squeezed():
+    data = b'A'*32 + bytes(32*5) + b'\x01'*32 + bytes(32)
+    # Split at odd places: rows go across the chunks
+    out = list(rows([data[:40], data[40:100], data[100:]], offset=0x1000))
+    assert [(pos, k) for pos, _, _, k in out] == [(0x1000, TEXT), (0x1020, ZERO), (0x1040, ZERO), (0x10c0, DATA), (0x10e0, ZERO)]
+    assert out[2][1:3] == (None, 4) # The 4 zero rows after the first
+    assert out[0][1].startswith('4141 4141') and out[0][2] == 'A'*32
+
+
+def test_verbose_and_short_rows():
+    data = bytes(32*3) + b'hi'
+    out = list(rows([data], squeeze=False))
+    assert [(pos, k) for pos, _, _, k in out] == [(0, ZERO), (32, ZERO), (64, ZERO), (96, TEXT)]
+    assert out[-1][1:3] == ('6869', 'hi')
+    # Squeezing at the end of the data
+    assert [r[1:3] for r in rows([bytes(32*3)])][1] == (None, 2)
+
+
+def test_dump():
+    out = io.StringIO()
+    dump([b'A'*16 + bytes(16) + bytes(64)], out=out, color=False)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 3
+    assert lines[0].startswith('00000000  4141') and lines[0].endswith('|' + 'A'*16 + ' '*16 + '|')
+    assert lines[2] == '00000040  *  1 zero rows'
@@ -0,0 +1,82 @@
+import numpy as np
+from types import SimpleNamespace
+from e2fs.inode_table import COLUMNS, InodeTable, check, _dtype
+
+NOW = 1_600_000_000
+SB = SimpleNamespace(block_size=4096, blocks_count_lo=1000, wtime=NOW)
+
+
+def _inode(**kw):
+    ''' A regular file of 5000 bytes in blocks 100 and 101, which passes every check '''
+    rec = np.zeros(1, dtype=_dtype(128))
+    rec['mode'], rec['size_lo'], rec['blocks_lo'], rec['links_count'] = 0x81a4, 5000, 16, 1
+    rec['block'][0, :2] = 100, 101
+    rec['atime'] = rec['ctime'] = rec['mtime'] = NOW - 100
+    for k, v in kw.items():
+        if k == 'block': rec['block'][0, :len(v)] = v
+        else: rec[k] = v
+    return rec
+
+
+def _checks(**kw):
+    checks, size = check(SB, _inode(**kw), NOW)
+    return int(checks[0])
+
+
+def test_check_scoring():
+    assert _checks() == 0x3f
+    assert _checks(mode=0x01a4) == 0x3f & ~0x01 # No file type
+    assert _checks(flags=0x40000000) == 0x3f & ~0x02 # Unknown flag
+    assert _checks(block=[100, 5000]) == 0x3f & ~0x04 # Outside the filesystem
+    assert _checks(blocks_lo=800) == 0x3f & ~0x08 # 100 blocks for 5000 bytes
+    assert _checks(mtime=NOW + 30*86400) == 0x3f & ~0x10 # From the future
+    assert _checks(atime=100) == 0x3f & ~0x10 # Before 1980
+    assert _checks(dtime=5) == 0x3f & ~0x20
+    assert _checks(dtime=NOW) == 0x3f # Deleted, at a sane time
+    # A device keeps its number in the block map, and has no size
+    assert _checks(mode=0x21a4, size_lo=0, blocks_lo=0, block=[0x0801, 0]) == 0x3f
+
+
+def test_check_size_high_only_for_regular_files():
+    _, size = check(SB, np.concatenate([_inode(size_high=1), _inode(mode=0x41ed, size_high=1, size_lo=4096, blocks_lo=8)]), NOW)
+    assert size.tolist() == [(1 << 32) + 5000, 4096]
+
+
+def _table(tmp_path, rows):
+    data = np.zeros(len(rows), dtype=np.dtype(COLUMNS))
+    for i, row in enumerate(rows):
+        for k, v in row.items(): data[i][k] = v
+    data.tofile(tmp_path / 'inodes.data')
+    return InodeTable(str(tmp_path), rebuild=True)
+
+
+ROWS = [
+    dict(id=11, mode=0x81a4, size=100, mtime=1000, ctime=1000, atime=3000, score=6, used=1),
+    dict(id=12, mode=0x81a4, size=5000, mtime=2000, ctime=2500, atime=0, score=6, used=0),
+    dict(id=13, mode=0x41ed, size=4096, mtime=2000, ctime=2000, atime=2000, score=6, used=1),
+    dict(id=14, mode=0x81a4, size=5000, mtime=4000, ctime=4000, atime=4000, score=3, used=0),
+]
+
+
+def _ids(t, sel):
+    return sorted(int(t.rows['id'][i]) for i in sel)
+
+
+def test_query_ranges_are_inclusive(tmp_path):
+    t = _table(tmp_path, ROWS)
+    assert _ids(t, t.query(size=(100, 4096))) == [11, 13]
+    assert _ids(t, t.query(size=(4096, None))) == [12, 13, 14]
+    assert _ids(t, t.query(size=(1000, None), mtime=(None, 2000))) == [12, 13]
+    assert _ids(t, t.query(mtime=(2000, 2000), ftype=0x8000)) == [12]
+    assert _ids(t, t.query(size=(5000, 5000), min_score=6)) == [12]
+    assert _ids(t, t.query(used=0)) == [12, 14]
+    assert _ids(t, t.query(size=(6000, None))) == []
+
+
+def test_timeline(tmp_path):
+    t = _table(tmp_path, ROWS)
+    times, rows, which = t.timeline(2000, 3000, cols=('mtime', 'atime'))
+    assert times.tolist() == [2000, 2000, 2000, 3000] # Sorted, and the unset atime of 12 never matches
+    assert [(int(t.rows['id'][r]), ('mtime', 'atime')[w]) for r, w in zip(rows, which)] == [(12, 'mtime'), (13, 'mtime'), (13, 'atime'), (11, 'atime')]
+    times, _, _ = t.timeline(cols=('atime',))
+    assert times.tolist() == [2000, 3000, 4000]
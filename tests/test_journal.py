@@ -0,0 +1,56 @@
+import io, struct
+from e2fs.journal import Journal, JournalSuperblock, _tags, HEADER, MAGIC, DESCRIPTOR, FLAG_SAME_UUID, FLAG_LAST_TAG, FLAG_ESCAPE
+
+BS = 1024
+
+
+def _jsb(incompat):
+    raw = bytearray(BS)
+    struct.pack_into('>IIIIIII', raw, 0, MAGIC, 4, 0, BS, 1024, 1, 1)
+    struct.pack_into('>I', raw, 0x28, incompat)
+    return JournalSuperblock(io.BytesIO(bytes(raw)), 0)
+
+
+def _descriptor(tags, tail=0):
+    block = bytearray(BS)
+    HEADER.pack_into(block, 0, MAGIC, DESCRIPTOR, 7)
+    pos = HEADER.size
+    for tag in tags:
+        block[pos:pos+len(tag)] = tag
+        pos += len(tag)
+    return bytes(block)
+
+
+def test_tags_32bit():
+    jsb = _jsb(0x1) # REVOKE only: 8 byte tags, each followed by a uuid unless SAME_UUID
+    block = _descriptor([
+        struct.pack('>IHH', 100, 0, 0) + bytes(16),
+        struct.pack('>IHH', 101, 0, FLAG_SAME_UUID | FLAG_ESCAPE),
+        struct.pack('>IHH', 500, 0, FLAG_SAME_UUID | FLAG_LAST_TAG),
+        struct.pack('>IHH', 999, 0, FLAG_SAME_UUID), # After the last tag
+    ])
+    assert list(_tags(block, jsb, jsb.feature_incompat)) == [(100, 0), (101, FLAG_SAME_UUID | FLAG_ESCAPE), (500, FLAG_SAME_UUID | FLAG_LAST_TAG)]
+
+
+def test_tags_64bit_and_csum_v3():
+    jsb = _jsb(0x1 | 0x2) # 64BIT: 12 byte tags, the high half after the flags
+    block = _descriptor([struct.pack('>IHHI', 5, 0, FLAG_SAME_UUID | FLAG_LAST_TAG, 1)])
+    assert list(_tags(block, jsb, jsb.feature_incompat)) == [((1 << 32) | 5, FLAG_SAME_UUID | FLAG_LAST_TAG)]
+    jsb = _jsb(0x1 | 0x2 | 0x10) # CSUM_V3: 16 byte tags of blocknr, flags, blocknr_high, checksum
+    block = _descriptor([struct.pack('>IIII', 6, FLAG_SAME_UUID, 2, 0), struct.pack('>IIII', 7, FLAG_SAME_UUID | FLAG_LAST_TAG, 0, 0)])
+    assert list(_tags(block, jsb, jsb.feature_incompat)) == [((2 << 32) | 6, FLAG_SAME_UUID), (7, FLAG_SAME_UUID | FLAG_LAST_TAG)]
+    # The checksum tail of the block is never read as a tag
+    assert jsb.tail_size == 4
+
+
+def test_version():
+    jnl = Journal(BS, [], 1, 1024, 0, 10)
+    jnl.versions[50] = [(10, 3, False), (12, 8, True), (15, 20, False)]
+    jnl.revokes[50] = [13]
+    assert jnl.version(50, 9) == None # Before the first copy
+    assert jnl.version(50, 10) == (10, 3, False)
+    assert jnl.version(50, 12) == (12, 8, True)
+    assert jnl.version(50, 13) == None # Revoked after the copy of 12
+    assert jnl.version(50, 14) == None
+    assert jnl.version(50, 99) == (15, 20, False) # Logged again after the revoke
+    assert jnl.version(51, 99) == None
@@ -0,0 +1,48 @@
+import io
+from e2fs.mapfile import Mapfile, Mapped
+from e2fs.cache import BlockCache
+
+
+def _mapfile(tmp_path, bad):
+    ''' A mapfile of a 1M image with the (start, size) ranges of `bad` unrecovered '''
+    lines, pos = ['0x0 +'], 0
+    for start, size in bad:
+        if start > pos: lines.append(f'{pos:#x} {start-pos:#x} +')
+        lines.append(f'{start:#x} {size:#x} -')
+        pos = start + size
+    lines.append(f'{pos:#x} {(1<<20)-pos:#x} +')
+    fname = tmp_path / 'image.map'
+    fname.write_text('\n'.join(lines) + '\n')
+    return Mapfile(str(fname))
+
+
+class Disk(io.BytesIO):
+    ''' An image that remembers every read '''
+    def __init__(self, data):
+        super().__init__(data)
+        self.reads = []
+
+    def pread(self, size, offset):
+        self.reads.append((offset, size))
+        return self.getvalue()[offset:offset+size]
+
+
+def test_bad_is_the_first_overlap(tmp_path):
+    m = _mapfile(tmp_path, [(0x1000, 0x100), (0x2200, 0x100)])
+    assert m.bad(0, 0x10000) == (0x1000, 0x1100)
+    assert m.bad(0x1100, 0x10000) == (0x2200, 0x2300)
+    assert m.bad(0x10ff, 1) == (0x1000, 0x1100)
+    assert m.bad(0x1100, 0x1100) == None
+    assert m.bad(0x3000, 0x1000) == None
+
+
+def test_two_bad_ranges_in_one_page(tmp_path):
+    m = _mapfile(tmp_path, [(0x1000, 0x100), (0x2200, 0x100)])
+    disk = Disk(b'\xff' * (1<<20))
+    stream = Mapped(BlockCache(Mapped(disk, m, strict=False), 1<<20, page=0x10000), m)
+    data = stream.stream.pread(0x10000, 0)
+    assert data[0x1000:0x1100] == bytes(0x100)
+    assert data[0x2200:0x2300] == bytes(0x100)
+    assert data.count(0) == 0x200
+    for offset, size in disk.reads:
+        assert m.bad(offset, size) == None, f'read [{offset:#x}, {offset+size:#x}) of an unrecovered range'
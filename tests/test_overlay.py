@@ -0,0 +1,51 @@
+import io
+from e2fs.overlay import Overlay, apply
+
+
+def _image(tmp_path):
+    fname = tmp_path / 'image'
+    fname.write_bytes(bytes(range(256)) * 64) # 16K
+    return open(fname, 'r+b')
+
+
+def test_writes_stay_in_the_patch(tmp_path):
+    patch = str(tmp_path / 'patch')
+    with _image(tmp_path) as img:
+        ovl = Overlay(img, patch, page=4096)
+        ovl.seek(4094)
+        ovl.write(b'XXXX') # Across two pages
+        assert ovl.pread(6, 4093) == b'\xfdXXXX\x02'
+        img.seek(0)
+        assert img.read() == bytes(range(256)) * 64
+        assert ovl.commit() == (1, 2)
+        ovl.seek(0)
+        ovl.write(b'Y')
+        assert sorted(ovl.pending) == [0]
+        assert ovl.rollback() == [0]
+        assert ovl.pread(1, 0) == b'\x00'
+        ovl.f.close()
+        # Reopened: the committed batch is there, the rolled back page isn't
+        ovl = Overlay(img, patch)
+        assert ovl.batches == [(1, 2)] and not ovl.pending
+        assert ovl.pread(6, 4093) == b'\xfdXXXX\x02'
+        ovl.f.close()
+
+
+def test_cut_record_is_dropped_and_apply(tmp_path):
+    patch = str(tmp_path / 'patch')
+    with _image(tmp_path) as img:
+        ovl = Overlay(img, patch, page=4096)
+        ovl.seek(8192)
+        ovl.write(b'Z'*10)
+        ovl.commit()
+        ovl.seek(0)
+        ovl.write(b'W')
+        ovl.f.close()
+    with open(patch, 'r+b') as f: f.truncate(f.seek(0, io.SEEK_END) - 100) # A crash while writing a page
+    with _image(tmp_path) as img:
+        ovl = Overlay(img, patch)
+        assert not ovl.pending and sorted(ovl.committed) == [2]
+        ovl.f.close()
+        assert apply(patch, img) == (4096, [2])
+        img.seek(8192)
+        assert img.read(11) == b'Z'*10 + bytes([10])
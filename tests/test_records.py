@@ -0,0 +1,26 @@
+import io, json
+import pytest
+from print_ext import PrettyException
+from e2fs import records
+
+
+def test_jsonl():
+    out = io.StringIO()
+    with records.Records('jsonl', ['a', 'b', 'c'], out=out) as rec:
+        rec(a=1, b='x\ty', extra=5)
+        rec(c=[1, 2])
+    lines = [json.loads(l) for l in out.getvalue().splitlines()]
+    assert lines == [{'a':1, 'b':'x\ty', 'c':None}, {'a':None, 'b':None, 'c':[1, 2]}]
+    assert rec.count == 2
+
+
+def test_tsv_escapes():
+    out = io.StringIO()
+    with records.Records('tsv', ['name', 'ok', 'list', 'none'], out=out) as rec:
+        rec(name='a\tb\nc\\d', ok=True, list=[1, 'x'], none=None)
+    assert out.getvalue().splitlines() == ['name\tok\tlist\tnone', 'a\\tb\\nc\\\\d\t1\t1,x\t']
+
+
+def test_check():
+    assert records.check('tsv') == 'tsv'
+    with pytest.raises(PrettyException): records.check('csv')
@@ -0,0 +1,14 @@
+from e2fs.scan import windows
+
+
+def test_collections_are_sorted_whole():
+    blkids = {5, 1, 3, 3, 2_000_001, 40, 41}
+    assert list(windows(blkids, max_blocks=8, gap=2, chunk=2)) == [(1, 5, [1, 3, 5]), (40, 2, [40, 41]), (2_000_001, 1, [2_000_001])]
+    assert list(windows(sorted(blkids, reverse=True), gap=2, chunk=2)) == list(windows(blkids, gap=2))
+
+
+def test_iterators_are_sorted_a_chunk_at_a_time():
+    # In order: the same windows whatever the chunk, with runs carried across chunks
+    assert list(windows(iter(range(10)), max_blocks=4, gap=1, chunk=3)) == [(0, 4, [0, 1, 2, 3]), (4, 4, [4, 5, 6, 7]), (8, 2, [8, 9])]
+    # Out of order: ascending within each chunk, and a window never goes backwards
+    assert list(windows(iter([9, 8, 7, 1, 2, 3]), gap=4, chunk=3)) == [(7, 3, [7, 8, 9]), (1, 3, [1, 2, 3])]
@@ -0,0 +1,23 @@
+import os, random
+from e2fs.spill import Runs
+
+
+def test_runs_merge_across_spills(tmp_path):
+    fname = str(tmp_path / 'ids.u64')
+    rng = random.Random(7)
+    values = [rng.randrange(1 << 40) for _ in range(5000)]
+    runs = Runs(fname, memory=1024*8) # 1024 ints buffered
+    for i in range(0, len(values), 300):
+        runs.add(values[i:i+300] + values[:10]) # Repeats within and across runs
+    assert len(runs.runs) >= 4
+    found = runs.close()
+    assert list(found) == sorted(set(values))
+    assert len(found) == len(set(values))
+    assert list(found.iter(chunk=7)) == sorted(set(values))
+    assert os.listdir(tmp_path) == ['ids.u64'] # The runs are removed
+
+
+def test_runs_that_fit_in_memory(tmp_path):
+    runs = Runs(str(tmp_path / 'ids.u64'))
+    runs.add([3, 1, 3, 2])
+    assert list(runs.close()) == [1, 2, 3] and runs.runs == []
@@ -0,0 +1,48 @@
+import io, struct
+from e2fs.volume import SECTOR, partitions, parse_lvm_config
+
+
+def _entry(type, first, sectors):
+    return struct.pack('<B3sB3sII', 0, b'', type, b'', first, sectors)
+
+
+def _mbr(entries):
+    table = b''.join(entries).ljust(64, b'\0')
+    return bytes(446) + table + b'\x55\xaa'
+
+
+def test_mbr_with_logical_partitions():
+    disk = bytearray(64*SECTOR)
+    disk[:SECTOR] = _mbr([_entry(0x83, 2, 8), _entry(0x05, 16, 40)])
+    # EBRs: the first logical partition at 16+1, the next EBR at 16+20 (relative to the extended partition)
+    disk[16*SECTOR:17*SECTOR] = _mbr([_entry(0x83, 1, 4), _entry(0x05, 20, 10)])
+    disk[36*SECTOR:37*SECTOR] = _mbr([_entry(0x82, 2, 6)])
+    disk[2*SECTOR:3*SECTOR] = b'P' * SECTOR
+    disk[17*SECTOR:18*SECTOR] = b'L' * SECTOR
+    parts = partitions(io.BytesIO(bytes(disk)))
+    assert [(p.name, p.size, p.desc) for p in parts] == [
+        ('1', 8*SECTOR, 'Linux'), ('5', 4*SECTOR, 'Linux'), ('6', 6*SECTOR, 'Linux swap')]
+    assert parts[0].stream.read(4) == b'PPPP'
+    assert parts[1].stream.read(4) == b'LLLL'
+
+
+def test_no_partition_table():
+    assert partitions(io.BytesIO(bytes(2*SECTOR))) == []
+
+
+def test_parse_lvm_config():
+    text = '''vg0 {
+        id = "abc-def"   # comment
+        seqno = 3
+        status = ["RESIZEABLE", "READ", "WRITE"]
+        logical_volumes {
+            root { segment1 { stripes = ["pv0", 0] } }
+        }
+    }
+    description = "say \\"hi\\""
+    '''
+    cfg = parse_lvm_config(text)
+    assert cfg['vg0']['id'] == 'abc-def' and cfg['vg0']['seqno'] == 3
+    assert cfg['vg0']['status'] == ['RESIZEABLE', 'READ', 'WRITE']
+    assert cfg['vg0']['logical_volumes']['root']['segment1']['stripes'] == ['pv0', 0]
+    assert cfg['description'] == 'say "hi"'